@@ -1,9 +1,12 @@
+from __future__ import annotations
 from typing import Union
 from pathlib import Path
-from geopandas import read_file as gpd_read_file
-from shapely.geometry import Point
+from lazy_import import lazyImport
+from subbasins import SubBasinIndex, SubBasinCache
+from metrics import stage, writeMetrics
+from compact import compactFrame
+from columnar import writeColumnar, writeColumnarRecords, getPyarrow
 import json
-import pandas
 from warnings import warn
 import logging
 import sys
@@ -12,7 +15,17 @@ config = {
     "basins_geojson_file": "cuencas/cuencas.geojson"
 }
 
-basins = gpd_read_file(config["basins_geojson_file"])
+# heavy libraries load on first use
+pandas = lazyImport("pandas")
+geopandas = lazyImport("geopandas")
+
+# basins layer, read on first use (see getBasins)
+basins = None
+basins_index = None
+# subbasin lookup table of known coordinates (SubBasinCache), set by main
+subbasin_cache = None
+# metrics of the running flow (a5_client.Client.metrics), set by main
+metrics = None
 
 internal_var_ids = {
     1: "P",
@@ -48,7 +61,7 @@ def interval2epoch(interval):
             seconds = seconds + interval[k] * 86400 * 365
     return seconds
 
-def estacionesToFews(estaciones : Union[str, list],output=None): 
+def estacionesToFews(estaciones : Union[str, list],output=None,compact=False): 
     """Converts a5 estaciones to FEWS table
     
     Parameters
@@ -59,6 +72,8 @@ def estacionesToFews(estaciones : Union[str, list],output=None):
         If list: a5_client.getEstaciones 
     output: string
         Write CSV output into this file
+    compact: bool
+        Use categorical and fixed-width dtypes (see compact.compactFrame). The CSV output is the same
     
     Returns
     -------
@@ -69,6 +84,7 @@ def estacionesToFews(estaciones : Union[str, list],output=None):
         with open(estaciones,"r") as f: 
             estaciones = json.load(f)
     rows = []
+    coordinates = []
     for item in estaciones:
         if not isinstance(item["geom"]["coordinates"][0],float):
             warn("Station %i with no geometry. Skipping" % item["id"])
@@ -84,11 +100,16 @@ def estacionesToFews(estaciones : Union[str, list],output=None):
             "TYPE": "Automatic" if item["automatica"] else "Conventional",
             "COUNTRY": item["pais"],
             "ORGANIZATION": "INA",
-            "SUBBASIN": getSubBasin(item["geom"]["coordinates"]),
+            "SUBBASIN": None,
             "PARENT_ID": "AR_INA_%i" % item["id"]
         }
         rows.append(row)
-    data_frame = pandas.DataFrame(rows).sort_values("STATION_ID")
+        coordinates.append(item["geom"]["coordinates"])
+    data_frame = pandas.DataFrame(rows)
+    data_frame["SUBBASIN"] = getSubBasins(coordinates)
+    data_frame = data_frame.sort_values("STATION_ID")
+    if compact:
+        data_frame = compactFrame(data_frame)
     if output is not None:
         try: 
             f = open(output,"w")
@@ -98,15 +119,40 @@ def estacionesToFews(estaciones : Union[str, list],output=None):
         f.close()
     return data_frame
 
+def getBasins():
+    """Returns the basins layer (config basins_geojson_file), reading it on first use"""
+    global basins
+    if basins is None:
+        basins = geopandas.read_file(config["basins_geojson_file"])
+    return basins
+
 def getSubBasin(coordinates):
-    # def get_region(lon,lat,getNotation=False):
-    st0 = Point(coordinates[0],coordinates[1])
-    subbasin = None
-    for i in range(0,len(basins.geometry)):
-        if st0.within(basins.geometry[i]):
-            # print("is within subbasin %s" % self.basins.nombre_2[i])
-            subbasin = basins.nombre_3[i]
-    return subbasin
+    return getSubBasins([coordinates])[0]
+
+def getSubBasins(coordinates : list) -> list:
+    """Assigns subbasin (basins nombre_3) to a list of [longitude, latitude] coordinates, looking them up first in subbasin_cache if set, else using a spatial index built once per basins layer
+    
+    Parameters
+    ----------
+    coordinates : list
+        List of [longitude, latitude(, altitude)]
+    
+    Returns
+    -------
+    list
+        Subbasin name of each point (None if not within any basin). For overlapping basins the last match wins
+    """
+    with stage(metrics, "subbasin"):
+        if subbasin_cache is not None:
+            return subbasin_cache.getSubBasins(coordinates, computeSubBasins)
+        return computeSubBasins(coordinates)
+
+def computeSubBasins(coordinates : list) -> list:
+    """Assigns subbasins with the geometry tests, see getSubBasins"""
+    global basins_index
+    if basins_index is None:
+        basins_index = SubBasinIndex(getBasins())
+    return basins_index.getSubBasins(coordinates)
 
 fews_series_columns = {
     1: ["STATION_ID", "STATION_NAME", "EXTERNAL_LOCATION_ID", "EXTERNAL_PARAMETER_ID", "TIMESTEP_HOUR", "UNIT", "IMPORT_SOURCE", "THRESHOLD_YELLOW", "THRESHOLD_ORANGE", "THRESHOLD_RED", "THRESHOLD_MEAN", "THRESHOLD_P05", "THRESHOLD_P10", "THRESHOLD_P90", "THRESHOLD_P95", "IMPORT", "LATITUDE", "LONGITUDE", "ALTITUDE", "TYPE", "COUNTRY", "ORGANIZATION", "SUBBASIN", "PARENT_ID", "CHILD_ID"],
@@ -119,7 +165,7 @@ fews_series_columns = {
 }
 
 
-def seriesToFews(series : Union[str,list], output=None, monthly_stats=False,stations=None,percentil=None,var_id: int=None):
+def seriesToFews(series : Union[str,list], output=None, monthly_stats=False,stations=None,percentil=None,var_id: int=None,compact=False):
     """Converts a5 series list to FEWS table
     
     Parameters
@@ -137,6 +183,8 @@ def seriesToFews(series : Union[str,list], output=None, monthly_stats=False,stat
         list of numeric percentiles to add to series metadata table (if present in series)
     var_id: int
         id of variable. If not None, result columns are selected according to FEWS requirement 
+    compact: bool
+        Use categorical and fixed-width dtypes (see compact.compactFrame). The CSV output is the same
     
     Returns
     -------
@@ -227,6 +275,8 @@ def seriesToFews(series : Union[str,list], output=None, monthly_stats=False,stat
             if column not in data_frame.columns:
                 data_frame[column] = None
         data_frame = data_frame[fews_series_columns[var_id]]
+    if compact:
+        data_frame = compactFrame(data_frame)
     logging.debug("columns: %s" % ",".join(data_frame.columns))
     if output is not None:
         try: 
@@ -244,6 +294,7 @@ if __name__ == "__main__":
     parser.add_argument('--monthly_stats', action='store_true',
         help='add monthly percentiles')
     parser.add_argument('--debug',action='store_true', help='activate debug logging')
+    parser.add_argument('-u','--url', help='base url of the a5 API. Defaults to %s' % "https://alerta.ina.gob.ar/a5")
     parser.add_argument('--var_id', nargs='*', help = "retrieve only this id(s)")
     parser.add_argument('--write_in_separate_files', action=argparse.BooleanOptionalAction, default=True, help='write separate files for each variable and time step')
     parser.add_argument('--write_final_files', action=argparse.BooleanOptionalAction, default=True, help='write final files for each variable combining all time steps')
@@ -252,6 +303,13 @@ if __name__ == "__main__":
     parser.add_argument('--output_variables',nargs=1, default="results/variables.csv", help="write variables as csv into file")
     parser.add_argument('--output_locations_fews',nargs=1, default="results/INA_locations.csv", help="write locations as csv into file")
     parser.add_argument('--output_locations_raw',nargs=1, default="results/INA_locations.json", help="write locations as raw json into file")
+    parser.add_argument('--no-subbasin-cache', action='store_true', help="don't keep the subbasin lookup table of station coordinates (subbasin_cache.json, next to the locations output)")
+    parser.add_argument('--compact_frames', action='store_true', help="keep the FEWS tables in memory with categorical / fixed-width dtypes (same CSV output)")
+    parser.add_argument('--columnar', nargs="+", default=[], choices=["parquet","arrow"], help="also write the FEWS tables and raw responses in these columnar formats (requires pyarrow): parquet (zstd), arrow (IPC, memory-mappable)")
+    parser.add_argument('--metrics', help="write the JSON run report (request and per-stage metrics) to this file")
+    parser.add_argument('--prometheus', help="write the run metrics in Prometheus text format to this file")
+    parser.add_argument('--profile', nargs="?", const="deterministic", choices=["deterministic","sampling"], help="profile the run: deterministic (cProfile, default) or sampling. Logs the top hot functions")
+    parser.add_argument('--profile-out', default="log/a5ToFews_profile", help="profile output path prefix (writes .pstats and .collapsed flamegraph stacks). Defaults to log/a5ToFews_profile")
     
     args = parser.parse_args()
 
@@ -264,16 +322,43 @@ if __name__ == "__main__":
     exclude_test_stations = True
     import datetime
     from a5_client import Client
-    a5_client = Client()
-    estaciones = a5_client.getEstaciones(has_obs=True, pais="Argentina", habilitar=True, geom="-68,-38,-53,-21")
+    # per host rate limits, shared with whos_client
+    a5_config = {}
+    if Path("config.json").exists():
+        file_config = json.load(open("config.json"))
+        if "rate_limits" in file_config:
+            a5_config["rate_limits"] = file_config["rate_limits"]
+    a5_client = Client(url = args.url, config = a5_config)
+    metrics = a5_client.metrics
+    if args.metrics is not None or args.prometheus is not None:
+        import atexit
+        # written at exit, also when the run fails
+        atexit.register(writeMetrics, metrics, args.metrics, args.prometheus)
+    if args.profile is not None:
+        import atexit
+        profiler = a5_client.profile(args.profile_out, mode=args.profile)
+        profiler.start()
+        atexit.register(profiler.stop)
+    if len(args.columnar):
+        # fail before harvesting if pyarrow is missing
+        getPyarrow()
+    with metrics.stage("fetch_stations"):
+        estaciones = a5_client.getEstaciones(has_obs=True, pais="Argentina", habilitar=True, geom="-68,-38,-53,-21")
     json.dump(estaciones,open(args.output_locations_raw,"w"))
+    with metrics.stage("write"):
+        writeColumnarRecords(estaciones, args.output_locations_raw, args.columnar)
     # len(estaciones)
     # estaciones_fews = estacionesToFews("results/estaciones.json",output="results/estaciones_fews.csv")
     if exclude_stations is not None:
         estaciones = [e for e in estaciones if e["id"] not in exclude_stations]
     if exclude_test_stations:
         estaciones = [ e for e in estaciones if "zprueba" not in e["nombre"].lower()]
-    estaciones_fews = estacionesToFews(estaciones,output=None) # args.output_locations_fews)
+    if not args.no_subbasin_cache:
+        subbasin_cache = SubBasinCache(Path(args.output_locations_fews).parent / "subbasin_cache.json", config["basins_geojson_file"])
+    with metrics.stage("convert_stations"):
+        estaciones_fews = estacionesToFews(estaciones,output=None,compact=args.compact_frames) # args.output_locations_fews)
+    if subbasin_cache is not None:
+        subbasin_cache.save()
     # SERIES
     percentil = [0.05,0.5,0.95]
     variable_id_list = default_variable_id_list if args.var_id is None else args.var_id
@@ -286,19 +371,22 @@ if __name__ == "__main__":
         logging.debug(datetime.datetime.now())
         date_range_after = datetime.datetime.now() - datetime.timedelta(days=180)
         logging.info("downloading series for stations %i to %i" % (i, i+by))
-        series_part = a5_client.getSeries(
-            proc_id=[1,2],
-            var_id=variable_id_list,
-            estacion_id=estacion_ids[i:i+by],
-            date_range_after=date_range_after.isoformat(),
-            getMonthlyStats=args.monthly_stats,
-            getPercentiles=True,
-            percentil=percentil)
+        with metrics.stage("fetch_series"):
+            series_part = a5_client.getSeries(
+                proc_id=[1,2],
+                var_id=variable_id_list,
+                estacion_id=estacion_ids[i:i+by],
+                date_range_after=date_range_after.isoformat(),
+                getMonthlyStats=args.monthly_stats,
+                getPercentiles=True,
+                percentil=percentil)
         series.extend(series_part)
         i = i + by
     if output_series_raw is not None:
         series_raw = open(output_series_raw, "w")
         json.dump(series_part, series_raw, indent = 2)
+        with metrics.stage("write"):
+            writeColumnarRecords(series_part, output_series_raw, args.columnar)
     #len(series)
     #set([s["procedimiento"]["id"] for s in series])
     #set([s["estacion"]["id"] for s in series])
@@ -307,25 +395,32 @@ if __name__ == "__main__":
     # how_old_days = 180
     # series_filter = filter(lambda serie: serie["date_range"]["timeend"] is not None and datetime.fromisoformat(serie["date_range"]["timeend"].replace("Z","")) > datetime.now() - timedelta(days=how_old_days),series)
     # series = list(series_filter)
-    series_fews = seriesToFews(
-        series,
-        output=args.output_series_fews,
-        stations=estaciones_fews,
-        monthly_stats=args.monthly_stats,
-        percentil=percentil)
+    with metrics.stage("convert_series"):
+        series_fews = seriesToFews(
+            series,
+            output=args.output_series_fews,
+            stations=estaciones_fews,
+            monthly_stats=args.monthly_stats,
+            percentil=percentil,
+            compact=args.compact_frames)
     if series_fews is None:
         logging.error("No series found")
         exit(1)
+    with metrics.stage("write"):
+        writeColumnar(series_fews, Path(args.output_series_fews).with_suffix(""), args.columnar)
     # filter and write locations
     estaciones_fews = estaciones_fews[estaciones_fews['PARENT_ID'].isin(series_fews['PARENT_ID'].unique())]
-    try: 
-        f = open(args.output_locations_fews,"w")
-    except:
-        raise Exception("Couldn't open file %s for writing" % args.output_locations_fews)
-    f.write(estaciones_fews.to_csv(index=False))
-    f.close()
+    with metrics.stage("write"):
+        try: 
+            f = open(args.output_locations_fews,"w")
+        except:
+            raise Exception("Couldn't open file %s for writing" % args.output_locations_fews)
+        f.write(estaciones_fews.to_csv(index=False))
+        f.close()
+        writeColumnar(estaciones_fews, Path(args.output_locations_fews).with_suffix(""), args.columnar)
     # VARIABLES
-    variables = a5_client.getVariables(id=variable_id_list,as_DataFrame=True)
+    with metrics.stage("fetch_variables"):
+        variables = a5_client.getVariables(id=variable_id_list,as_DataFrame=True)
     a5_client.writeLastResult(args.output_variables)
     # WRITE SERIES IN SEPARATE FILES
     if args.write_in_separate_files:
@@ -357,7 +452,11 @@ if __name__ == "__main__":
             series_subset = list(series_filter_by_var_id)
             filename = series_file_map[variables["id"][i]] if variables["id"][i] in series_file_map else "results/INA_%s.csv" % variables["nombre"][i]
             var_id = variables["id"][i] # if variables["id"][i] in fews_series_columns else None
-            series_subset_fews = seriesToFews(series_subset,output=filename,stations=estaciones_fews,monthly_stats=args.monthly_stats,percentil=percentil,var_id=var_id)
+            with metrics.stage("group"):
+                series_subset_fews = seriesToFews(series_subset,output=filename,stations=estaciones_fews,monthly_stats=args.monthly_stats,percentil=percentil,var_id=var_id,compact=args.compact_frames)
+            if series_subset_fews is not None:
+                with metrics.stage("write"):
+                    writeColumnar(series_subset_fews, Path(filename).with_suffix(""), args.columnar)
             for file, v in series_final_files.items():
                 if variables["id"][i] in v["ids"]:
                     if v["df"] is None:
@@ -369,9 +468,11 @@ if __name__ == "__main__":
                 if v["df"] is None:
                     logging.error("No data to write for file %s" % file)
                     exit(2)
-                with open(file, "w") as outfile:
-                    outfile.write(v["df"].sort_values(["STATION_ID","EXTERNAL_PARAMETER_ID"]).to_csv(index=False))
+                with metrics.stage("write"), open(file, "w") as outfile:
+                    final_df = v["df"].sort_values(["STATION_ID","EXTERNAL_PARAMETER_ID"])
+                    outfile.write(final_df.to_csv(index=False))
                     outfile.close()
+                    writeColumnar(final_df, Path(file).with_suffix(""), args.columnar)
 
 
 
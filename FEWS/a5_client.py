@@ -1,39 +1,107 @@
+from __future__ import annotations
 import requests
-import pandas as pd
+import time
 import json
 from typing import Union
 import logging
+from http_session import getSession
+from single_flight import single_flight
+from metrics import Metrics, getEndpointName, getRetries
+from profiler import Profiler
+from lazy_import import lazyImport
+pd = lazyImport("pandas")
 
 class Client:
-    """Functions to retrieve metadata and data from a5 JSON API"""
+    """Functions to retrieve metadata and data from a5 JSON API
+
+    Attributes
+    ----------
+    metrics : Metrics
+        Request counts, bytes, retries and latency by endpoint and per-stage timings of the client (see metrics.Metrics)
+    """
     
     default_config = {
         "url":"https://alerta.ina.gob.ar/a5",
         "authenticate": False,
         "token": "",
-        "timeout": 120
+        "timeout": 120,
+        "pool_maxsize": 10,
+        "retries": 5,
+        "backoff_factor": 0.5,
+        "backoff_jitter": 0.5,
+        "rate_limits": None
     }
     
     last_result = None
 
-    def __init__(self,url : str = None, authenticate : bool = False, token : str = ""):
+    def __init__(self,url : str = None, authenticate : bool = False, token : str = "", config : dict = None):
         """
         Parameters
         ----------
             url : str
             authenticate : bool
             token : str
+            config : dict
+                Additional configuration parameters: timeout, pool_maxsize, retries, backoff_factor, backoff_jitter, rate_limits (by host, see rate_limiter.getGovernor)
         """
         
         self.config = self.default_config
+        if config is not None:
+            for key in config:
+                self.config[key] = config[key]
         if url is not None:
             self.config["url"] = url
         if authenticate is not None:
             self.config["authenticate"] = authenticate
         if token is not None:
             self.config["token"] = token
+        self.metrics = Metrics("a5")
 
     
+    def request(self, url : str, params : dict = None) -> requests.Response:
+        """Sends a GET request through the shared session of the url host (connection pool, compression, timeout and retries with backoff). Adds the Authorization header if authenticate is set"""
+        headers = {}
+        if self.config["authenticate"]:
+            headers["Authorization"] = "Bearer %s" % self.config["token"]
+        start = time.perf_counter()
+        try:
+            response = getSession(url, self.config).get(
+                url,
+                params = params,
+                headers = headers,
+                timeout = self.config["timeout"]
+            )
+        except requests.exceptions.RequestException:
+            self.metrics.observeRequest(getEndpointName(url), "error", time.perf_counter() - start)
+            raise
+        self.metrics.observeRequest(getEndpointName(url), response.status_code, time.perf_counter() - start, len(response.content), getRetries(response))
+        return response
+
+    def profile(self, output : str = None, mode : str = "deterministic", interval : float = 0.01, top : int = 20) -> Profiler:
+        """Context manager profiling the enclosed calls (see profiler.Profiler)
+
+        Usage
+        -----
+            with client.profile("log/run"):
+                series = client.getSeries(var_id=[1,39,40])
+
+        Parameters
+        ----------
+        output : str
+            Output path prefix: writes <output>.pstats (deterministic mode) and <output>.collapsed (flamegraph collapsed stacks). None to only log the top-N summary
+        mode : str
+            deterministic (cProfile) or sampling
+        interval : float
+            Sampling interval in seconds
+        top : int
+            Number of hot functions logged
+
+        Returns
+        -------
+        Profiler
+        """
+        return Profiler(output, mode=mode, interval=interval, top=top)
+
     def writeLastResult(self,output : str):
         f = open(output, "w")
         if isinstance(self.last_result,pd.DataFrame):
@@ -49,14 +117,9 @@ class Client:
                 # print("%s: %s" % (param,str(params[param])))
                 params[param] = ",".join([str(i) for i in params[param]])
                 # print("%s: %s" % (param,str(params[param])))
-        headers = {}
-        if self.config["authenticate"]:
-            headers["Authorization"] = "Bearer %s" % self.config["token"]
-        response = requests.get(
+        response = self.request(
             "%s/obs/%s/series" % (self.config["url"], tipo),
-            params = params,
-            headers = headers,
-            timeout = self.config["timeout"]
+            params = params
         )
         # print("status_code: %s" % response.status_code)
         # print("url: %s" % response.url)
@@ -84,18 +147,13 @@ class Client:
         return series
     
     def getObs(self, series_id : int,timestart : str,timeend : str, tipo : str="puntual", as_DataFrame : bool=False):
-        headers = {}
-        if self.config["authenticate"]:
-            headers["Authorization"] = "Bearer %s" % self.config["token"]
-        response = requests.get(
+        response = self.request(
             '%s/obs/%s/observaciones' % (self.config["url"], tipo),
-            params={
+            params = {
                 'series_id': series_id,
                 'timestart': timestart,
                 'timeend': timeend
-            },
-            headers=headers,
-            timeout = self.config["timeout"]
+            }
         )
         if response.status_code > 299:
             raise Exception(response.text)
@@ -119,14 +177,9 @@ class Client:
         for param in ["id", "var", "nombre" , "abrev" , "type", "dataType", "valueType", "GeneralCategory", "VariableName", "SampleMedium", "def_unit_id", "timeSupport"]:
             if isinstance(params[param],list):
                 params[param] = ",".join([str(i) for i in params[param]])
-        headers = {}
-        if self.config["authenticate"]:
-            headers["Authorization"] = "Bearer %s" % self.config["token"]
-        response = requests.get(
+        response = self.request(
             "%s/obs/variables" % self.config["url"],
-            params = params,
-            headers = headers,
-            timeout = self.config["timeout"]
+            params = params
         )
         logging.debug("status_code: %s" % response.status_code)
         if response.status_code > 299:
@@ -143,20 +196,16 @@ class Client:
 
     def getEstaciones(self, fuentes_id : int=None, nombre : str=None, unid : int=None, id : int=None, id_externo : str=None,distrito: str = None, pais: str = None, has_obs : bool=None, real : bool=None, habilitar : bool=None, has_prono : bool=None, rio : str=None, tipo_2 : str=None, geom : str=None, propietario : str=None, automatica : bool=None, ubicacion : str=None, localidad : str=None, tabla : str=None, as_DataFrame : bool=False):
         params = {"fuentes_id" :fuentes_id, "nombre" : nombre, "unid" : unid, "id" : id, "id_externo" : id_externo,"distrito": distrito, "pais": pais, "has_obs" : has_obs, "real" : real, "habilitar" : habilitar, "has_prono" : has_prono, "rio" : rio, "tipo_2" : tipo_2, "geom" : geom, "propietario" : propietario, "automatica" : automatica, "ubicacion" : ubicacion, "localidad" : localidad, "tabla" : tabla}
-        headers = {}
-        if self.config["authenticate"]:
-            headers["Authorization"] = "Bearer %s" % self.config["token"]
-        response = requests.get(
-            "%s/obs/puntual/estaciones" % (self.config["url"]),
-            params = params,
-            headers = headers,
-            timeout = self.config["timeout"]
-        )
-        logging.debug("getEstaciones request: %s" % response.url)
-        logging.debug("status_code: %s" % response.status_code)
-        if response.status_code > 299:
-            raise Exception(response.text)
-        json_response = response.json()
+        url = "%s/obs/puntual/estaciones" % (self.config["url"])
+        def getJSON():
+            response = self.request(url, params = params)
+            logging.debug("getEstaciones request: %s" % response.url)
+            logging.debug("status_code: %s" % response.status_code)
+            if response.status_code > 299:
+                raise Exception(response.text)
+            return response.json()
+        # identical concurrent requests share one response
+        json_response = single_flight.do(single_flight.key(url, params, self.config["token"] if self.config["authenticate"] else None), getJSON)
         estaciones = None
         if as_DataFrame:
             estaciones = pd.DataFrame.from_dict(json_response)
@@ -171,14 +220,9 @@ class Client:
     def getEstadisticosMensuales(self,series_id : int, as_DataFrame=False):
         # https://alerta.ina.gob.ar/a5/obs/puntual/series/19/estadisticosMensuales?format=json
         params = {"format" :"json"}
-        headers = {}
-        if self.config["authenticate"]:
-            headers["Authorization"] = "Bearer %s" % self.config["token"]
-        response = requests.get(
+        response = self.request(
             "%s/obs/puntual/series/%i/estadisticosMensuales" % (self.config["url"],series_id),
-            params = params,
-            headers = headers,
-            timeout = self.config["timeout"]
+            params = params
         )
         logging.debug("status_code: %s" % response.status_code)
         if response.status_code > 299:
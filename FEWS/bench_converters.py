@@ -0,0 +1,162 @@
+"""Microbenchmarks of the FEWS converters on synthetic catalogs (generated by mock_server.MockCatalog from the sample tables in results/)
+
+Each benchmark is timed on catalogs of 1k, 10k and 50k stations/series (best and median of --repeat runs). Results are appended to a JSON lines history file and compared with the last recorded run of the same benchmark, size and host: slowdowns beyond --threshold are reported as regressions
+
+Run from the directory holding cuencas/, as whos_client.py
+
+Usage:
+    python bench_converters.py
+    python bench_converters.py --sizes 1000 10000 --benchmarks timeseriesToFEWS groupTimeseriesByVar --repeat 10
+    python bench_converters.py --fail-on-regression --threshold 1.2
+"""
+import sys
+import json
+import time
+import socket
+import logging
+import statistics
+import subprocess
+from pathlib import Path
+
+fews_dir = Path(__file__).resolve().parent
+
+import pandas
+from mock_server import MockCatalog
+from whos_client import Client
+import a5ToFews
+
+benchmarks = {}
+
+def benchmark(function):
+    """Registers a benchmark. function(inputs) is timed, inputs being the dict returned by makeInputs"""
+    benchmarks[function.__name__] = function
+    return function
+
+@benchmark
+def monitoringPointsToFEWS(inputs):
+    inputs["client"].monitoringPointsToFEWS(inputs["monitoring_points"])
+
+@benchmark
+def timeseriesToFEWS(inputs):
+    inputs["client"].timeseriesToFEWS(inputs["timeseries"], stations=inputs["stations_fews"])
+
+@benchmark
+def groupTimeseriesByVar(inputs):
+    inputs["client"].groupTimeseriesByVar(inputs["timeseries_fews"], inputs["var_map"], fews=True)
+
+@benchmark
+def getSubBasins(inputs):
+    inputs["client"].getSubBasins(inputs["coordinates"])
+
+@benchmark
+def getSubBasin(inputs):
+    client = inputs["client"]
+    for coordinates in inputs["coordinates"]:
+        client.getSubBasin(coordinates)
+
+@benchmark
+def filterByAvailability(inputs):
+    inputs["client"].filterByAvailability(inputs["timeseries"]["member"], inputs["client"].threshold_begin_date)
+
+@benchmark
+def estacionesToFews(inputs):
+    a5ToFews.estacionesToFews(inputs["estaciones"])
+
+@benchmark
+def seriesToFews(inputs):
+    a5ToFews.seriesToFews(inputs["series"], stations=inputs["estaciones_fews"], percentil=[0.05, 0.95], var_id=39)
+
+def makeInputs(client : Client, size : int) -> dict:
+    """Synthetic converter inputs of size stations and size series, in the shapes returned by the WHOS and a5 APIs"""
+    catalog = MockCatalog(stations=size, series=size, a5_stations=size, a5_series=size)
+    inputs = {
+        "client": client,
+        "monitoring_points": {"results": catalog.monitoring_points},
+        "timeseries": {"member": catalog.timeseries},
+        "coordinates": [item["shape"]["coordinates"] for item in catalog.monitoring_points],
+        "var_map": {code: {"variableName": name, "unitName": unit} for code, name, unit in catalog.variables},
+        "estaciones": catalog.estaciones,
+        "series": catalog.series
+    }
+    inputs["stations_fews"] = client.monitoringPointsToFEWS(inputs["monitoring_points"])
+    inputs["timeseries_fews"] = client.timeseriesToFEWS(inputs["timeseries"], stations=inputs["stations_fews"])
+    inputs["estaciones_fews"] = a5ToFews.estacionesToFews(inputs["estaciones"])
+    return inputs
+
+def timeBenchmark(function, inputs : dict, repeat : int) -> dict:
+    function(inputs) # warm-up (builds the spatial index, fills caches)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(inputs)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+def getCommit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=fews_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def readHistory(history_file : Path) -> dict:
+    """Last recorded result by (benchmark, size, host)"""
+    last = {}
+    if history_file.exists():
+        with open(history_file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                last[(record["benchmark"], record["size"], record["host"])] = record
+    return last
+
+if __name__ == "__main__":
+    import argparse
+    argparser = argparse.ArgumentParser(description="Microbenchmarks of the FEWS converters")
+    argparser.add_argument("-s","--sizes", help="catalog sizes (stations and series). Default 1000 10000 50000", type=int, nargs="+", default=[1000, 10000, 50000])
+    argparser.add_argument("-b","--benchmarks", help="benchmarks to run. Default all: %s" % " ".join(benchmarks), nargs="+", choices=list(benchmarks), default=list(benchmarks))
+    argparser.add_argument("-r","--repeat", help="timed runs of each benchmark. Default 5", type=int, default=5)
+    argparser.add_argument("-H","--history", help="JSON lines history file. Default bench_history.jsonl", type=str, default="bench_history.jsonl")
+    argparser.add_argument("--no-history", help="don't record the results", action="store_true")
+    argparser.add_argument("-t","--threshold", help="report a regression when the best time exceeds the last recorded one by this factor. Default 1.25", type=float, default=1.25)
+    argparser.add_argument("--fail-on-regression", help="exit with status 1 if a regression is found", action="store_true")
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.ERROR, format="%(asctime)s %(levelname)s %(message)s")
+    history_file = Path(args.history)
+    last = readHistory(history_file)
+    host = socket.gethostname()
+    commit = getCommit()
+    client = Client()
+    records = []
+    regressions = []
+    print("%-22s %8s %12s %12s %10s" % ("benchmark", "size", "best (ms)", "median (ms)", "vs last"))
+    for size in args.sizes:
+        inputs = makeInputs(client, size)
+        for name in args.benchmarks:
+            result = timeBenchmark(benchmarks[name], inputs, args.repeat)
+            record = {
+                "benchmark": name,
+                "size": size,
+                "min": round(result["min"], 6),
+                "median": round(result["median"], 6),
+                "repeat": result["repeat"],
+                "commit": commit,
+                "host": host,
+                "python": sys.version.split()[0],
+                "pandas": pandas.__version__,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+            }
+            records.append(record)
+            previous = last.get((name, size, host))
+            ratio = record["min"] / previous["min"] if previous is not None and previous["min"] > 0 else None
+            if ratio is not None and ratio > args.threshold:
+                regressions.append((name, size, ratio, previous["commit"]))
+            print("%-22s %8i %12.2f %12.2f %10s" % (name, size, record["min"] * 1000, record["median"] * 1000, "%.2fx" % ratio if ratio is not None else "-"))
+    if not args.no_history:
+        with open(history_file, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    for name, size, ratio, previous_commit in regressions:
+        print("regression: %s at size %i is %.2fx slower than at commit %s" % (name, size, ratio, previous_commit), file=sys.stderr)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
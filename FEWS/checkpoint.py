@@ -0,0 +1,69 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+class CheckpointStore:
+    """Completed pages of a paginated harvest, persisted in <output_dir>/checkpoints/<hash of key>/<offset>.json so that an interrupted harvest can be resumed
+
+    Methods
+    -------
+    has(offset)
+        True if the page at offset was completed
+    load(offset)
+        Returns the stored page and the limit it was requested with
+    save(offset, page, limit)
+        Stores a completed page
+    completed()
+        Returns the sorted list of completed offsets
+    clear()
+        Deletes the checkpoint (to be called once the harvest is complete)
+    """
+
+    def __init__(self, output_dir : str, key : dict, resume : bool = False):
+        """
+        Parameters
+        ----------
+        output_dir : str
+            Output directory of the harvest
+        key : dict
+            Parameters identifying the harvest (i.e. view, observedProperty, provider, bbox, page size)
+        resume : bool
+            Keep the pages completed by a previous run of the same harvest. If False, any previous checkpoint is discarded
+        """
+        self.path = Path(output_dir) / "checkpoints" / hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        if not resume and self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / "key.json", "w") as f:
+            json.dump(key, f, default=str)
+        if resume:
+            logging.info("checkpoint %s: resuming with %i completed pages" % (self.path, len(self.completed())))
+
+    def has(self, offset : int) -> bool:
+        return (self.path / ("%i.json" % offset)).exists()
+
+    def load(self, offset : int) -> tuple:
+        """Returns (page, limit): the stored page and the limit it was requested with (None if not recorded)"""
+        with open(self.path / ("%i.json" % offset), "r") as f:
+            stored = json.load(f)
+        if "page" not in stored:
+            # stored without its limit
+            return stored, None
+        return stored["page"], stored["limit"]
+
+    def save(self, offset : int, page : dict, limit : int = None):
+        """Stores the page at offset, requested with limit. A page is only valid for its limit: merged or de-duplicated pages may have more or fewer items"""
+        tmp_path = self.path / ("%i.json.tmp%i" % (offset, threading.get_ident()))
+        with open(tmp_path, "w") as f:
+            json.dump({"limit": limit, "page": page}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path / ("%i.json" % offset))
+
+    def completed(self) -> list:
+        return sorted(int(f.stem) for f in self.path.glob("*.json") if f.stem.isdigit())
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,115 @@
+import json
+import logging
+from pathlib import Path
+from compact import compactFrame
+from lazy_import import lazyImport
+pandas = lazyImport("pandas")
+
+# columnar output formats and their file suffixes
+columnar_formats = {
+    "parquet": ".parquet",
+    "arrow": ".arrow"
+}
+
+def getPyarrow():
+    """Imports pyarrow (optional dependency, only needed for the columnar outputs)"""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Columnar output (parquet, arrow) requires pyarrow. Install it with: pip install pyarrow")
+    return pyarrow
+
+def getColumnarPaths(path : str, formats : list) -> dict:
+    """Returns the output file of each format, adding its suffix to path (i.e. results/locations -> results/locations.parquet, results/timeseries.json -> results/timeseries.json.parquet)"""
+    paths = {}
+    for output_format in formats:
+        if output_format not in columnar_formats:
+            raise Exception("Invalid columnar format %s. Choose from %s" % (output_format, ", ".join(columnar_formats.keys())))
+        paths[output_format] = Path("%s%s" % (path, columnar_formats[output_format]))
+    return paths
+
+def dataFrameToTable(data_frame):
+    """Converts a FEWS table to a pyarrow Table with proper dtypes: repetitive string columns as dictionary arrays, fixed-width numbers (see compact.compactFrame). Object columns of mixed types are stored as strings"""
+    pyarrow = getPyarrow()
+    data_frame = compactFrame(data_frame)
+    arrays = []
+    for column in data_frame.columns:
+        try:
+            arrays.append(pyarrow.array(data_frame[column], from_pandas=True))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            logging.debug("columnar: column %s has mixed types, stored as string" % column)
+            arrays.append(pyarrow.array([None if pandas.isna(v) else str(v) for v in data_frame[column]], type=pyarrow.string()))
+    return pyarrow.Table.from_arrays(arrays, names=[str(column) for column in data_frame.columns])
+
+def recordsToTable(records : list):
+    """Converts raw API records (i.e. monitoring points results, timeseries members) to a pyarrow Table of nested columns. If the records don't share a schema, a single column json holds each record as a JSON string"""
+    pyarrow = getPyarrow()
+    try:
+        return pyarrow.Table.from_struct_array(pyarrow.array(records)) if len(records) else pyarrow.table({})
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError) as e:
+        logging.debug("columnar: records don't share a schema (%s), stored as json strings" % str(e))
+        return pyarrow.table({"json": pyarrow.array([json.dumps(record, ensure_ascii=False) for record in records], type=pyarrow.string())})
+
+def writeTable(table, path : str, formats : list) -> list:
+    """Writes a pyarrow Table in each of formats
+
+    Parquet files are zstd compressed. Arrow IPC files are left uncompressed so that readColumnar can memory-map them without copying
+
+    Parameters
+    ----------
+    table : pyarrow.Table
+    path : str
+        Output path, the format suffix is appended to it (i.e. results/locations, results/timeseries.json)
+    formats : list
+        Formats to write (parquet, arrow)
+
+    Returns
+    -------
+    list
+        Written files
+    """
+    pyarrow = getPyarrow()
+    paths = getColumnarPaths(path, formats)
+    for output_format, output in paths.items():
+        if output_format == "parquet":
+            pyarrow.parquet.write_table(table, output, compression="zstd")
+        else:
+            with pyarrow.OSFile(str(output), "wb") as sink, pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    return list(paths.values())
+
+def writeColumnar(data_frame, path : str, formats : list) -> list:
+    """Writes a FEWS table (DataFrame) in each of formats (parquet, arrow), see writeTable"""
+    if not len(formats):
+        return []
+    return writeTable(dataFrameToTable(data_frame), path, formats)
+
+def writeColumnarRecords(records : list, path : str, formats : list) -> list:
+    """Writes raw API records in each of formats (parquet, arrow), see writeTable"""
+    if not len(formats):
+        return []
+    return writeTable(recordsToTable(records), path, formats)
+
+def isColumnarMissing(path : str, formats : list) -> bool:
+    """True if any of the outputs of formats is missing"""
+    return any(not output.exists() for output in getColumnarPaths(path, formats).values())
+
+def readColumnar(path : str):
+    """Reads a columnar output. Arrow IPC files are memory-mapped
+
+    Parameters
+    ----------
+    path : str
+        .parquet or .arrow file
+
+    Returns
+    -------
+    pyarrow.Table
+        Use .to_pandas() for a DataFrame
+    """
+    pyarrow = getPyarrow()
+    if str(path).endswith(columnar_formats["arrow"]):
+        return pyarrow.ipc.open_file(pyarrow.memory_map(str(path), "r")).read_all()
+    return pyarrow.parquet.read_table(path, memory_map=True)
@@ -0,0 +1,62 @@
+import sys
+from lazy_import import lazyImport
+pandas = lazyImport("pandas")
+
+# repetitive string columns of the FEWS metadata tables
+categorical_columns = ["IMPORT_SOURCE", "UNIT", "COUNTRY", "ORGANIZATION", "SUBBASIN", "EXTERNAL_PARAMETER_ID", "TYPE"]
+
+# identifier columns, repeated across the stations and time series tables
+id_columns = ["STATION_ID", "EXTERNAL_LOCATION_ID", "PARENT_ID", "CHILD_ID", "ORIGINAL_STATION_ID"]
+
+def compactFrame(data_frame, categorical : list = None, ids : list = None):
+    """Returns a memory-compact version of a FEWS metadata table whose CSV output is byte-identical
+
+    Repetitive string columns become categoricals, identifier strings are interned (shared between tables, i.e. STATION_ID of stations and time series) and numeric columns get fixed-width dtypes: integers are downcast, object columns of floats or booleans without missing values become float64 / bool. Floats are never downcast (float32 would change the CSV digits)
+
+    Parameters
+    ----------
+    data_frame : DataFrame
+        i.e. result of monitoringPointsToFEWS, timeseriesToFEWS or seriesToFews
+    categorical : list
+        Columns to convert to categoricals. Defaults to categorical_columns
+    ids : list
+        Columns of identifiers to intern. Defaults to id_columns
+
+    Returns
+    -------
+    DataFrame
+    """
+    categorical = categorical if categorical is not None else categorical_columns
+    ids = ids if ids is not None else id_columns
+    columns = {}
+    for column in data_frame.columns:
+        series = data_frame[column]
+        if column in categorical and isText(series):
+            columns[column] = series.astype("category")
+        elif column in ids and (series.dtype == object or getattr(series.dtype, "storage", None) == "python"):
+            # pyarrow backed string columns are stored compactly already
+            columns[column] = pandas.Series([sys.intern(v) if type(v) is str else v for v in series], index=series.index, dtype=series.dtype, name=column)
+        else:
+            columns[column] = fixedWidth(series)
+    return pandas.DataFrame(columns, index=data_frame.index)
+
+def isText(series) -> bool:
+    """True for object or string dtype columns"""
+    return series.dtype == object or (pandas.api.types.is_string_dtype(series.dtype) and not isinstance(series.dtype, pandas.CategoricalDtype))
+
+def fixedWidth(series):
+    """Fixed-width dtype for a numeric or boolean column, if its CSV output stays the same. Other columns are returned as they are"""
+    if pandas.api.types.is_integer_dtype(series.dtype) and not isinstance(series.dtype, pandas.CategoricalDtype):
+        return pandas.to_numeric(series, downcast="integer")
+    if series.dtype != object:
+        return series
+    values = series.dropna()
+    if not len(values):
+        return series
+    types = set(type(v) for v in values)
+    if types == {float}:
+        # missing values are written as empty fields either way
+        return series.astype("float64")
+    if types == {bool} and len(values) == len(series):
+        return series.astype(bool)
+    return series
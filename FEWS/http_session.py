@@ -0,0 +1,102 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import threading
+import logging
+from rate_limiter import getGovernor
+
+default_config = {
+    "timeout": 120,
+    "pool_maxsize": 10,
+    "retries": 5,
+    "backoff_factor": 0.5,
+    "backoff_jitter": 0.5,
+    "retry_status": [429, 500, 502, 503, 504],
+    "rate_limits": None
+}
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+class GovernedRetry(Retry):
+    """Retry policy that slows down the host governor on throttling responses and waits for a governor token before each retry"""
+
+    governor = None
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.governor = self.governor
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if self.governor is not None and response is not None:
+            retry_after = self.get_retry_after(response)
+            if response.status == 429 or (response.status == 503 and retry_after is not None):
+                self.governor.throttle(retry_after)
+        return super().increment(method=method, url=url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.governor is not None:
+            self.governor.wait()
+
+class GovernedAdapter(HTTPAdapter):
+    """HTTPAdapter that sends requests through the host governor (rate limit and maximum in-flight requests)"""
+
+    def __init__(self, governor, **kwargs):
+        self.governor = governor
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.governor.acquire()
+        status_code = None
+        try:
+            response = super().send(request, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            self.governor.release(status_code)
+
+def getSession(url : str, config : dict = None) -> requests.Session:
+    """Returns the shared HTTP session for the host of url
+
+    Sessions are created once per host and retry policy and reused across clients and threads, so that connections are kept alive in a per-host pool. If rate_limits has an entry for the host, requests go through the process-wide governor of the host (token bucket rate limit, maximum in-flight requests, slow down on 429 / Retry-After). Idempotent requests are retried with exponential backoff and jitter on connection errors and on the status codes in retry_status (honoring Retry-After)
+
+    Parameters
+    ----------
+    url : str
+        Any url of the target host
+    config : dict
+        Transport parameters: pool_maxsize, retries, backoff_factor, backoff_jitter, retry_status, rate_limits (by host, see rate_limiter.getGovernor). Missing keys take the values of default_config
+
+    Returns
+    -------
+    requests.Session
+    """
+    config = {key: config[key] if config is not None and key in config else default_config[key] for key in default_config}
+    parts = urlsplit(url)
+    prefix = "%s://%s/" % (parts.scheme, parts.netloc)
+    governor = getGovernor(url, config["rate_limits"])
+    key = (prefix, config["pool_maxsize"], config["retries"], config["backoff_factor"], config["backoff_jitter"], tuple(config["retry_status"]), id(governor))
+    with sessions_lock:
+        if key not in sessions:
+            logging.debug("new session for %s" % prefix)
+            retry = GovernedRetry(
+                total = config["retries"],
+                backoff_factor = config["backoff_factor"],
+                backoff_jitter = config["backoff_jitter"],
+                status_forcelist = config["retry_status"],
+                allowed_methods = ["GET", "HEAD"],
+                respect_retry_after_header = True,
+                raise_on_status = False)
+            retry.governor = governor
+            if governor is not None:
+                adapter = GovernedAdapter(governor, pool_connections = 1, pool_maxsize = config["pool_maxsize"], max_retries = retry)
+            else:
+                adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = config["pool_maxsize"], max_retries = retry)
+            session = requests.Session()
+            session.mount(prefix, adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            sessions[key] = session
+        return sessions[key]
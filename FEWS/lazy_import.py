@@ -0,0 +1,37 @@
+import sys
+import types
+import importlib
+import threading
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on first attribute access
+
+    The import goes through importlib.import_module, so concurrent first uses from several threads wait on the import lock of the module instead of seeing it half-initialized. Once imported, the attributes of the module are copied into the stand-in, so later lookups cost the same as on the module itself
+    """
+
+    def __init__(self, name : str):
+        super().__init__(name)
+        self.__dict__["__lazy_lock__"] = threading.Lock()
+
+    def __getattr__(self, attribute : str):
+        # only called for attributes not yet copied from the module
+        with self.__dict__["__lazy_lock__"]:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+def lazyImport(name : str) -> types.ModuleType:
+    """Returns module name if already imported, else a LazyModule that imports it on first use
+
+    Parameters
+    ----------
+    name : str
+        Module name (i.e. pandas, lxml.etree)
+
+    Returns
+    -------
+    module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
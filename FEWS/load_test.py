@@ -0,0 +1,110 @@
+"""End-to-end load test of the harvest flows against the local mock server (mock_server.py)
+
+Runs `whos_client.py all` (makeFewsTables) and the a5ToFews main flow as subprocesses in a scratch directory and reports wall time, requests per second and peak RSS of each
+
+Usage:
+    python load_test.py --stations 10000 --series 40000 --latency 0.05 --max_workers 4 --report load_test.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+from pathlib import Path
+from mock_server import MockCatalog, MockServer
+
+fews_dir = Path(__file__).resolve().parent
+
+def runFlow(name : str, command : list, cwd : Path, server : MockServer) -> dict:
+    """Runs command in cwd and returns its wall time, peak RSS and the requests it sent to server"""
+    requests_before = server.stats()["requests"]
+    bytes_before = server.stats()["bytes"]
+    start = time.monotonic()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    stats = server.stats()
+    requests = stats["requests"] - requests_before
+    result = {
+        "flow": name,
+        "exit_code": process.returncode,
+        "wall_time": round(wall_time, 3),
+        "requests": requests,
+        "requests_per_second": round(requests / wall_time, 2) if wall_time > 0 else None,
+        "bytes": stats["bytes"] - bytes_before,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1)
+    }
+    if process.returncode != 0:
+        logging.error("%s failed with exit code %i: %s" % (name, process.returncode, stderr.decode(errors="replace")[-2000:]))
+    return result
+
+def makeWorkDir(server : MockServer, config : dict) -> Path:
+    """Scratch directory with the layout the scripts expect: config.json, cuencas/, log/ and results/"""
+    work_dir = Path(tempfile.mkdtemp(prefix="whos_load_test_"))
+    os.symlink(fews_dir / "cuencas", work_dir / "cuencas")
+    (work_dir / "log").mkdir()
+    (work_dir / "results").mkdir()
+    with open(fews_dir / "config.json") as f:
+        whos_config = json.load(f)
+    whos_config.update({"url": server.url, "token": "mock"})
+    if "rate_limits" in whos_config:
+        del whos_config["rate_limits"]
+    whos_config.update(config)
+    with open(work_dir / "config.json", "w") as f:
+        json.dump(whos_config, f, indent=2)
+    return work_dir
+
+if __name__ == "__main__":
+    import argparse
+    argparser = argparse.ArgumentParser(description="End-to-end load test of makeFewsTables and a5ToFews against the local mock server")
+    argparser.add_argument("-s","--stations", help="number of WHOS monitoring points. Default 3000", type=int, default=3000)
+    argparser.add_argument("-S","--series", help="number of WHOS timeseries. Default 12000", type=int, default=12000)
+    argparser.add_argument("--a5_stations", help="number of a5 stations. Default 300", type=int, default=300)
+    argparser.add_argument("--a5_series", help="number of a5 series. Default 1200", type=int, default=1200)
+    argparser.add_argument("-l","--latency", help="mock response delay in seconds. Default 0.05", type=float, default=0.05)
+    argparser.add_argument("--latency_per_item", help="additional mock delay in seconds per returned item. Default 0", type=float, default=0)
+    argparser.add_argument("-e","--error_rate", help="fraction of mock requests answered with 503. Default 0", type=float, default=0)
+    argparser.add_argument("--throttle_rate", help="fraction of mock requests answered with 429. Default 0", type=float, default=0)
+    argparser.add_argument("-w","--max_workers", help="whos_client max_workers", type=int)
+    argparser.add_argument("-f","--flows", help="flows to run: whos a5. Default both", nargs="+", default=["whos", "a5"])
+    argparser.add_argument("-r","--report", help="append the results to this JSON lines file", type=str)
+    argparser.add_argument("-k","--keep", help="keep the scratch directory", action="store_true")
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    catalog = MockCatalog(stations=args.stations, series=args.series, a5_stations=args.a5_stations, a5_series=args.a5_series)
+    server = MockServer(catalog, latency=args.latency, latency_per_item=args.latency_per_item, error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    server.start()
+    config = {"monitoring_points_max": args.stations + 1000, "timeseries_max": args.series + 1000}
+    if args.max_workers is not None:
+        config["max_workers"] = args.max_workers
+    work_dir = makeWorkDir(server, config)
+    logging.info("mock server at %s, scratch directory %s" % (server.url, work_dir))
+    results = []
+    if "whos" in args.flows:
+        results.append(runFlow("whos makeFewsTables", [sys.executable, str(fews_dir / "whos_client.py"), "all", "-O", "results"], work_dir, server))
+    if "a5" in args.flows:
+        results.append(runFlow("a5ToFews", [sys.executable, str(fews_dir / "a5ToFews.py"), "--url", "%s/a5" % server.url], work_dir, server))
+    server.shutdown()
+    run = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": vars(args),
+        "results": results
+    }
+    print("%-22s %6s %10s %10s %8s %12s" % ("flow", "exit", "wall (s)", "requests", "req/s", "peak RSS MB"))
+    for result in results:
+        print("%-22s %6i %10.2f %10i %8.1f %12.1f" % (result["flow"], result["exit_code"], result["wall_time"], result["requests"], result["requests_per_second"] or 0, result["peak_rss_mb"]))
+    if args.report is not None:
+        with open(args.report, "a") as f:
+            f.write(json.dumps(run) + "\n")
+    if args.keep:
+        logging.info("outputs kept in %s" % work_dir)
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if any(result["exit_code"] != 0 for result in results):
+        sys.exit(1)
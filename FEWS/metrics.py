@@ -0,0 +1,217 @@
+import json
+import time
+import threading
+import contextlib
+import functools
+from bisect import bisect_left
+
+# request latency histogram upper bounds (seconds)
+default_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+class Metrics:
+    """Request and stage metrics of a harvest run: request counts by endpoint and status, bytes, retries, cache hits, latency histograms by endpoint and cumulative stage timings. Exported as a JSON run report or in Prometheus text format
+
+    Stage timings are cumulative wall times. Stages may nest (i.e. subbasin within convert_stations) or run concurrently (pipelined harvest): the parent stage includes the time of its nested stages
+
+    Methods
+    -------
+    observeRequest(endpoint, status, latency, size, retries)
+        Records a request sent to endpoint
+    observeCacheHit(endpoint)
+        Records a request answered by the response cache
+    stage(name)
+        Context manager timing a stage
+    addStage(name, seconds)
+        Adds seconds to the timing of stage name
+    report()
+        Returns the metrics as a dict
+    writeReport(output)
+        Writes the JSON run report
+    toPrometheus()
+        Returns the metrics in Prometheus text exposition format
+    writePrometheus(output)
+        Writes the Prometheus text format (i.e. for the node exporter textfile collector)
+    """
+
+    def __init__(self, namespace : str, buckets : list = None):
+        """
+        Parameters
+        ----------
+        namespace : str
+            Metric name prefix (i.e. whos, a5)
+        buckets : list
+            Latency histogram upper bounds in seconds. Defaults to default_buckets
+        """
+        self.namespace = namespace
+        self.buckets = buckets if buckets is not None else default_buckets
+        self.started = time.time()
+        self.requests = {}
+        self.endpoints = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def getEndpoint(self, endpoint : str) -> dict:
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                "bytes": 0,
+                "retries": 0,
+                "cache_hits": 0,
+                "latency_sum": 0.0,
+                "latency_count": 0,
+                "latency_max": 0.0,
+                "latency_buckets": [0] * (len(self.buckets) + 1)
+            }
+        return self.endpoints[endpoint]
+
+    def observeRequest(self, endpoint : str, status, latency : float, size : int = 0, retries : int = 0):
+        """Records a request
+
+        Parameters
+        ----------
+        endpoint : str
+            Endpoint name (i.e. monitoring-points, timeseries, series)
+        status : int or str
+            Final status code, or "error" if the request failed without response
+        latency : float
+            Request duration in seconds, retries included
+        size : int
+            Response body size in bytes
+        retries : int
+            Number of retries
+        """
+        with self.lock:
+            key = (endpoint, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            e = self.getEndpoint(endpoint)
+            e["bytes"] += size or 0
+            e["retries"] += retries
+            e["latency_sum"] += latency
+            e["latency_count"] += 1
+            e["latency_max"] = max(e["latency_max"], latency)
+            e["latency_buckets"][bisect_left(self.buckets, latency)] += 1
+
+    def observeCacheHit(self, endpoint : str):
+        with self.lock:
+            self.getEndpoint(endpoint)["cache_hits"] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name : str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addStage(name, time.perf_counter() - start)
+
+    def addStage(self, name : str, seconds : float):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "count": 0})
+            stage["seconds"] += seconds
+            stage["count"] += 1
+
+    def report(self) -> dict:
+        """Returns the metrics as a dict: elapsed, requests (by endpoint and status), endpoints (bytes, retries, cache_hits, latency histogram and summary) and stages (seconds, count)"""
+        with self.lock:
+            endpoints = {}
+            for endpoint, e in self.endpoints.items():
+                endpoints[endpoint] = {
+                    "requests": sum(count for (name, status), count in self.requests.items() if name == endpoint),
+                    "bytes": e["bytes"],
+                    "retries": e["retries"],
+                    "cache_hits": e["cache_hits"],
+                    "latency": {
+                        "sum": round(e["latency_sum"], 6),
+                        "count": e["latency_count"],
+                        "mean": round(e["latency_sum"] / e["latency_count"], 6) if e["latency_count"] else None,
+                        "max": round(e["latency_max"], 6),
+                        "buckets": {formatBound(le): count for le, count in zip(self.buckets + [None], e["latency_buckets"])}
+                    }
+                }
+            return {
+                "namespace": self.namespace,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "elapsed": round(time.time() - self.started, 3),
+                "requests": {"%s %s" % key: count for key, count in sorted(self.requests.items())},
+                "endpoints": endpoints,
+                "stages": {name: {"seconds": round(stage["seconds"], 6), "count": stage["count"]} for name, stage in self.stages.items()}
+            }
+
+    def writeReport(self, output : str):
+        f = open(output, "w")
+        f.write(json.dumps(self.report(), indent=2))
+        f.close()
+
+    def toPrometheus(self) -> str:
+        """Returns the metrics in Prometheus text exposition format"""
+        ns = self.namespace
+        lines = []
+        def family(name, kind, help):
+            lines.append("# HELP %s_%s %s" % (ns, name, help))
+            lines.append("# TYPE %s_%s %s" % (ns, name, kind))
+        with self.lock:
+            family("requests_total", "counter", "Requests by endpoint and final status")
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append('%s_requests_total{endpoint="%s",status="%s"} %i' % (ns, endpoint, status, count))
+            family("response_bytes_total", "counter", "Response body bytes by endpoint")
+            for endpoint, e in sorted(self.endpoints.items()):
+                lines.append('%s_response_bytes_total{endpoint="%s"} %i' % (ns, endpoint, e["bytes"]))
+            family("request_retries_total", "counter", "Retries by endpoint")
+            for endpoint, e in sorted(self.endpoints.items()):
+                lines.append('%s_request_retries_total{endpoint="%s"} %i' % (ns, endpoint, e["retries"]))
+            family("cache_hits_total", "counter", "Requests answered by the response cache by endpoint")
+            for endpoint, e in sorted(self.endpoints.items()):
+                lines.append('%s_cache_hits_total{endpoint="%s"} %i' % (ns, endpoint, e["cache_hits"]))
+            family("request_duration_seconds", "histogram", "Request duration by endpoint, retries included")
+            for endpoint, e in sorted(self.endpoints.items()):
+                cumulative = 0
+                for le, count in zip(self.buckets + [None], e["latency_buckets"]):
+                    cumulative += count
+                    lines.append('%s_request_duration_seconds_bucket{endpoint="%s",le="%s"} %i' % (ns, endpoint, formatBound(le), cumulative))
+                lines.append('%s_request_duration_seconds_sum{endpoint="%s"} %f' % (ns, endpoint, e["latency_sum"]))
+                lines.append('%s_request_duration_seconds_count{endpoint="%s"} %i' % (ns, endpoint, e["latency_count"]))
+            family("stage_seconds_total", "counter", "Cumulative wall time by stage")
+            for name, stage in sorted(self.stages.items()):
+                lines.append('%s_stage_seconds_total{stage="%s"} %f' % (ns, name, stage["seconds"]))
+            family("stage_runs_total", "counter", "Runs by stage")
+            for name, stage in sorted(self.stages.items()):
+                lines.append('%s_stage_runs_total{stage="%s"} %i' % (ns, name, stage["count"]))
+            family("run_elapsed_seconds", "gauge", "Elapsed time since the start of the run")
+            lines.append("%s_run_elapsed_seconds %f" % (ns, time.time() - self.started))
+        return "\n".join(lines) + "\n"
+
+    def writePrometheus(self, output : str):
+        f = open(output, "w")
+        f.write(self.toPrometheus())
+        f.close()
+
+def writeMetrics(metrics : Metrics, report : str = None, prometheus : str = None):
+    """Writes the JSON run report and / or the Prometheus text format of metrics"""
+    if report is not None:
+        metrics.writeReport(report)
+    if prometheus is not None:
+        metrics.writePrometheus(prometheus)
+
+def formatBound(le : float) -> str:
+    return "%g" % le if le is not None else "+Inf"
+
+def stage(metrics : Metrics, name : str):
+    """metrics.stage(name), or a no-op context if metrics is None"""
+    return metrics.stage(name) if metrics is not None else contextlib.nullcontext()
+
+def timed(name : str):
+    """Method decorator timing each call as stage name of self.metrics"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with stage(getattr(self, "metrics", None), name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def getEndpointName(url : str) -> str:
+    """Last path segment of url (i.e. monitoring-points, timeseries, cuahsi_1_1.asmx, series)"""
+    return url.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+
+def getRetries(response) -> int:
+    """Number of retries urllib3 made for a requests.Response"""
+    retries = getattr(response.raw, "retries", None)
+    return len(retries.history) if retries is not None else 0
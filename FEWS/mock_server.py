@@ -0,0 +1,343 @@
+"""Local stand-in for the WHOS and a5 APIs, for load tests and offline benchmarks (see load_test.py)
+
+Serves synthetic catalogs generated from the sample tables under results/:
+- WHOS timeseries API: /gs-service/services/essi/token/<token>/view/<view>/timeseries-api/monitoring-points and .../timeseries
+- WHOS CUAHSI API: /gs-service/services/essi/token/<token>/view/<view>/cuahsi_1_1.asmx?request=GetVariables
+- a5 API: /a5/obs/puntual/estaciones, /a5/obs/puntual/series, /a5/obs/puntual/observaciones, /a5/obs/variables
+
+Usage:
+    python mock_server.py --port 8080 --stations 10000 --series 40000 --latency 0.2 --error_rate 0.01
+"""
+import re
+import json
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from pathlib import Path
+import pandas
+
+results_dir = Path(__file__).parent / "results"
+
+whos_variable_names = [("Precipitation", "millimetre"), ("Level", "metre"), ("Flux, discharge", "cubic metres per second")]
+
+whos_organizations = {
+    "INMET": "INMET",
+    "INA": "Instituto Nacional del Agua (INA)",
+    "SAR - Agência Nacional de Águas (ANA)": "SAR - Agência Nacional de Águas (ANA)",
+    "WHOS": None
+}
+
+a5_variables = {
+    1: {"nombre": "precipitación diaria", "VariableName": "Precipitation", "timeSupport": {"days": 1}, "abrev": "mm/d"},
+    31: {"nombre": "precipitación horaria", "VariableName": "Precipitation", "timeSupport": {"hours": 1}, "abrev": "mm"},
+    34: {"nombre": "precipitación 3 horaria", "VariableName": "Precipitation", "timeSupport": {"hours": 3}, "abrev": "mm"},
+    39: {"nombre": "altura hidrométrica diaria", "VariableName": "Gage height", "timeSupport": {"days": 1}, "abrev": "m"},
+    85: {"nombre": "altura hidrométrica horaria", "VariableName": "Gage height", "timeSupport": {"hours": 1}, "abrev": "m"},
+    101: {"nombre": "altura hidrométrica 4 horaria", "VariableName": "Gage height", "timeSupport": {"hours": 4}, "abrev": "m"},
+    40: {"nombre": "caudal diario", "VariableName": "Discharge", "timeSupport": {"days": 1}, "abrev": "m^3/s"}
+}
+
+class MockCatalog:
+    """Synthetic WHOS and a5 catalogs. Station names, coordinates, countries and organizations are taken from the sample tables in results/ (repeated with jittered coordinates beyond their size)"""
+
+    def __init__(self, stations : int = 3000, series : int = 12000, a5_stations : int = 300, a5_series : int = 1200, observed_properties : list = None, seed : int = 0):
+        """
+        Parameters
+        ----------
+        stations : int
+            Number of WHOS monitoring points
+        series : int
+            Number of WHOS timeseries
+        a5_stations : int
+            Number of a5 stations
+        a5_series : int
+            Number of a5 series
+        observed_properties : list
+            WHOS observed property codes. Defaults to fews_observed_properties of config.json
+        seed : int
+            Random seed
+        """
+        random_ = random.Random(seed)
+        if observed_properties is None:
+            with open(Path(__file__).parent / "config.json") as f:
+                observed_properties = json.load(f)["fews_observed_properties"]
+        self.variables = [(code,) + whos_variable_names[i % len(whos_variable_names)] for i, code in enumerate(observed_properties)]
+        now = datetime.now(timezone.utc)
+        # WHOS
+        sample = self.readSample("locations.csv")
+        self.monitoring_points = []
+        for i in range(stations):
+            row = sample[i % len(sample)]
+            jitter = 0 if i < len(sample) else 0.01
+            organization = whos_organizations[row["ORGANIZATION"]] if row["ORGANIZATION"] in whos_organizations else None
+            longitude = float(row["LONGITUDE"]) + random_.uniform(-jitter, jitter)
+            latitude = float(row["LATITUDE"]) + random_.uniform(-jitter, jitter)
+            self.monitoring_points.append({
+                "id": "%040X" % random_.getrandbits(160),
+                "name": "%s%s" % (row["STATION_NAME"], "" if i < len(sample) else " %i" % (i // len(sample))),
+                "shape": {"type": "Point", "coordinates": [longitude, latitude]},
+                "parameter": [{"name": "country", "value": row["COUNTRY"]}, {"name": "identifier", "value": "urn:mock:%s:%i" % (row["STATION_ID"], i)}],
+                "relatedParty": [{"organisationName": organization}] if organization is not None else []
+            })
+        self.timeseries = []
+        ends = [(now - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ") for days in [0, 1, 2, 30, 400]]
+        for i in range(series):
+            point = self.monitoring_points[i % stations]
+            code, name, unit = self.variables[random_.randrange(len(self.variables))]
+            end = random_.choice(ends)
+            duration = random_.choice(["P1D", "PT1H", "PT3H", "P1M"])
+            self.timeseries.append({
+                "id": "%040X" % random_.getrandbits(160),
+                "featureOfInterest": {"href": point["id"]},
+                "observedProperty": {"href": code, "title": name},
+                "phenomenonTime": {"begin": "2000-01-01T00:00:00Z", "end": end},
+                "result": {"defaultPointMetadata": {"uom": unit, "aggregationDuration": duration}} if i % 5 else {"defaultPointMetadata": {"uom": unit}, "metadata": {"intendedObservationSpacing": duration}}
+            })
+        self.timeseries_by_property = {}
+        for item in self.timeseries:
+            self.timeseries_by_property.setdefault(item["observedProperty"]["href"], []).append(item)
+        # a5
+        sample = self.readSample("INA_locations.csv")
+        self.estaciones = []
+        for i in range(a5_stations):
+            row = sample[i % len(sample)]
+            jitter = 0 if i < len(sample) else 0.01
+            self.estaciones.append({
+                "id": i + 1,
+                "nombre": row["STATION_NAME"],
+                "abreviatura": row["STATION_SHORTNAME"] if len(row["STATION_SHORTNAME"]) else None,
+                "propietario": random_.choice(["INA", "PNA", None]),
+                "geom": {"type": "Point", "coordinates": [float(row["LONGITUDE"]) + random_.uniform(-jitter, jitter), float(row["LATITUDE"]) + random_.uniform(-jitter, jitter)]},
+                "altitud": None,
+                "automatica": row["TYPE"] == "Automatic",
+                "pais": "Argentina",
+                "nivel_aguas_bajas": 0.5,
+                "nivel_alerta": 3.0,
+                "nivel_evacuacion": 4.5
+            })
+        var_ids = list(a5_variables.keys())
+        self.series = []
+        for i in range(a5_series):
+            estacion = self.estaciones[i % a5_stations]
+            var_id = var_ids[(i // a5_stations + i) % len(var_ids)]
+            variable = a5_variables[var_id]
+            self.series.append({
+                "id": i + 1,
+                "estacion": {key: estacion[key] for key in ["id", "nombre", "geom", "nivel_aguas_bajas", "nivel_alerta", "nivel_evacuacion"]},
+                "var": {"id": var_id, "nombre": variable["nombre"], "VariableName": variable["VariableName"], "timeSupport": variable["timeSupport"]},
+                "procedimiento": {"id": 1 + i % 2},
+                "unidades": {"abrev": variable["abrev"]},
+                "date_range": {"timestart": "2000-01-01T03:00:00.000Z", "timeend": (now - timedelta(days=random_.choice([0, 1, 10]))).strftime("%Y-%m-%dT%H:%M:%S.000Z"), "count": random_.randrange(100, 10000)},
+                "percentiles": [{"percentile": p, "valor": round(random_.uniform(0, 10) * (1 + p), 3)} for p in [0.05, 0.5, 0.95]],
+                "monthlyStats": [{"mon": m, "mean": 1.0 + m, "p01": 0.1, "p10": 0.5, "p50": 1.0 + m, "p90": 2.0 + m, "p99": 3.0 + m} for m in range(12)]
+            })
+
+    def readSample(self, filename : str) -> list:
+        """Reads a sample locations table of results/ as a list of rows, keeping the rows with coordinates"""
+        sample = pandas.read_csv(results_dir / filename, keep_default_na=False, dtype=str)
+        for column in ["LONGITUDE", "LATITUDE"]:
+            sample[column] = pandas.to_numeric(sample[column], errors="coerce")
+        return sample.dropna(subset=["LONGITUDE", "LATITUDE"]).to_dict("records")
+
+    def getMonitoringPoints(self, query : dict) -> dict:
+        items = self.monitoring_points
+        if "west" in query:
+            west, south, east, north = [float(query[key]) for key in ["west", "south", "east", "north"]]
+            items = [x for x in items if west <= x["shape"]["coordinates"][0] <= east and south <= x["shape"]["coordinates"][1] <= north]
+        if "country" in query:
+            items = [x for x in items if x["parameter"][0]["value"][0:3].upper() == query["country"][0:3].upper()]
+        return self.page(items, query, "results")
+
+    def getTimeseries(self, query : dict) -> dict:
+        items = self.timeseries_by_property.get(query["observedProperty"], []) if "observedProperty" in query else self.timeseries
+        if "monitoringPoint" in query:
+            items = [x for x in items if x["featureOfInterest"]["href"] == query["monitoringPoint"]]
+        if "beginPosition" in query:
+            items = [x for x in items if x["phenomenonTime"]["end"] >= query["beginPosition"]]
+        return self.page(items, query, "member")
+
+    def page(self, items : list, query : dict, key : str) -> dict:
+        offset = int(query["offset"]) if "offset" in query else 1
+        limit = int(query["limit"]) if "limit" in query else 10
+        items = items[offset - 1:offset - 1 + limit]
+        return {key: items} if len(items) else {}
+
+    def getVariablesXml(self) -> str:
+        variables = "".join("<variable><variableCode vocabulary=\"WHOS\">%s</variableCode><variableName>%s</variableName><unit><unitName>%s</unitName></unit></variable>" % v for v in self.variables)
+        response = "<variablesResponse xmlns=\"http://www.cuahsi.org/waterML/1.1/\"><variables>%s</variables></variablesResponse>" % variables
+        return '<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body><GetVariablesResponse xmlns="http://www.cuahsi.org/his/1.1/ws/"><GetVariablesResult>%s</GetVariablesResult></GetVariablesResponse></soap:Body></soap:Envelope>' % response.replace("<", "&lt;").replace(">", "&gt;")
+
+    def getEstaciones(self, query : dict) -> list:
+        items = self.estaciones
+        if "geom" in query:
+            west, south, east, north = [float(x) for x in query["geom"].split(",")]
+            items = [x for x in items if west <= x["geom"]["coordinates"][0] <= east and south <= x["geom"]["coordinates"][1] <= north]
+        return items
+
+    def getSeries(self, query : dict) -> dict:
+        items = self.series
+        for param, get in [("estacion_id", lambda x: x["estacion"]["id"]), ("var_id", lambda x: x["var"]["id"]), ("proc_id", lambda x: x["procedimiento"]["id"]), ("id", lambda x: x["id"])]:
+            if param in query:
+                ids = set(int(i) for i in query[param].split(","))
+                items = [x for x in items if get(x) in ids]
+        if query.get("getPercentiles") != "True":
+            items = [{key: x[key] for key in x if key != "percentiles"} for x in items]
+        if query.get("getMonthlyStats") != "True":
+            items = [{key: x[key] for key in x if key != "monthlyStats"} for x in items]
+        return {"rows": items}
+
+    def getObservaciones(self, query : dict) -> list:
+        timestart = datetime.fromisoformat(query["timestart"][0:19])
+        timeend = datetime.fromisoformat(query["timeend"][0:19])
+        obs = []
+        t = timestart
+        while t <= timeend and len(obs) < 10000:
+            obs.append({"series_id": int(query["series_id"]), "timestart": t.isoformat() + "Z", "timeend": t.isoformat() + "Z", "valor": round(1 + (t.hour + t.day) % 10 * 0.1, 2)})
+            t = t + timedelta(days=1)
+        return obs
+
+    def getVariables(self, query : dict) -> list:
+        ids = set(int(i) for i in query["id"].split(",")) if "id" in query else set(a5_variables.keys())
+        return [{"id": var_id, "nombre": v["nombre"], "VariableName": v["VariableName"], "timeSupport": v["timeSupport"]} for var_id, v in a5_variables.items() if var_id in ids]
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Routes requests to the server catalog, applying its latency and error injection"""
+
+    whos_path = re.compile(r"^/gs-service/services/essi/token/[^/]+/view/[^/]+/(timeseries-api/monitoring-points|timeseries-api/timeseries|cuahsi_1_1\.asmx)$")
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        server.count(parts.path)
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self.send(503, b"injected error", "text/plain")
+        if server.throttle_rate and server.random.random() < server.throttle_rate:
+            return self.send(429, b"injected throttling", "text/plain", {"Retry-After": "1"})
+        catalog = server.catalog
+        match = self.whos_path.match(parts.path)
+        if match is not None and match.group(1) == "timeseries-api/monitoring-points":
+            body = catalog.getMonitoringPoints(query)
+            items = len(body["results"]) if "results" in body else 0
+        elif match is not None and match.group(1) == "timeseries-api/timeseries":
+            body = catalog.getTimeseries(query)
+            items = len(body["member"]) if "member" in body else 0
+        elif match is not None:
+            return self.send(200, catalog.getVariablesXml().encode(), "text/xml; charset=utf-8")
+        elif parts.path == "/a5/obs/puntual/estaciones":
+            body = catalog.getEstaciones(query)
+            items = len(body)
+        elif parts.path == "/a5/obs/puntual/series":
+            body = catalog.getSeries(query)
+            items = len(body["rows"])
+        elif parts.path == "/a5/obs/puntual/observaciones":
+            body = catalog.getObservaciones(query)
+            items = len(body)
+        elif parts.path == "/a5/obs/variables":
+            body = catalog.getVariables(query)
+            items = len(body)
+        else:
+            return self.send(404, b"not found", "text/plain")
+        time.sleep(server.latency + server.latency_per_item * items)
+        self.send(200, json.dumps(body, ensure_ascii=False).encode(), "application/json")
+
+    def send(self, status : int, content : bytes, content_type : str, headers : dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+        self.server.count_bytes(len(content))
+
+class MockServer(ThreadingHTTPServer):
+    """Threaded HTTP server for a MockCatalog. Keeps request counts by path
+
+    Methods
+    -------
+    start()
+        Serves in a background thread
+    stats()
+        Returns the request and byte counts
+    """
+
+    daemon_threads = True
+
+    def __init__(self, catalog : MockCatalog, port : int = 0, latency : float = 0, latency_per_item : float = 0, error_rate : float = 0, throttle_rate : float = 0, seed : int = 0):
+        """
+        Parameters
+        ----------
+        catalog : MockCatalog
+        port : int
+            Listening port (on 127.0.0.1). 0 picks a free port
+        latency : float
+            Response delay in seconds
+        latency_per_item : float
+            Additional delay in seconds per returned item
+        error_rate : float
+            Fraction of requests answered with 503
+        throttle_rate : float
+            Fraction of requests answered with 429 and Retry-After: 1
+        seed : int
+            Random seed of the error injection
+        """
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.latency_per_item = latency_per_item
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%i" % self.server_address[1]
+
+    def count(self, path : str):
+        endpoint = path.rsplit("/", 1)[-1]
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def count_bytes(self, size : int):
+        with self.lock:
+            self.bytes += size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"requests": sum(self.requests.values()), "by_endpoint": dict(self.requests), "bytes": self.bytes}
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+if __name__ == "__main__":
+    import argparse
+    argparser = argparse.ArgumentParser(description="Local stand-in for the WHOS and a5 APIs")
+    argparser.add_argument("-p","--port", help="listening port. Default 8080", type=int, default=8080)
+    argparser.add_argument("-s","--stations", help="number of WHOS monitoring points. Default 3000", type=int, default=3000)
+    argparser.add_argument("-S","--series", help="number of WHOS timeseries. Default 12000", type=int, default=12000)
+    argparser.add_argument("--a5_stations", help="number of a5 stations. Default 300", type=int, default=300)
+    argparser.add_argument("--a5_series", help="number of a5 series. Default 1200", type=int, default=1200)
+    argparser.add_argument("-l","--latency", help="response delay in seconds. Default 0", type=float, default=0)
+    argparser.add_argument("--latency_per_item", help="additional delay in seconds per returned item. Default 0", type=float, default=0)
+    argparser.add_argument("-e","--error_rate", help="fraction of requests answered with 503. Default 0", type=float, default=0)
+    argparser.add_argument("--throttle_rate", help="fraction of requests answered with 429. Default 0", type=float, default=0)
+    argparser.add_argument("--seed", help="random seed. Default 0", type=int, default=0)
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    catalog = MockCatalog(stations=args.stations, series=args.series, a5_stations=args.a5_stations, a5_series=args.a5_series, seed=args.seed)
+    server = MockServer(catalog, port=args.port, latency=args.latency, latency_per_item=args.latency_per_item, error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=args.seed)
+    logging.info("serving on %s (WHOS: %s/gs-service/..., a5: %s/a5)" % (server.url, server.url, server.url))
+    server.serve_forever()
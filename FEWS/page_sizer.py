@@ -0,0 +1,105 @@
+import logging
+import threading
+import contextvars
+
+# sizes of the responses received for the page being fetched (see measureResponses)
+response_sizes = contextvars.ContextVar("response_sizes", default=None)
+
+def recordResponseSize(size : int):
+    """Adds a response body size to the page being measured in the current context, if any"""
+    sizes = response_sizes.get()
+    if sizes is not None:
+        sizes.append(size)
+
+def measureResponses(function, *args, **kwargs) -> tuple:
+    """Calls function, collecting the sizes of the responses recorded meanwhile (recordResponseSize). Threads started by function must run in a copy of the context (contextvars.copy_context) for their responses to count
+
+    Returns
+    -------
+    tuple
+        (result of function, total bytes)
+    """
+    sizes = []
+    token = response_sizes.set(sizes)
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        response_sizes.reset(token)
+    return result, sum(sizes)
+
+class PageSizer:
+    """Adaptive page size (limit) for paginated requests
+
+    After each page the limit is scaled by target_latency / latency (at most halved or doubled per page) and capped so that the page payload stays under max_bytes, always within [min_limit, max_limit]
+
+    Methods
+    -------
+    update(limit, items, latency, size)
+        Adjusts the limit from the measures of a page requested with limit
+    shrink(limit)
+        Lowers the limit (and maximum) after a failed (i.e. timed out) page requested with limit
+    """
+
+    def __init__(self, name : str, limit : int, min_limit : int = 100, max_limit : int = 5000, target_latency : float = 10, max_bytes : int = None):
+        """
+        Parameters
+        ----------
+        name : str
+            Name of the paginated request, for logging
+        limit : int
+            Initial page size
+        min_limit : int
+            Minimum page size
+        max_limit : int
+            Maximum page size
+        target_latency : float
+            Target page latency in seconds
+        max_bytes : int
+            Maximum page payload size in bytes. None for no limit
+        """
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.limit = self.clip(limit)
+        self.sizes = []
+        self.lock = threading.Lock()
+
+    def clip(self, limit : float) -> int:
+        return int(max(self.min_limit, min(self.max_limit, limit)))
+
+    def update(self, limit : int, items : int, latency : float, size : int):
+        """Adjusts the limit from the measures of a page
+
+        Parameters
+        ----------
+        limit : int
+            Page size of the request
+        items : int
+            Number of items in the page. Short (last) pages only count for the payload cap
+        latency : float
+            Request duration in seconds
+        size : int
+            Payload size in bytes
+        """
+        with self.lock:
+            self.sizes.append(limit)
+            new_limit = self.limit
+            if items >= limit:
+                new_limit = limit * max(0.5, min(2.0, self.target_latency / max(latency, 0.001)))
+            if self.max_bytes is not None and items > 0 and size > 0:
+                new_limit = min(new_limit, self.max_bytes * items / size)
+            new_limit = self.clip(new_limit)
+            if new_limit != self.limit:
+                logging.info("%s page size: %i -> %i (%i items, %.2f s, %i bytes)" % (self.name, self.limit, new_limit, items, latency, size))
+                self.limit = new_limit
+
+    def shrink(self, limit : int):
+        """Halves the limit of a failed page and keeps it as the maximum page size"""
+        with self.lock:
+            self.max_limit = max(self.min_limit, min(self.max_limit, limit // 2))
+            new_limit = self.clip(self.limit)
+            if new_limit != self.limit:
+                logging.info("%s page size: %i -> %i (failed page)" % (self.name, self.limit, new_limit))
+                self.limit = new_limit
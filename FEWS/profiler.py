@@ -0,0 +1,140 @@
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from pathlib import Path
+
+# modules of idle waits (locks, queues, thread pool workers), left out of the sampling summary
+idle_modules = ["threading.py", "queue.py", "selectors.py", "thread.py"]
+
+class Profiler:
+    """Profile of a run: deterministic (cProfile) or sampling, written as a pstats file and a flamegraph-compatible collapsed-stack file, with a top-N hot function summary logged at the end
+
+    The deterministic profile (cProfile) covers the thread that starts it. The sampling profile (stacks of all threads every interval seconds) is taken in both modes and is the one written as collapsed stacks (input of flamegraph.pl, speedscope, ...)
+
+    Usage
+    -----
+        with Profiler("log/run") as profiler:
+            client.makeFewsTables(output_dir="results")
+
+    Methods
+    -------
+    start()
+        Starts profiling
+    stop()
+        Stops profiling, writes the outputs and logs the summary
+    summary()
+        Returns the top hot functions
+    """
+
+    def __init__(self, output : str = None, mode : str = "deterministic", interval : float = 0.01, top : int = 20):
+        """
+        Parameters
+        ----------
+        output : str
+            Output path prefix: writes <output>.pstats (deterministic mode) and <output>.collapsed. None to only log the summary
+        mode : str
+            deterministic (cProfile plus sampling) or sampling (sampling only, low overhead)
+        interval : float
+            Sampling interval in seconds
+        top : int
+            Number of functions of the summary
+        """
+        if mode not in ["deterministic", "sampling"]:
+            raise Exception("Invalid profile mode %s. Choose one of 'deterministic', 'sampling'" % mode)
+        self.output = output
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self.profile = None
+        self.samples = {}
+        self.sample_count = 0
+        self.sampler = None
+        self.running = threading.Event()
+        self.started = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(target=self.sample, name="profiler-sampler", daemon=True)
+        self.sampler.start()
+        if self.mode == "deterministic":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if not self.running.is_set():
+            return
+        if self.profile is not None:
+            self.profile.disable()
+        self.running.clear()
+        self.sampler.join()
+        self.elapsed = time.perf_counter() - self.started
+        if self.output is not None:
+            Path(self.output).parent.mkdir(parents=True, exist_ok=True)
+            if self.profile is not None:
+                self.profile.dump_stats("%s.pstats" % self.output)
+            f = open("%s.collapsed" % self.output, "w")
+            for stack, count in sorted(self.samples.items()):
+                f.write("%s %i\n" % (stack, count))
+            f.close()
+            logging.info("profile written to %s.%s" % (self.output, "pstats and .collapsed" if self.profile is not None else "collapsed"))
+        for line in self.summary():
+            logging.info(line)
+
+    def sample(self):
+        me = threading.get_ident()
+        names = {}
+        while self.running.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%i)" % (code.co_name, Path(code.co_filename).name, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.sample_count += 1
+            time.sleep(self.interval)
+
+    def summary(self) -> list:
+        """Top hot functions as log lines: by cumulative time for the deterministic profile, by share of samples (own and total) for the sampling profile, leaving out samples of idle threads (see idle_modules)"""
+        lines = ["profile: %.1f s, %s" % (self.elapsed if self.elapsed is not None else time.perf_counter() - self.started, self.mode)]
+        if self.profile is not None:
+            stats = pstats.Stats(self.profile).sort_stats("cumulative")
+            lines.append("%10s %10s %10s  %s" % ("calls", "tottime", "cumtime", "function"))
+            for (filename, line, name) in stats.fcn_list[:self.top]:
+                calls, primitive_calls, tottime, cumtime, callers = stats.stats[(filename, line, name)]
+                lines.append("%10i %10.3f %10.3f  %s (%s:%i)" % (calls, tottime, cumtime, name, Path(filename).name, line))
+            return lines
+        own = {}
+        total = {}
+        for stack, count in self.samples.items():
+            frames = stack.split(";")[1:]
+            if not len(frames) or frames[-1].rsplit(" (", 1)[-1].split(":")[0] in idle_modules:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total[frame] = total.get(frame, 0) + count
+        samples = sum(own.values())
+        lines.append("%8s %8s  %s" % ("own %", "total %", "function (busy samples of all threads)"))
+        for frame, count in sorted(own.items(), key=lambda item: -item[1])[:self.top]:
+            lines.append("%8.1f %8.1f  %s" % (100 * count / samples, 100 * total[frame] / samples, frame))
+        return lines
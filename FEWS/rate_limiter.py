@@ -0,0 +1,191 @@
+import time
+import asyncio
+import threading
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+
+default_limits = {
+    "rate": 10,
+    "burst": 10,
+    "max_in_flight": 8,
+    "min_rate": 0.1
+}
+
+governors = {}
+governors_lock = threading.Lock()
+
+class HostGovernor:
+    """Token bucket rate limiter and maximum in-flight requests governor for one host
+
+    acquire() blocks until a request slot (max_in_flight) and a token are available. Tokens are refilled at rate per second up to burst. A throttling response (see throttle) halves the current rate (down to min_rate) and pauses all requests until Retry-After has elapsed. The rate then recovers gradually with successful responses. Threaded and asyncio clients share the same slots and tokens: coroutines wait with acquireAsync on their event loop and are woken by release
+
+    Methods
+    -------
+    acquire()
+        Waits for a request slot and a token
+    acquireAsync()
+        Coroutine version of acquire, without blocking a thread
+    release(status_code)
+        Frees the request slot. Successful responses let the rate recover
+    wait()
+        Waits for a token (for retries of an already acquired request)
+    waitAsync()
+        Coroutine version of wait
+    throttle(retry_after)
+        Slows down after a throttling response (429, or 503 with Retry-After)
+    """
+
+    def __init__(self, host : str, rate : float = 10, burst : float = 10, max_in_flight : int = 8, min_rate : float = 0.1):
+        """
+        Parameters
+        ----------
+        host : str
+            Host name, for logging
+        rate : float
+            Maximum sustained request rate (requests per second)
+        burst : float
+            Bucket size: maximum number of requests sent at once after an idle period
+        max_in_flight : int
+            Maximum number of concurrent requests
+        min_rate : float
+            Lower bound of the rate when slowing down
+        """
+        self.host = host
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        # (event loop, future) of the coroutines waiting for a slot
+        self.waiters = deque()
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            self.wait()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    async def acquireAsync(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            waiter = loop.create_future()
+            # registered before trying, so that a slot released meanwhile wakes it up
+            with self.lock:
+                self.waiters.append((loop, waiter))
+            if self.slots.acquire(blocking=False):
+                self.removeWaiter(waiter)
+                break
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not self.removeWaiter(waiter):
+                    # woken up: hand the slot over to the next waiter
+                    self.wakeWaiter()
+                raise
+        try:
+            await self.waitAsync()
+        except BaseException:
+            self.release()
+            raise
+
+    def removeWaiter(self, waiter) -> bool:
+        """Removes waiter from the queue. False if release already took it out (to wake it up)"""
+        with self.lock:
+            for item in self.waiters:
+                if item[1] is waiter:
+                    self.waiters.remove(item)
+                    return True
+        return False
+
+    def wakeWaiter(self):
+        """Wakes up the first coroutine waiting for a slot, from any thread"""
+        while True:
+            with self.lock:
+                if not len(self.waiters):
+                    return
+                loop, waiter = self.waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(setWaiterResult, waiter)
+                return
+            except RuntimeError:
+                # its event loop is closed
+                continue
+
+    def release(self, status_code : int = None):
+        self.slots.release()
+        self.wakeWaiter()
+        if status_code is not None and status_code < 400:
+            with self.lock:
+                # additive recovery: back to max_rate after ~20 successful requests
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def wait(self):
+        while True:
+            delay = self.takeToken()
+            if delay is None:
+                return
+            time.sleep(delay)
+
+    async def waitAsync(self):
+        while True:
+            delay = self.takeToken()
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+
+    def takeToken(self) -> float:
+        """Takes a token if one is available and requests are not paused. Returns None if taken, else the time to wait before trying again"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens = self.tokens - 1
+                return None
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+    def throttle(self, retry_after : float = None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            logging.warning("%s: throttled by server, rate lowered to %.2f req/s%s" % (self.host, self.rate, ", paused for %.1f s" % retry_after if retry_after is not None else ""))
+
+def setWaiterResult(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+def getGovernor(url : str, rate_limits : dict = None) -> HostGovernor:
+    """Returns the process-wide governor of the host of url, or None if rate_limits has no entry for the host
+
+    Parameters
+    ----------
+    url : str
+        Any url of the target host
+    rate_limits : dict
+        Limits by host name (i.e. {"whos.geodab.eu": {"rate": 5, "burst": 10, "max_in_flight": 8}}). The "*" entry applies to any other host. Missing keys take the values of default_limits. The governor of a host is created with the limits of the first call
+
+    Returns
+    -------
+    HostGovernor
+    """
+    if rate_limits is None:
+        return None
+    host = urlsplit(url).hostname
+    limits = rate_limits[host] if host in rate_limits else rate_limits["*"] if "*" in rate_limits else None
+    if limits is None:
+        return None
+    with governors_lock:
+        if host not in governors:
+            limits = {key: limits[key] if key in limits else default_limits[key] for key in default_limits}
+            logging.debug("new governor for %s: %s" % (host, str(limits)))
+            governors[host] = HostGovernor(host, **limits)
+        return governors[host]
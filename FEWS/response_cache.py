@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from pathlib import Path
+import requests
+from requests.structures import CaseInsensitiveDict
+
+class ResponseCache:
+    """Persistent HTTP response cache with per-endpoint TTL, ETag/Last-Modified revalidation and LRU size cap
+
+    Each entry is stored as two files in cache_dir: <key>.body (raw response content) and <key>.json (metadata). The key is a hash of the endpoint and the normalized query parameters, so it must not contain credentials (i.e. the WHOS token)
+
+    Methods
+    -------
+    key(endpoint, params)
+        Returns the cache key of a request
+    get(key)
+        Returns the cached entry metadata or None
+    isFresh(entry)
+        True if the entry age is below the TTL of its endpoint
+    validators(entry)
+        Returns conditional request headers for the entry
+    response(key, entry)
+        Builds a requests.Response from a cached entry, or None if it was evicted meanwhile
+    put(key, endpoint, response)
+        Stores a response
+    refresh(key, entry)
+        Resets the age of an entry after a 304 Not Modified
+    """
+
+    def __init__(self, cache_dir : str, ttl : dict = None, default_ttl : float = 3600, max_bytes : int = 1024**3):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Cache directory. Created if missing
+        ttl : dict
+            Time to live in seconds by endpoint name (last path element of the request url, i.e. 'timeseries')
+        default_ttl : float
+            Time to live in seconds for endpoints not in ttl
+        max_bytes : int
+            Maximum total size of cached bodies. Least recently used entries are evicted beyond this size
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl if ttl is not None else {}
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = sum(f.stat().st_size for f in self.cache_dir.glob("*.body"))
+
+    def key(self, endpoint : str, params : dict = None) -> str:
+        normalized = sorted((str(k), str(v)) for k, v in (params or {}).items() if v is not None)
+        return hashlib.sha1(json.dumps([endpoint, normalized]).encode()).hexdigest()
+
+    def get(self, key : str) -> dict:
+        try:
+            # not while evict removes files
+            with self.lock:
+                with open(self.cache_dir / ("%s.json" % key), "r") as f:
+                    entry = json.load(f)
+                # mark as recently used
+                os.utime(self.cache_dir / ("%s.body" % key))
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def isFresh(self, entry : dict) -> bool:
+        ttl = self.ttl[entry["endpoint"]] if entry["endpoint"] in self.ttl else self.default_ttl
+        return time.time() - entry["stored"] < ttl
+
+    def validators(self, entry : dict) -> dict:
+        headers = {}
+        if entry is None:
+            return headers
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def response(self, key : str, entry : dict) -> requests.Response:
+        response = requests.Response()
+        try:
+            with self.lock:
+                with open(self.cache_dir / ("%s.body" % key), "rb") as f:
+                    response._content = f.read()
+        except OSError:
+            # evicted since get (by this or another process sharing cache_dir)
+            return None
+        response.status_code = entry["status_code"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = entry["encoding"]
+        response.url = entry["url"]
+        return response
+
+    def put(self, key : str, endpoint : str, response : requests.Response):
+        entry = {
+            "endpoint": endpoint,
+            "stored": time.time(),
+            "url": response.url,
+            "status_code": response.status_code,
+            "encoding": response.encoding,
+            "headers": {k: response.headers[k] for k in ["Content-Type", "ETag", "Last-Modified"] if k in response.headers},
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "size": len(response.content)
+        }
+        with self.lock:
+            body_file = self.cache_dir / ("%s.body" % key)
+            previous_size = body_file.stat().st_size if body_file.exists() else 0
+            self.write(body_file, response.content)
+            self.write(self.cache_dir / ("%s.json" % key), json.dumps(entry).encode())
+            self.total_bytes += entry["size"] - previous_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def refresh(self, key : str, entry : dict):
+        entry["stored"] = time.time()
+        with self.lock:
+            self.write(self.cache_dir / ("%s.json" % key), json.dumps(entry).encode())
+
+    def write(self, path : Path, content : bytes):
+        tmp_path = path.with_suffix(path.suffix + ".tmp%i" % threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        bodies = sorted(self.cache_dir.glob("*.body"), key=lambda f: f.stat().st_mtime)
+        for body_file in bodies:
+            if self.total_bytes <= self.max_bytes:
+                break
+            size = body_file.stat().st_size
+            body_file.unlink(missing_ok=True)
+            body_file.with_suffix(".json").unlink(missing_ok=True)
+            self.total_bytes -= size
+            logging.debug("cache: evicted %s" % body_file.stem)
@@ -0,0 +1,76 @@
+import copy
+import json
+import asyncio
+import threading
+import logging
+
+class SingleFlight:
+    """Coalesces identical concurrent calls: while a call with a given key is in flight, further calls with the same key wait for it instead of repeating it. Every caller gets its own (deep) copy of the result, or the exception raised by the call
+
+    Methods
+    -------
+    key(*args, **kwargs)
+        Returns a normalized key of the call parameters
+    do(key, function, *args, **kwargs)
+        Calls function, or waits for the in-flight call with the same key
+    doAsync(key, function, *args, **kwargs)
+        Same as do for a coroutine function, coalescing within the running event loop
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.async_calls = {}
+        self.lock = threading.Lock()
+
+    def key(self, *args, **kwargs) -> str:
+        """Normalized key of the call parameters. None valued keyword arguments and dict entries are dropped and keys are sorted"""
+        def normalize(value):
+            if isinstance(value, dict):
+                return {str(k): normalize(v) for k, v in value.items() if v is not None}
+            if isinstance(value, (list, tuple)):
+                return [normalize(v) for v in value]
+            return value
+        return json.dumps([normalize(list(args)), normalize(kwargs)], sort_keys=True, default=str)
+
+    def do(self, key : str, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None, "followers": 0}
+                self.calls[key] = call
+            else:
+                call["followers"] += 1
+        if leader:
+            try:
+                call["result"] = function(*args, **kwargs)
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call["done"].set()
+        else:
+            logging.debug("single flight: joined in-flight call %s" % key)
+            call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        # the stored result stays untouched while it is being copied: the leader also gets a copy if the call was shared
+        return call["result"] if leader and call["followers"] == 0 else copy.deepcopy(call["result"])
+
+    async def doAsync(self, key : str, function, *args, **kwargs):
+        loop_key = (id(asyncio.get_running_loop()), key)
+        call = self.async_calls.get(loop_key)
+        if call is None:
+            call = {"task": asyncio.ensure_future(function(*args, **kwargs)), "followers": 0}
+            self.async_calls[loop_key] = call
+            call["task"].add_done_callback(lambda task: self.async_calls.pop(loop_key, None))
+            # shield: a cancelled caller must not cancel the call of the others
+            result = await asyncio.shield(call["task"])
+            return result if call["followers"] == 0 else copy.deepcopy(result)
+        logging.debug("single flight: joined in-flight call %s" % key)
+        call["followers"] += 1
+        return copy.deepcopy(await asyncio.shield(call["task"]))
+
+# shared by all the clients of the process
+single_flight = SingleFlight()
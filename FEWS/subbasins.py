@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from lazy_import import lazyImport
+numpy = lazyImport("numpy")
+shapely = lazyImport("shapely")
+
+class SubBasinIndex:
+    """Spatial index (STRtree) of a basins layer for batch subbasin assignment
+
+    Methods
+    -------
+    getSubBasins(coordinates)
+        Returns the subbasin name of each of the coordinates
+    """
+
+    def __init__(self, basins, name_column : str = "nombre_3"):
+        """
+        Parameters
+        ----------
+        basins : GeoDataFrame
+            Basins layer (i.e. cuencas.geojson)
+        name_column : str
+            Column of basins holding the subbasin name
+        """
+        self.names = numpy.array(list(basins[name_column]) + [None], dtype=object)
+        self.tree = shapely.STRtree(numpy.asarray(basins.geometry.values))
+
+    def getSubBasins(self, coordinates) -> list:
+        """Returns the subbasin name of each of the coordinates
+
+        A point falling within several (overlapping) basins gets the one appearing last in the basins layer, as in the per-point test it replaces
+
+        Parameters
+        ----------
+        coordinates : list
+            List of [longitude, latitude(, altitude)]
+
+        Returns
+        -------
+        list
+            Subbasin name of each point, None where the point is not within any basin
+        """
+        if not len(coordinates):
+            return []
+        points = shapely.points(numpy.array([[c[0], c[1]] for c in coordinates], dtype=float))
+        point_index, basin_index = self.tree.query(points, predicate="within")
+        # last match wins. -1 points to the trailing None name
+        match = numpy.full(len(coordinates), -1)
+        numpy.maximum.at(match, point_index, basin_index)
+        return list(self.names[match])
+
+# marks coordinates missing from the lookup table (None is a valid subbasin: outside of all basins)
+unknown = object()
+
+class SubBasinCache:
+    """Persistent lookup table of subbasin name by rounded [longitude, latitude], saved as JSON (i.e. next to the outputs)
+
+    The table is tied to the fingerprint (sha256) of the basins file and the name column: it is discarded automatically when the basins layer changes
+
+    Methods
+    -------
+    getSubBasins(coordinates, compute)
+        Returns the subbasin name of each of the coordinates, computing only the ones not in the table
+    save()
+        Writes the table if it changed, merged with the entries other runs saved meanwhile
+    """
+
+    def __init__(self, filename : str, basins_file : str, name_column : str = "nombre_3", precision : int = 6):
+        """
+        Parameters
+        ----------
+        filename : str
+            JSON file of the table. Created on save if missing
+        basins_file : str
+            Basins layer file (i.e. cuencas/cuencas.geojson), for the fingerprint
+        name_column : str
+            Column of basins holding the subbasin name
+        precision : int
+            Decimal places of the coordinates key
+        """
+        self.filename = Path(filename)
+        self.precision = precision
+        with open(basins_file, "rb") as f:
+            self.fingerprint = "%s:%s" % (hashlib.sha256(f.read()).hexdigest(), name_column)
+        self.lookup = self.read()
+        self.added = {}
+        self.lock = threading.Lock()
+
+    def read(self) -> dict:
+        try:
+            with open(self.filename, "r") as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if table.get("fingerprint") != self.fingerprint or table.get("precision") != self.precision:
+            logging.info("subbasin cache %s: basins layer changed, discarding %i entries" % (self.filename, len(table.get("lookup", {}))))
+            return {}
+        return table["lookup"]
+
+    def key(self, coordinates) -> str:
+        return "%.*f,%.*f" % (self.precision, coordinates[0], self.precision, coordinates[1])
+
+    def getSubBasins(self, coordinates, compute) -> list:
+        """Returns the subbasin name of each of the coordinates
+
+        Parameters
+        ----------
+        coordinates : list
+            List of [longitude, latitude(, altitude)]
+        compute : function
+            Returns the subbasin names of a list of coordinates (i.e. SubBasinIndex.getSubBasins). Called once with the coordinates missing from the table, if any
+
+        Returns
+        -------
+        list
+            Subbasin name of each point, None where the point is not within any basin
+        """
+        keys = [self.key(c) for c in coordinates]
+        with self.lock:
+            names = [self.lookup[key] if key in self.lookup else self.added[key] if key in self.added else unknown for key in keys]
+        missing = [i for i, name in enumerate(names) if name is unknown]
+        if len(missing):
+            computed = compute([coordinates[i] for i in missing])
+            with self.lock:
+                for i, name in zip(missing, computed):
+                    names[i] = name
+                    self.added[keys[i]] = name
+        logging.debug("subbasin cache: %i hits, %i computed" % (len(keys) - len(missing), len(missing)))
+        return names
+
+    def save(self):
+        with self.lock:
+            if not len(self.added):
+                return
+            # keep the entries saved by concurrent runs since this table was read
+            lookup = self.read()
+            lookup.update(self.lookup)
+            lookup.update(self.added)
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.filename.with_name("%s.tmp%i" % (self.filename.name, threading.get_ident()))
+            with open(tmp_path, "w") as f:
+                json.dump({"fingerprint": self.fingerprint, "precision": self.precision, "lookup": lookup}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.filename)
+            self.lookup = lookup
+            self.added = {}
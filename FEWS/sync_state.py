@@ -0,0 +1,192 @@
+from __future__ import annotations
+import json
+import gzip
+import hashlib
+import logging
+from collections import Counter
+from io import StringIO
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from lazy_import import lazyImport
+pandas = lazyImport("pandas")
+
+class SyncState:
+    """State of the FEWS tables of an output directory, for incremental (delta) runs of makeFewsTables
+
+    Keeps the phenomenonTime.end watermark of every timeseries of the previous run (sync_state.json) and its timeseries members (sync_members.json.gz), so that the next run requests only the series whose end reached the watermark of their variable (see getBeginPositions). Writes only the tables whose content hash changed, removes the tables that are no longer produced and records added, removed and changed stations and series in a machine-readable changelog (changelog.json)
+
+    Methods
+    -------
+    getBeginPositions(query, observedProperties, threshold, full_sync_days)
+        Begin position of the timeseries request of each variable
+    writeTable(filename, data_frame, key)
+        Writes data_frame as csv if its content changed and records the row changes
+    removeTables()
+        Removes the tables of the previous run that were not written in this one
+    setWatermarks(watermarks)
+        Records the watermarks of this run and the series whose end advanced
+    setMembers(members)
+        Records the timeseries members of this run
+    save()
+        Writes sync_state.json, sync_members.json.gz and changelog.json
+    """
+
+    state_file = "sync_state.json"
+    members_file = "sync_members.json.gz"
+    changelog_file = "changelog.json"
+
+    def __init__(self, output_dir : str = ""):
+        """
+        Parameters
+        ----------
+        output_dir : str
+            Directory of the FEWS tables (locations.csv, P.csv, H.csv, ...)
+        """
+        self.output_dir = Path(output_dir)
+        self.previous = {"run": None, "watermarks": {}}
+        state_path = self.output_dir / self.state_file
+        if state_path.exists():
+            with open(state_path, "r") as f:
+                self.previous = json.load(f)
+        self.watermarks = {}
+        self.members = []
+        self.previous_members = []
+        self.query = None
+        self.changelog = {
+            "run": datetime.now().isoformat(),
+            "previous_run": self.previous["run"],
+            "files": {"written": [], "unchanged": [], "removed": []},
+            "tables": {},
+            "updated_series": []
+        }
+        self.full_run = self.changelog["run"]
+
+    def getBeginPositions(self, query : dict, observedProperties : list, threshold : str, full_sync_days : float = None) -> dict:
+        """Begin position of the timeseries request of each variable: the latest phenomenonTime.end of the variable in the previous run (its watermark), not earlier than threshold. The series not returned (their end didn't reach the watermark) are taken from the members of the previous run (previous_members)
+
+        A series whose end advanced without reaching the watermark of its variable keeps its previous end until the next full harvest, which is done if the previous run is not of the same query or the last full harvest is older than full_sync_days
+
+        Parameters
+        ----------
+        query : dict
+            Parameters identifying the harvest (i.e. view, observedProperty, country, bbox). Watermarks are only used if the previous run had the same query
+        observedProperties : list
+            Identifiers of the observed properties to request
+        threshold : str
+            Availability threshold (ISO 8601), begin position of the full harvest
+        full_sync_days : float
+            Maximum age in days of the last full harvest. Default no limit
+
+        Returns
+        -------
+        dict
+            Begin position indexed by observedProperty, or None for a full harvest from threshold
+        """
+        self.query = query
+        if self.previous.get("query") != query or self.previous.get("full_run") is None or not (self.output_dir / self.members_file).exists():
+            return None
+        if full_sync_days is not None and datetime.fromisoformat(self.previous["full_run"]) < datetime.now() - timedelta(days=full_sync_days):
+            logging.info("sync_state: last full harvest at %s, harvesting all timeseries" % self.previous["full_run"])
+            return None
+        with gzip.open(self.output_dir / self.members_file, "rt") as f:
+            self.previous_members = json.load(f)
+        self.full_run = self.previous["full_run"]
+        begin = {op: parseTime(threshold) for op in observedProperties}
+        for key, end in self.previous["watermarks"].items():
+            op = key.split("|")[-1]
+            if op in begin and end is not None and parseTime(end) > begin[op]:
+                begin[op] = parseTime(end)
+        return {op: position.strftime("%Y-%m-%dT%H:%M:%SZ") for op, position in begin.items()}
+
+    def writeTable(self, filename : str, data_frame : pandas.DataFrame, key : str) -> bool:
+        """Writes data_frame as csv (without index) into filename unless the existing file has the same content hash
+
+        Parameters
+        ----------
+        filename : str
+            File name relative to output_dir
+        data_frame : DataFrame
+            Table to write
+        key : str
+            Row identifier column, used to report added, removed and changed rows
+
+        Returns
+        -------
+        bool
+            True if the file was written
+        """
+        path = self.output_dir / filename
+        # row order depends on the order of the responses. Sorted on the whole row, since the key is not unique
+        if key in data_frame.columns:
+            data_frame = data_frame.sort_values([key] + [c for c in data_frame.columns if c != key], kind="stable", key=lambda column: column if pandas.api.types.is_numeric_dtype(column) else column.astype(str))
+        content = data_frame.to_csv(index=False)
+        previous_content = None
+        if path.exists():
+            with open(path, "r") as f:
+                previous_content = f.read()
+        if previous_content is not None and hashlib.sha256(previous_content.encode()).digest() == hashlib.sha256(content.encode()).digest():
+            self.changelog["files"]["unchanged"].append(filename)
+            self.changelog["tables"][filename] = {"added": [], "removed": [], "changed": []}
+            return False
+        self.changelog["tables"][filename] = self.diffRows(previous_content, content, key)
+        with open(path, "w") as f:
+            f.write(content)
+        self.changelog["files"]["written"].append(filename)
+        logging.info("%s: %i added, %i removed, %i changed" % (filename, len(self.changelog["tables"][filename]["added"]), len(self.changelog["tables"][filename]["removed"]), len(self.changelog["tables"][filename]["changed"])))
+        return True
+
+    def removeTables(self) -> list:
+        """Removes the tables of the previous run that were not written (or found unchanged) in this one, i.e. of a variable without series. Returns the removed file names"""
+        current = set(self.changelog["files"]["written"] + self.changelog["files"]["unchanged"])
+        for filename in self.previous.get("tables", []):
+            if filename in current:
+                continue
+            path = self.output_dir / filename
+            if path.exists():
+                path.unlink()
+            self.changelog["files"]["removed"].append(filename)
+            logging.info("%s: removed, no rows left" % filename)
+        return self.changelog["files"]["removed"]
+
+    def diffRows(self, previous_content : str, content : str, key : str) -> dict:
+        current = self.readRows(content, key)
+        previous = self.readRows(previous_content, key) if previous_content is not None else {}
+        return {
+            "added": [k for k in current if k not in previous],
+            "removed": [k for k in previous if k not in current],
+            "changed": [k for k in current if k in previous and current[k] != previous[k]]
+        }
+
+    def readRows(self, content : str, key : str) -> dict:
+        """Rows of a csv table by key, as a multiset (Counter) of the row tuples of each key"""
+        if not len(content.strip()):
+            return {}
+        data_frame = pandas.read_csv(StringIO(content), dtype=str, keep_default_na=False)
+        if key not in data_frame.columns:
+            return {}
+        rows = {}
+        for row in data_frame[[key] + [c for c in data_frame.columns if c != key]].itertuples(index=False, name=None):
+            rows.setdefault(row[0], Counter())[row[1:]] += 1
+        return rows
+
+    def setWatermarks(self, watermarks : dict):
+        """Records the phenomenonTime.end of each timeseries (watermarks: dict of end indexed by 'featureOfInterest|observedProperty') and lists those whose end advanced since the previous run"""
+        self.watermarks = watermarks
+        self.changelog["updated_series"] = [k for k, end in watermarks.items() if k in self.previous["watermarks"] and end != self.previous["watermarks"][k]]
+
+    def setMembers(self, members : list):
+        """Records the timeseries members of this run, the previous_members of the next one"""
+        self.members = members
+
+    def save(self):
+        with gzip.open(self.output_dir / self.members_file, "wt") as f:
+            json.dump(self.members, f, ensure_ascii=False)
+        with open(self.output_dir / self.state_file, "w") as f:
+            json.dump({"run": self.changelog["run"], "full_run": self.full_run, "query": self.query, "tables": self.changelog["files"]["written"] + self.changelog["files"]["unchanged"], "watermarks": self.watermarks}, f)
+        with open(self.output_dir / self.changelog_file, "w") as f:
+            json.dump(self.changelog, f, indent=2, ensure_ascii=False)
+
+def parseTime(position : str) -> datetime:
+    """Parses an ISO 8601 date (UTC if no offset is given)"""
+    time = datetime.fromisoformat(position.replace("Z", "+00:00"))
+    return time if time.tzinfo is not None else time.replace(tzinfo=timezone.utc)
@@ -0,0 +1,121 @@
+import sys
+import copy
+import json
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+import pytest
+
+fews_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(fews_dir))
+
+from mock_server import MockCatalog, MockServer
+import rate_limiter
+import whos_client
+
+@pytest.fixture(autouse=True)
+def isolate(monkeypatch, tmp_path):
+    """Runs each test in a scratch directory with cuencas/ and log/, restoring the process-wide state the clients share (default_config, host governors)"""
+    (tmp_path / "cuencas").symlink_to(fews_dir / "cuencas")
+    (tmp_path / "log").mkdir()
+    (tmp_path / "results").mkdir()
+    monkeypatch.chdir(tmp_path)
+    default_config = copy.deepcopy(whos_client.Client.default_config)
+    with rate_limiter.governors_lock:
+        rate_limiter.governors.clear()
+    yield
+    whos_client.Client.default_config.clear()
+    whos_client.Client.default_config.update(default_config)
+    with rate_limiter.governors_lock:
+        rate_limiter.governors.clear()
+
+@pytest.fixture(scope="session")
+def catalog():
+    return MockCatalog(stations=300, series=1200, a5_stations=50, a5_series=150)
+
+@pytest.fixture
+def server(catalog):
+    server = MockServer(catalog)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def makeConfig(server : MockServer, **config) -> dict:
+    """config.json of the repo pointed at the mock server, without rate limits, plus config"""
+    with open(fews_dir / "config.json") as f:
+        whos_config = json.load(f)
+    whos_config.update({"url": server.url, "token": "mock", "retries": 0, "backoff_factor": 0.01, "backoff_jitter": 0})
+    del whos_config["rate_limits"]
+    whos_config.update(config)
+    return whos_config
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        name = parts.path.rstrip("/").rsplit("/", 1)[-1]
+        query = dict(parse_qsl(parts.query))
+        with self.server.lock:
+            self.server.requests.append((name, query, dict(self.headers)))
+        if name not in self.server.routes:
+            self.send(404, {}, b"")
+            return
+        status, headers, body = self.server.routes[name](query, self.headers)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers = dict({"Content-Type": "application/json"}, **headers)
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send(status, headers, body)
+
+    def send(self, status : int, headers : dict, body : bytes):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubServer(ThreadingHTTPServer):
+    """Local HTTP server answering each GET with the route of the last element of its path: routes[name](query, headers) returns (status, headers, body). Bodies of dict or list are sent as JSON. Received requests are kept in requests as (name, query, headers)"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.routes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%i" % self.server_address[1]
+
+    def count(self, name : str) -> int:
+        with self.lock:
+            return len([request for request in self.requests if request[0] == name])
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def stubConfig(server : StubServer, **config) -> dict:
+    """Client config pointed at the stub server, without retries, plus config"""
+    return dict({"url": server.url, "token": "stub", "retries": 0, "backoff_factor": 0.01, "backoff_jitter": 0}, **config)
+
+def stubPage(items : list, query : dict, key : str) -> dict:
+    """Page of items at the offset (1-based) and limit of query, as the timeseries API returns it"""
+    offset = int(query["offset"]) if "offset" in query else 1
+    limit = int(query["limit"]) if "limit" in query else 10
+    items = items[offset - 1:offset - 1 + limit]
+    return {key: items} if len(items) else {}
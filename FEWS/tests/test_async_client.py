@@ -0,0 +1,121 @@
+import time
+import asyncio
+import threading
+from urllib.parse import urlsplit
+from mock_server import MockServer
+from rate_limiter import getGovernor, HostGovernor
+from whos_client import Client
+from whos_async_client import AsyncClient
+from conftest import makeConfig, stubConfig, stubPage
+
+stations = [{"id": "%03i" % i} for i in range(95)]
+
+def test_pagination_matches_client(stub):
+    stub.routes["monitoring-points"] = lambda query, headers: (200, {}, stubPage(stations, query, "results"))
+    async def main():
+        async with AsyncClient(stubConfig(stub, monitoring_points_per_page=10)) as client:
+            return await client.getMonitoringPointsWithPagination(max_workers=4)
+    result = asyncio.run(main())
+    assert result == Client(stubConfig(stub, monitoring_points_per_page=10)).getMonitoringPointsWithPagination()
+    assert [item["id"] for item in result["results"]] == [item["id"] for item in stations]
+
+def test_timeseries_multi_merges_queries(stub):
+    members = {op: [{"id": "%s%i" % (op, i), "featureOfInterest": {"href": "S%i" % i}, "observedProperty": {"href": op}} for i in range(3)] for op in ["P", "Q"]}
+    stub.routes["timeseries"] = lambda query, headers: (200, {}, stubPage(members[query["observedProperty"]], query, "member"))
+    async def main():
+        async with AsyncClient(stubConfig(stub)) as client:
+            return await client.getTimeseriesMulti(observedProperty=["P", "Q"], limit=10)
+    result = asyncio.run(main())
+    assert [item["id"] for item in result["member"]] == ["P0", "P1", "P2", "Q0", "Q1", "Q2"]
+    assert stub.count("timeseries") == 2
+
+def test_requests_in_flight_are_bounded(stub):
+    in_flight = {"now": 0, "max": 0}
+    lock = threading.Lock()
+    def route(query, headers):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        time.sleep(0.1)
+        with lock:
+            in_flight["now"] -= 1
+        return 200, {}, {"member": []}
+    stub.routes["timeseries"] = route
+    async def main():
+        async with AsyncClient(stubConfig(stub, max_concurrency=3)) as client:
+            return await asyncio.gather(*[client.getTimeseries(observedProperty="P%i" % i) for i in range(10)])
+    assert len(asyncio.run(main())) == 10
+    assert 1 < in_flight["max"] <= 3
+
+def test_unavailable_response_is_retried(stub):
+    responses = [(503, {"Retry-After": "0"}, b""), (200, {}, {"member": [{"id": "A"}]})]
+    stub.routes["timeseries"] = lambda query, headers: responses.pop(0)
+    async def main():
+        async with AsyncClient(stubConfig(stub, retries=2)) as client:
+            return await client.getTimeseries(observedProperty="P")
+    assert asyncio.run(main()) == {"member": [{"id": "A"}]}
+    assert stub.count("timeseries") == 2
+
+def makeAsyncConfig(server : MockServer, max_in_flight : int, **config) -> dict:
+    return makeConfig(server, rate_limits={urlsplit(server.url).hostname: {"rate": 1000, "burst": 1000, "max_in_flight": max_in_flight}}, **config)
+
+def test_cancelled_requests_free_their_slots(catalog):
+    server = MockServer(catalog, latency=0.2)
+    server.start()
+    try:
+        config = makeAsyncConfig(server, 2, timeseries_per_page=100, timeseries_max=10000)
+        async def main():
+            async with AsyncClient(config) as client:
+                url, params = client.getTimeseriesRequest(offset=1, limit=10)
+                # 2 requests in flight, 4 waiting for a slot
+                tasks = [asyncio.ensure_future(client.request(url, params)) for i in range(6)]
+                await asyncio.sleep(0.05)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.sleep(0.5)
+                governor = getGovernor(url, client.config["rate_limits"])
+                assert governor.slots._value == 2
+                return await asyncio.wait_for(client.getTimeseriesWithPagination(has_data=False, max_workers=4), 30)
+        result = asyncio.run(main())
+        assert len(result["member"]) == len(catalog.timeseries)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_governor_waits_on_the_event_loop(catalog, monkeypatch):
+    def runInExecutor(self, executor, function, *args):
+        raise AssertionError("governor waited for in a thread")
+    monkeypatch.setattr(asyncio.BaseEventLoop, "run_in_executor", runInExecutor)
+    server = MockServer(catalog, latency=0.1)
+    server.start()
+    try:
+        config = makeAsyncConfig(server, 2, max_concurrency=100)
+        async def main():
+            async with AsyncClient(config) as client:
+                url, params = client.getTimeseriesRequest(offset=1, limit=10)
+                start = time.monotonic()
+                responses = await asyncio.gather(*[client.request(url, params) for i in range(10)])
+                elapsed = time.monotonic() - start
+                governor = getGovernor(url, client.config["rate_limits"])
+                assert governor.slots._value == 2 and not len(governor.waiters)
+                return responses, elapsed
+        responses, elapsed = asyncio.run(main())
+        assert len(responses) == 10
+        # 2 at a time
+        assert elapsed >= 0.5
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_thread_release_wakes_coroutine():
+    governor = HostGovernor("mock", rate=1000, burst=1000, max_in_flight=1)
+    governor.acquire()
+    threading.Timer(0.2, governor.release).start()
+    async def main():
+        start = time.monotonic()
+        await asyncio.wait_for(governor.acquireAsync(), 5)
+        governor.release()
+        return time.monotonic() - start
+    assert asyncio.run(main()) >= 0.15
+    assert governor.slots._value == 1
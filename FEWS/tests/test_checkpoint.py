@@ -0,0 +1,94 @@
+import pytest
+from pathlib import Path
+from checkpoint import CheckpointStore
+from whos_client import Client
+from conftest import makeConfig, stubConfig, stubPage
+
+def getTimeseriesRequests(server) -> int:
+    return sum(count for endpoint, count in server.stats()["by_endpoint"].items() if "timeseries" in endpoint)
+
+def getMonitoringPointsRequests(server) -> int:
+    return sum(count for endpoint, count in server.stats()["by_endpoint"].items() if "monitoring-points" in endpoint)
+
+def test_store_keeps_pages_only_on_resume(tmp_path):
+    key = {"harvest": "timeseries", "per_page": 10}
+    store = CheckpointStore(tmp_path, key)
+    store.save(1, {"member": [1]})
+    store.save(11, {"member": [2]})
+    assert CheckpointStore(tmp_path, key, resume=True).completed() == [1, 11]
+    assert not CheckpointStore(tmp_path, dict(key, per_page=20), resume=True).has(1)
+    assert CheckpointStore(tmp_path, key).completed() == []
+    store = CheckpointStore(tmp_path, key)
+    store.save(1, {"member": [1]})
+    store.clear()
+    assert not store.path.exists()
+
+def test_interrupted_harvest_resumes_after_last_completed_page(stub):
+    stations = [{"id": "%03i" % i} for i in range(95)]
+    failing = {"offset": 41}
+    def route(query, headers):
+        if int(query["offset"]) >= failing["offset"]:
+            return 500, {}, b""
+        return 200, {}, stubPage(stations, query, "results")
+    stub.routes["monitoring-points"] = route
+    client = Client(stubConfig(stub, monitoring_points_per_page=10, checkpoint=True))
+    with pytest.raises(Exception):
+        client.getMonitoringPointsWithPagination(output_dir="results")
+    interrupted = stub.count("monitoring-points")
+    failing["offset"] = 1000
+    client = Client(stubConfig(stub, monitoring_points_per_page=10, checkpoint=True, resume=True))
+    result = client.getMonitoringPointsWithPagination(output_dir="results")
+    assert [item["id"] for item in result["results"]] == [item["id"] for item in stations]
+    # offsets 41 to 91
+    assert stub.count("monitoring-points") - interrupted == 6
+    # the checkpoint of a complete harvest is removed
+    assert not len(list(Path("results").glob("checkpoints/*/*.json")))
+
+@pytest.mark.parametrize("adaptive_page_size", [False, True])
+def test_resume_reads_completed_pages(server, catalog, adaptive_page_size):
+    # pages of several observed properties are merged, longer than the limit
+    observed_properties = sorted(catalog.timeseries_by_property.keys())[:3]
+    config = {"timeseries_per_page": 20, "timeseries_max": 10000, "adaptive_page_size": adaptive_page_size, "page_size_min": 10, "page_size_max": 100}
+    client = Client(makeConfig(server, checkpoint=True, **config))
+    key = dict(harvest="timeseries", view=client.config["view"], monitoringPoint=None, observedProperty=observed_properties, beginPosition=None, endPosition=None, provider=None, per_page=client.getPageSizeKey("timeseries"))
+    full = [page for offset, page in client.iterTimeseriesPages(observedProperty=observed_properties, checkpoint=client.getCheckpointStore("results", **key))]
+    full_requests = getTimeseriesRequests(server)
+    assert any(len(page["member"]) > 20 for page in full if "member" in page)
+    client = Client(makeConfig(server, checkpoint=True, resume=True, **config))
+    resumed = [page for offset, page in client.iterTimeseriesPages(observedProperty=observed_properties, checkpoint=client.getCheckpointStore("results", **key))]
+    assert getTimeseriesRequests(server) == full_requests
+    assert resumed == full
+
+def test_resume_interrupted_run(server, catalog):
+    observed_properties = sorted(catalog.timeseries_by_property.keys())[:3]
+    config = {"timeseries_per_page": 20, "timeseries_max": 10000}
+    client = Client(makeConfig(server, checkpoint=True, **config))
+    key = dict(harvest="timeseries", view=client.config["view"], monitoringPoint=None, observedProperty=observed_properties, beginPosition=None, endPosition=None, provider=None, per_page=client.getPageSizeKey("timeseries"))
+    pages = client.iterTimeseriesPages(observedProperty=observed_properties, checkpoint=client.getCheckpointStore("results", **key))
+    for i, (offset, page) in enumerate(pages):
+        if i == 2:
+            break
+    pages.close()
+    killed_requests = getTimeseriesRequests(server)
+    client = Client(makeConfig(server, checkpoint=True, resume=True, **config))
+    resumed = client.getTimeseriesWithPagination(observedProperty=observed_properties, output_dir="results", has_data=False)
+    resumed_requests = getTimeseriesRequests(server) - killed_requests
+    client = Client(makeConfig(server, **config))
+    full = client.getTimeseriesWithPagination(observedProperty=observed_properties, has_data=False)
+    full_requests = getTimeseriesRequests(server) - killed_requests - resumed_requests
+    assert resumed_requests < full_requests
+    assert resumed_requests + killed_requests >= full_requests
+    assert resumed == full
+
+def test_resume_tiled_harvest(server):
+    config = {"monitoring_points_per_page": 50, "tiled_harvest": True, "max_workers": 4}
+    client = Client(makeConfig(server, checkpoint=True, **config))
+    full = client.getMonitoringPointsWithPagination(output_dir="results")
+    full_requests = getMonitoringPointsRequests(server)
+    # a previous run left its checkpoint behind
+    key = dict(harvest="monitoringPoints", view=client.config["view"], bbox=[None, None, None, None], country=None, provider=None, per_page=client.getPageSizeKey("monitoring_points"), tiled=True)
+    list(client.iterMonitoringPointsPages(checkpoint=client.getCheckpointStore("results", **key)))
+    client = Client(makeConfig(server, checkpoint=True, resume=True, **config))
+    resumed = client.getMonitoringPointsWithPagination(output_dir="results")
+    assert getMonitoringPointsRequests(server) == 2 * full_requests
+    assert resumed["results"] == full["results"]
@@ -0,0 +1,40 @@
+from page_sizer import PageSizer
+from whos_client import Client
+from conftest import stubConfig, stubPage
+
+def test_limit_follows_target_latency():
+    sizer = PageSizer("timeseries", 100, min_limit=10, max_limit=1000, target_latency=2)
+    sizer.update(100, 100, 0.5, 1000)
+    # at most doubled per page
+    assert sizer.limit == 200
+    sizer.update(200, 200, 8, 2000)
+    assert sizer.limit == 100
+    sizer.update(100, 100, 2.5, 1000)
+    assert sizer.limit == 80
+    # short (last) pages don't change it
+    sizer.update(80, 3, 0.01, 30)
+    assert sizer.limit == 80
+    assert sizer.sizes == [100, 200, 100, 80]
+
+def test_limit_is_capped():
+    sizer = PageSizer("timeseries", 100, min_limit=10, max_limit=150, target_latency=2, max_bytes=5000)
+    sizer.update(100, 100, 0.1, 1000)
+    assert sizer.limit == 150
+    # 100 bytes per item
+    sizer.update(150, 150, 0.1, 15000)
+    assert sizer.limit == 50
+    sizer.update(50, 50, 100, 5000)
+    assert sizer.limit == 25
+    sizer.shrink(25)
+    assert sizer.limit == 12 and sizer.max_limit == 12
+    sizer.update(12, 12, 0.1, 1200)
+    assert sizer.limit == 12
+
+def test_adaptive_pages_neither_overlap_nor_leave_gaps(stub):
+    stations = [{"id": "%03i" % i} for i in range(95)]
+    stub.routes["monitoring-points"] = lambda query, headers: (200, {}, stubPage(stations, query, "results"))
+    client = Client(stubConfig(stub, monitoring_points_per_page=10, adaptive_page_size=True, page_size_min=5, page_size_max=40, page_target_latency=10))
+    result = client.getMonitoringPointsWithPagination()
+    assert [item["id"] for item in result["results"]] == [item["id"] for item in stations]
+    # 10, 20, 40, 40
+    assert stub.count("monitoring-points") == 4
@@ -0,0 +1,74 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import HostGovernor, getGovernor, default_limits
+from whos_client import Client
+from conftest import stubConfig
+
+def test_requests_are_spaced_by_rate():
+    governor = HostGovernor("stub", rate=20, burst=1, max_in_flight=8)
+    start = time.monotonic()
+    for i in range(6):
+        governor.acquire()
+        governor.release(200)
+    # the first one from the bucket, then one every 50 ms
+    assert time.monotonic() - start >= 0.23
+
+def test_throttle_halves_rate_and_pauses():
+    governor = HostGovernor("stub", rate=10, burst=10, max_in_flight=8)
+    governor.throttle(0.2)
+    assert governor.rate == 5
+    start = time.monotonic()
+    governor.wait()
+    assert time.monotonic() - start >= 0.19
+    governor.throttle()
+    governor.throttle()
+    assert governor.rate == 1.25
+    # additive recovery
+    governor.slots.acquire()
+    governor.release(200)
+    assert governor.rate == 1.75
+    governor.slots.acquire()
+    governor.release(429)
+    assert governor.rate == 1.75
+
+def test_governor_by_host():
+    rate_limits = {"whos.example": {"rate": 5, "max_in_flight": 2}, "*": {"rate": 1}}
+    governor = getGovernor("https://whos.example/gs-service/x", rate_limits)
+    assert getGovernor("https://whos.example/other", rate_limits) is governor
+    assert governor.max_rate == 5 and governor.burst == default_limits["burst"]
+    other = getGovernor("https://other.example/", rate_limits)
+    assert other is not governor and other.max_rate == 1
+    assert getGovernor("https://other.example/", None) is None
+    assert getGovernor("https://other.example/", {"whos.example": {}}) is None
+
+def test_requests_in_flight_are_bounded(stub):
+    in_flight = {"now": 0, "max": 0}
+    lock = threading.Lock()
+    def route(query, headers):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        time.sleep(0.1)
+        with lock:
+            in_flight["now"] -= 1
+        return 200, {}, {"member": []}
+    stub.routes["timeseries"] = route
+    # separate clients share the governor of the host
+    clients = [Client(stubConfig(stub, rate_limits={"127.0.0.1": {"rate": 1000, "burst": 1000, "max_in_flight": 2}})) for i in range(2)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: clients[i % 2].getTimeseries(observedProperty="P%i" % i), range(8)))
+    assert results == [{"member": []}] * 8
+    assert in_flight["max"] == 2
+
+def test_throttling_response_slows_down_host(stub):
+    responses = [(429, {"Retry-After": "1"}, b""), (200, {}, {"member": [{"id": "A"}]})]
+    stub.routes["timeseries"] = lambda query, headers: responses.pop(0)
+    client = Client(stubConfig(stub, retries=2, rate_limits={"*": {"rate": 100, "burst": 100}}))
+    start = time.monotonic()
+    assert client.getTimeseries(observedProperty="P") == {"member": [{"id": "A"}]}
+    assert time.monotonic() - start >= 0.99
+    assert stub.count("timeseries") == 2
+    governor = getGovernor(stub.url, {"*": {}})
+    # halved, then one successful response
+    assert governor.rate == 55
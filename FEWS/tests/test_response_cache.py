@@ -0,0 +1,82 @@
+import time
+from whos_client import Client
+from response_cache import ResponseCache
+from conftest import stubConfig
+
+def makeRoute(body : dict, etag : str = '"v1"'):
+    """Route answering 304 to a request with a matching If-None-Match"""
+    def route(query, headers):
+        if headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag}, body
+    return route
+
+def test_fresh_response_is_read_from_cache(stub):
+    stub.routes["timeseries"] = makeRoute({"member": [{"id": "A"}]})
+    client = Client(stubConfig(stub, cache_dir="cache"))
+    first = client.getTimeseries(observedProperty="P")
+    client = Client(stubConfig(stub, cache_dir="cache"))
+    second = client.getTimeseries(observedProperty="P")
+    assert first == second == {"member": [{"id": "A"}]}
+    assert stub.count("timeseries") == 1
+    # other parameters are other entries
+    client.getTimeseries(observedProperty="Q")
+    assert stub.count("timeseries") == 2
+
+def test_stale_response_is_revalidated(stub):
+    stub.routes["timeseries"] = makeRoute({"member": [{"id": "A"}]})
+    client = Client(stubConfig(stub, cache_dir="cache", cache_ttl={"timeseries": 0}))
+    client.getTimeseries(observedProperty="P")
+    assert client.getTimeseries(observedProperty="P") == {"member": [{"id": "A"}]}
+    name, query, headers = stub.requests[-1]
+    assert headers["If-None-Match"] == '"v1"'
+    # a changed response replaces the entry
+    stub.routes["timeseries"] = makeRoute({"member": [{"id": "B"}]}, etag='"v2"')
+    assert client.getTimeseries(observedProperty="P") == {"member": [{"id": "B"}]}
+    assert stub.count("timeseries") == 3
+
+def test_ttl_by_endpoint(tmp_path):
+    cache = ResponseCache(tmp_path / "cache", ttl={"timeseries": 60}, default_ttl=0)
+    assert cache.isFresh({"endpoint": "timeseries", "stored": time.time() - 30})
+    assert not cache.isFresh({"endpoint": "timeseries", "stored": time.time() - 90})
+    assert not cache.isFresh({"endpoint": "monitoring-points", "stored": time.time()})
+
+def test_least_recently_used_entries_are_evicted(stub):
+    stub.routes["timeseries"] = lambda query, headers: (200, {}, {"member": [{"id": query["observedProperty"] * 100}]})
+    client = Client(stubConfig(stub, cache_dir="cache", cache_max_bytes=250))
+    client.getTimeseries(observedProperty="P")
+    client.getTimeseries(observedProperty="Q")
+    client.getTimeseries(observedProperty="R")
+    assert client.cache.total_bytes <= 250
+    client.getTimeseries(observedProperty="R")
+    assert stub.count("timeseries") == 3
+    client.getTimeseries(observedProperty="P")
+    assert stub.count("timeseries") == 4
+
+def evictAfterGet(monkeypatch):
+    """Removes the body of each entry right after ResponseCache.get reads it, as a concurrent eviction would"""
+    get = ResponseCache.get
+    def getEvicted(self, key):
+        entry = get(self, key)
+        (self.cache_dir / ("%s.body" % key)).unlink(missing_ok=True)
+        return entry
+    monkeypatch.setattr(ResponseCache, "get", getEvicted)
+
+def test_entry_evicted_after_get_is_a_miss(stub, monkeypatch):
+    stub.routes["timeseries"] = makeRoute({"member": [{"id": "A"}]})
+    client = Client(stubConfig(stub, cache_dir="cache"))
+    client.getTimeseries(observedProperty="P")
+    evictAfterGet(monkeypatch)
+    assert client.getTimeseries(observedProperty="P") == {"member": [{"id": "A"}]}
+    assert stub.count("timeseries") == 2
+    name, query, headers = stub.requests[-1]
+    assert "If-None-Match" not in headers
+
+def test_entry_evicted_while_revalidating_is_requested_again(stub, monkeypatch):
+    stub.routes["timeseries"] = makeRoute({"member": [{"id": "A"}]})
+    client = Client(stubConfig(stub, cache_dir="cache", cache_ttl={"timeseries": 0}))
+    client.getTimeseries(observedProperty="P")
+    evictAfterGet(monkeypatch)
+    assert client.getTimeseries(observedProperty="P") == {"member": [{"id": "A"}]}
+    # 304, then without validators
+    assert [request[2].get("If-None-Match") for request in stub.requests] == [None, '"v1"', None]
@@ -0,0 +1,74 @@
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from single_flight import SingleFlight
+from page_sizer import measureResponses
+from whos_client import Client
+from whos_async_client import AsyncClient
+from conftest import stubConfig
+
+def test_key_is_normalized():
+    single_flight = SingleFlight()
+    assert single_flight.key("u", {"a": 1, "b": None, "c": 2}) == single_flight.key("u", {"c": 2, "a": 1})
+    assert single_flight.key("u", {"a": 1}) != single_flight.key("u", {"a": 2})
+
+def test_concurrent_calls_are_coalesced():
+    single_flight = SingleFlight()
+    calls = []
+    def function():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"member": [1, 2]}
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda i: single_flight.do("k", function), range(5)))
+    assert len(calls) == 1
+    assert results == [{"member": [1, 2]}] * 5
+    # every caller gets its own copy
+    assert len(set(id(result) for result in results)) == 5
+    # a later call is not coalesced
+    single_flight.do("k", function)
+    assert len(calls) == 2 and not len(single_flight.calls)
+
+def test_error_is_raised_to_every_caller():
+    single_flight = SingleFlight()
+    def function():
+        time.sleep(0.2)
+        raise Exception("failed")
+    def call(i):
+        with pytest.raises(Exception, match="failed"):
+            single_flight.do("k", function)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(call, range(3)))
+
+def route(query, headers):
+    time.sleep(0.2)
+    return 200, {}, {"member": [{"id": "A"}]}
+
+def test_identical_timeseries_requests_are_sent_once(stub):
+    stub.routes["timeseries"] = route
+    clients = [Client(stubConfig(stub)) for i in range(2)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda i: clients[i % 2].getTimeseries(observedProperty="P", monitoringPoint=None), range(4)))
+    assert results == [{"member": [{"id": "A"}]}] * 4
+    assert stub.count("timeseries") == 1
+    results[0]["member"].clear()
+    assert results[1] == {"member": [{"id": "A"}]}
+
+def test_identical_async_timeseries_requests_are_sent_once(stub):
+    stub.routes["timeseries"] = route
+    async def main():
+        async with AsyncClient(stubConfig(stub)) as client:
+            return await asyncio.gather(*[client.getTimeseries(observedProperty="P") for i in range(4)] + [client.getTimeseries(observedProperty="Q")])
+    results = asyncio.run(main())
+    assert results == [{"member": [{"id": "A"}]}] * 5
+    assert stub.count("timeseries") == 2
+
+def test_response_size_is_recorded_for_every_caller(stub):
+    stub.routes["timeseries"] = route
+    client = Client(stubConfig(stub))
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(lambda i: measureResponses(client.getTimeseries, observedProperty="P"), range(3)))
+    assert stub.count("timeseries") == 1
+    assert [size for result, size in results] == [len(json.dumps({"member": [{"id": "A"}]}))] * 3
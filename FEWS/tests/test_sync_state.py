@@ -0,0 +1,133 @@
+import json
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import pandas
+import pytest
+from mock_server import MockCatalog, MockServer
+from sync_state import SyncState
+from whos_client import Client
+from conftest import makeConfig
+
+@pytest.fixture
+def sync_server():
+    """Server of a catalog of its own, the tests change the end of its series"""
+    with open(Path(__file__).resolve().parent.parent / "config.json") as f:
+        observed_properties = json.load(f)["fews_observed_properties"][:6]
+    catalog = MockCatalog(stations=100, series=400, a5_stations=1, a5_series=1, observed_properties=observed_properties, seed=1)
+    server = MockServer(catalog)
+    server.start()
+    yield server, catalog
+    server.shutdown()
+    server.server_close()
+
+def getObservedProperties(catalog : MockCatalog, count : int) -> list:
+    return [variable[0] for variable in catalog.variables[:count]]
+
+def readTables(output_dir : Path) -> dict:
+    return {path.name: path.read_text() for path in sorted(output_dir.glob("*.csv"))}
+
+def test_write_table_skips_unchanged_content(tmp_path):
+    table = pandas.DataFrame({"CHILD_ID": ["a", "b"], "VALUE": [1, 2]})
+    sync_state = SyncState(tmp_path)
+    assert sync_state.writeTable("P.csv", table, key="CHILD_ID")
+    assert sync_state.changelog["tables"]["P.csv"]["added"] == ["a", "b"]
+    sync_state.save()
+    modified = (tmp_path / "P.csv").stat().st_mtime_ns
+    sync_state = SyncState(tmp_path)
+    assert not sync_state.writeTable("P.csv", table, key="CHILD_ID")
+    assert sync_state.changelog["files"]["written"] == [] and sync_state.changelog["files"]["unchanged"] == ["P.csv"]
+    assert (tmp_path / "P.csv").stat().st_mtime_ns == modified
+
+def test_write_table_reports_row_changes(tmp_path):
+    SyncState(tmp_path).writeTable("P.csv", pandas.DataFrame({"CHILD_ID": ["a", "b"], "VALUE": [1, 2]}), key="CHILD_ID")
+    sync_state = SyncState(tmp_path)
+    assert sync_state.writeTable("P.csv", pandas.DataFrame({"CHILD_ID": ["b", "c"], "VALUE": [3, 4]}), key="CHILD_ID")
+    assert sync_state.changelog["tables"]["P.csv"] == {"added": ["c"], "removed": ["a"], "changed": ["b"]}
+    assert (tmp_path / "P.csv").read_text() == "CHILD_ID,VALUE\nb,3\nc,4\n"
+
+def test_watermarks_report_updated_series(tmp_path):
+    sync_state = SyncState(tmp_path)
+    sync_state.setWatermarks({"A|P": "2026-10-01T00:00:00Z", "B|P": "2026-10-01T00:00:00Z"})
+    sync_state.save()
+    sync_state = SyncState(tmp_path)
+    assert sync_state.previous["watermarks"]["A|P"] == "2026-10-01T00:00:00Z"
+    sync_state.setWatermarks({"A|P": "2026-10-02T00:00:00Z", "B|P": "2026-10-01T00:00:00Z", "C|P": "2026-10-02T00:00:00Z"})
+    assert sync_state.changelog["updated_series"] == ["A|P"]
+    sync_state.save()
+    with open(tmp_path / "changelog.json") as f:
+        changelog = json.load(f)
+    assert changelog["previous_run"] is not None and changelog["updated_series"] == ["A|P"]
+
+def test_write_table_ignores_row_order(tmp_path):
+    table = pandas.DataFrame({"CHILD_ID": ["c", "a", "b"], "VALUE": [3, 1, 2]})
+    sync_state = SyncState(tmp_path)
+    assert sync_state.writeTable("P.csv", table, key="CHILD_ID")
+    sync_state = SyncState(tmp_path)
+    assert not sync_state.writeTable("P.csv", table.iloc[[2, 0, 1]], key="CHILD_ID")
+    assert sync_state.changelog["files"]["unchanged"] == ["P.csv"]
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_incremental_run_requests_only_advanced_series(sync_server, pipeline):
+    server, catalog = sync_server
+    output_dir = Path("results")
+    observed_properties = getObservedProperties(catalog, 4)
+    client = Client(makeConfig(server, timeseries_per_page=20, timeseries_max=10000))
+    client.makeFewsTables(output_dir=output_dir, observedProperty=observed_properties, incremental=True, pipeline=pipeline)
+    full = server.stats()["by_endpoint"]
+    tables = readTables(output_dir)
+    # one series advances
+    now = datetime.now(timezone.utc)
+    item = next(item for item in catalog.timeseries_by_property[observed_properties[0]] if (now - timedelta(days=100)).strftime("%Y-%m-%d") < item["phenomenonTime"]["end"] < now.strftime("%Y-%m-%d"))
+    item["phenomenonTime"]["end"] = (now + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    client = Client(makeConfig(server, timeseries_per_page=20, timeseries_max=10000))
+    result = client.makeFewsTables(output_dir=output_dir, observedProperty=observed_properties, incremental=True, pipeline=pipeline)
+    incremental = {endpoint: count - full[endpoint] for endpoint, count in server.stats()["by_endpoint"].items() if "timeseries" in endpoint}
+    assert sum(incremental.values()) < sum(count for endpoint, count in full.items() if "timeseries" in endpoint)
+    assert "%s|%s" % (item["featureOfInterest"]["href"], item["observedProperty"]["href"]) in result["changelog"]["updated_series"]
+    with open(output_dir / "sync_state.json") as f:
+        state = json.load(f)
+    assert state["watermarks"]["%s|%s" % (item["featureOfInterest"]["href"], item["observedProperty"]["href"])] == item["phenomenonTime"]["end"]
+    # the series that were not requested again are kept
+    assert readTables(output_dir).keys() == tables.keys()
+    Path("full").mkdir()
+    assert set(result["timeseries"]["CHILD_ID"]) == set(client.makeFewsTables(output_dir="full", observedProperty=observed_properties)["timeseries"]["CHILD_ID"])
+
+def test_incremental_run_removes_tables_without_series(sync_server):
+    server, catalog = sync_server
+    output_dir = Path("results")
+    observed_properties = getObservedProperties(catalog, 3)
+    client = Client(makeConfig(server, timeseries_per_page=20, timeseries_max=10000))
+    first = client.makeFewsTables(output_dir=output_dir, observedProperty=observed_properties, incremental=True)
+    client = Client(makeConfig(server, timeseries_per_page=20, timeseries_max=10000))
+    second = client.makeFewsTables(output_dir=output_dir, observedProperty=observed_properties[:1], incremental=True)
+    removed = sorted("%s.csv" % variable for variable in set(first["timeseries"]["variableName"]) - set(second["timeseries"]["variableName"]))
+    assert len(removed)
+    assert sorted(second["changelog"]["files"]["removed"]) == removed
+    assert not any((output_dir / filename).exists() for filename in removed)
+
+def test_write_table_compares_duplicate_keys_as_multisets(tmp_path):
+    table = pandas.DataFrame({"CHILD_ID": ["a", "b", "a", "b"], "VALUE": [2, 1, 1, 1]})
+    SyncState(tmp_path).writeTable("P.csv", table, key="CHILD_ID")
+    assert (tmp_path / "P.csv").read_text() == "CHILD_ID,VALUE\na,1\na,2\nb,1\nb,1\n"
+    sync_state = SyncState(tmp_path)
+    assert not sync_state.writeTable("P.csv", table.iloc[[3, 2, 1, 0]], key="CHILD_ID")
+    sync_state = SyncState(tmp_path)
+    assert sync_state.writeTable("P.csv", pandas.DataFrame({"CHILD_ID": ["a", "a", "b"], "VALUE": [1, 2, 1]}), key="CHILD_ID")
+    assert sync_state.changelog["tables"]["P.csv"] == {"added": [], "removed": [], "changed": ["b"]}
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_repeated_incremental_run_changes_nothing(sync_server, pipeline):
+    server, catalog = sync_server
+    output_dir = Path("results")
+    observed_properties = getObservedProperties(catalog, 4)
+    client = Client(makeConfig(server, timeseries_per_page=20, timeseries_max=10000))
+    client.makeFewsTables(output_dir=output_dir, observedProperty=observed_properties, incremental=True, pipeline=pipeline)
+    tables = readTables(output_dir)
+    modified = {path.name: path.stat().st_mtime_ns for path in output_dir.glob("*.csv")}
+    client = Client(makeConfig(server, timeseries_per_page=20, timeseries_max=10000))
+    changelog = client.makeFewsTables(output_dir=output_dir, observedProperty=observed_properties, incremental=True, pipeline=pipeline)["changelog"]
+    assert changelog["files"]["written"] == [] and changelog["files"]["removed"] == []
+    assert sorted(changelog["files"]["unchanged"]) == sorted(tables.keys())
+    assert all(not any(len(rows) for rows in changes.values()) for changes in changelog["tables"].values())
+    assert readTables(output_dir) == tables
+    assert {path.name: path.stat().st_mtime_ns for path in output_dir.glob("*.csv")} == modified
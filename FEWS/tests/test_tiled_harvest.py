@@ -0,0 +1,41 @@
+import random
+from whos_client import Client
+from conftest import stubConfig, stubPage
+
+def makeStations(count : int, bbox : tuple, seed : int = 0) -> list:
+    random_ = random.Random(seed)
+    west, south, east, north = bbox
+    return [{"id": "%03i" % i, "shape": {"coordinates": [random_.uniform(west, east), random_.uniform(south, north)]}} for i in range(count)]
+
+def makeRoute(stations : list):
+    """monitoring-points filtered by the (inclusive) bounding box of the query"""
+    def route(query, headers):
+        west, south, east, north = [float(query[key]) for key in ["west", "south", "east", "north"]]
+        items = [item for item in stations if west <= item["shape"]["coordinates"][0] <= east and south <= item["shape"]["coordinates"][1] <= north]
+        return 200, {}, stubPage(items, query, "results")
+    return route
+
+def getIds(client : Client, bbox : tuple) -> list:
+    west, south, east, north = bbox
+    return [item["id"] for item in client.getMonitoringPointsWithPagination(west=west, south=south, east=east, north=north)["results"]]
+
+def test_full_tiles_are_split(stub):
+    bbox = (-60, -35, -50, -25)
+    # plus stations on the borders of the first quadrants
+    stations = makeStations(200, bbox) + [{"id": "border%i" % i, "shape": {"coordinates": coordinates}} for i, coordinates in enumerate([[-55, -30], [-55, -33], [-57.5, -30]])]
+    stub.routes["monitoring-points"] = makeRoute(stations)
+    client = Client(stubConfig(stub, monitoring_points_per_page=30, monitoring_points_max=50, tiled_harvest=True, max_workers=4))
+    ids = getIds(client, bbox)
+    assert sorted(ids) == sorted(item["id"] for item in stations)
+    assert stub.count("monitoring-points") > 5
+
+def test_full_tiles_at_max_depth_are_paginated(stub):
+    bbox = (-60, -35, -50, -25)
+    # all in one quadrant
+    stations = makeStations(100, (-60, -35, -55.5, -30.5))
+    stub.routes["monitoring-points"] = makeRoute(stations)
+    client = Client(stubConfig(stub, monitoring_points_per_page=30, tiled_harvest=True, tile_max_depth=1))
+    ids = getIds(client, bbox)
+    assert sorted(ids) == sorted(item["id"] for item in stations)
+    # the full tile, its four quadrants, then the first one paginated (offsets 1, 31, 61, 91)
+    assert stub.count("monitoring-points") == 9
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+from whos_client import Client
+from conftest import makeConfig
+
+def makeMember(station : str, observed_property : str, duration : str, end : str) -> dict:
+    return {
+        "featureOfInterest": {"href": station},
+        "observedProperty": {"href": observed_property},
+        "phenomenonTime": {"begin": "2000-01-01T00:00:00Z", "end": end},
+        "result": {"defaultPointMetadata": {"uom": "mm", "aggregationDuration": duration}}
+    }
+
+def test_merge_timeseries_keeps_active_duplicate():
+    client = Client({"begin_days": 180})
+    now = datetime.now(timezone.utc)
+    stale = makeMember("A", "P", "PT1H", (now - timedelta(days=400)).strftime("%Y-%m-%dT%H:%M:%SZ"))
+    active = makeMember("A", "P", "PT1H", now.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    merged = client.mergeTimeseries([{"member": [stale]}, {"member": [active]}])
+    assert merged["member"] == [active]
+    assert client.filterByAvailability(merged["member"], client.threshold_begin_date) == [active]
+
+def test_merge_timeseries_keeps_each_time_step():
+    client = Client()
+    hourly = makeMember("A", "P", "PT1H", "2025-09-01T00:00:00Z")
+    monthly = makeMember("A", "P", "P1M", "2026-10-01T00:00:00Z")
+    merged = client.mergeTimeseries([{"member": [hourly, monthly]}, {"member": [hourly]}])
+    assert merged["member"] == [hourly, monthly]
+
+def test_timeseries_multi_keeps_active_series(server, catalog):
+    client = Client(makeConfig(server, timeseries_per_page=100, timeseries_max=2000))
+    observed_properties = sorted(set(item["observedProperty"]["href"] for item in catalog.timeseries))
+    result = client.getTimeseriesWithPagination(observedProperty=observed_properties, has_data=True)
+    expected = set(client.getMemberKey(item) for item in client.filterByAvailability(catalog.timeseries, client.threshold_begin_date))
+    assert set(client.getMemberKey(item) for item in result["member"]) == expected
+
+def test_adaptive_pagination_logs_last_page(server, catalog, caplog):
+    client = Client(makeConfig(server, timeseries_per_page=100, timeseries_max=10000, adaptive_page_size=True, page_size_min=10, page_size_max=1000))
+    caplog.set_level("DEBUG")
+    offsets = [offset for offset, page in client.iterTimeseriesPages()]
+    last_page = [record.getMessage() for record in caplog.records if "last page" in record.getMessage()]
+    assert len(offsets) < len(catalog.timeseries) // 100
+    assert len(last_page) == 1
+    assert last_page[0].startswith("timeseries: last page at offset %i " % offsets[-1])
+
+def test_adaptive_pagination_measures_response_bytes(server, catalog, monkeypatch):
+    import page_sizer
+    sizes = []
+    update = page_sizer.PageSizer.update
+    def recordUpdate(self, limit, items, latency, size):
+        sizes.append(size)
+        return update(self, limit, items, latency, size)
+    monkeypatch.setattr(page_sizer.PageSizer, "update", recordUpdate)
+    client = Client(makeConfig(server, timeseries_per_page=100, timeseries_max=10000, adaptive_page_size=True, page_size_min=10, page_size_max=1000, max_workers=4))
+    observed_properties = sorted(set(item["observedProperty"]["href"] for item in catalog.timeseries))[:3]
+    list(client.iterTimeseriesPages(observedProperty=observed_properties))
+    assert len(sizes) and all(size > 0 for size in sizes)
+    assert sum(sizes) == server.stats()["bytes"]
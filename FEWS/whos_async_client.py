@@ -0,0 +1,290 @@
+from __future__ import annotations
+import json
+import time
+import asyncio
+import random
+import logging
+from collections import deque
+from pathlib import Path
+import aiohttp
+from whos_client import Client
+from rate_limiter import getGovernor
+from single_flight import single_flight
+from metrics import getEndpointName
+from lazy_import import lazyImport
+pandas = lazyImport("pandas")
+
+class AsyncClient(Client):
+    """asyncio version of whos_client.Client
+
+    getMonitoringPoints, getTimeseries, getTimeseriesMulti, getVariableMapping, getMonitoringPointsWithPagination and getTimeseriesWithPagination are coroutines with the same parameters as in Client. Requests go through one aiohttp session per client (connection pool of pool_maxsize connections per host) and at most max_concurrency of them are in flight at any time. The FEWS conversion methods (monitoringPointsToFEWS, timeseriesToFEWS, groupTimeseriesByVar, ...) are inherited unchanged. The response cache, checkpoints and stream mode are not available, nor are the synchronous harvest helpers (makeFewsTables, iterMonitoringPointsPages, iterTimeseriesPages)
+
+    Usage
+    -----
+        async with AsyncClient(config) as client:
+            stations = await client.getMonitoringPointsWithPagination(fews_output="results/mp.csv")
+    """
+
+    default_config = dict(Client.default_config, max_concurrency = 100)
+
+    def __init__(self,config: dict = None):
+        """
+        Parameters
+        ----------
+        config : dict
+            Configuration parameters as in Client, plus max_concurrency (maximum number of requests in flight)
+        """
+        super().__init__(config)
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        """Creates the HTTP session. Must be called from within the event loop (or use the client as an async context manager)"""
+        if self.session is not None:
+            return
+        connector = aiohttp.TCPConnector(limit=self.config["max_concurrency"], limit_per_host=self.config["pool_maxsize"])
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.config["timeout"]), headers={"Accept-Encoding": "gzip, deflate"})
+        self.semaphore = asyncio.Semaphore(self.config["max_concurrency"])
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        self.session = None
+        self.semaphore = None
+
+    async def request(self, url : str, params : dict = None) -> str:
+        """Sends a GET request through the client session, retrying with exponential backoff and jitter on connection errors and on the retry_status codes (honoring Retry-After). If rate_limits has an entry for the host, requests also go through its process-wide governor (see rate_limiter)
+
+        Parameters
+        ----------
+        url : str
+            Request url
+        params : dict
+            Query parameters
+
+        Returns
+        -------
+        str
+            Response body
+        """
+        if self.session is None:
+            await self.open()
+        params = {key: str(value).lower() if type(value) == bool else str(value) for key, value in (params or {}).items() if value is not None}
+        retry_status = self.config["retry_status"] if "retry_status" in self.config else [429, 500, 502, 503, 504]
+        governor = getGovernor(url, self.config["rate_limits"])
+        endpoint = getEndpointName(url)
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            delay = self.config["backoff_factor"] * 2 ** attempt + random.uniform(0, self.config["backoff_jitter"])
+            try:
+                async with self.semaphore:
+                    if governor is not None:
+                        # the governor is shared with the threaded clients, waited for on the event loop
+                        await governor.acquireAsync()
+                    status_code = None
+                    try:
+                        async with self.session.get(url, params=params) as response:
+                            status_code = response.status
+                            retry_after = response.headers.get("Retry-After")
+                            retry_after = float(retry_after) if retry_after is not None and retry_after.isdigit() else None
+                            if governor is not None and (response.status == 429 or (response.status == 503 and retry_after is not None)):
+                                governor.throttle(retry_after)
+                            if response.status in retry_status and attempt < self.config["retries"]:
+                                if retry_after is not None:
+                                    delay = retry_after
+                                logging.debug("status code %s, retrying in %.1f s" % (response.status, delay))
+                            elif response.status >= 400:
+                                self.metrics.observeRequest(endpoint, response.status, time.perf_counter() - start, 0, attempt)
+                                raise Exception("request failed, status code: %s" % response.status)
+                            else:
+                                text = await response.text()
+                                self.metrics.observeRequest(endpoint, response.status, time.perf_counter() - start, len(text.encode()), attempt)
+                                return text
+                    finally:
+                        if governor is not None:
+                            governor.release(status_code)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.config["retries"]:
+                    self.metrics.observeRequest(endpoint, "error", time.perf_counter() - start, 0, attempt)
+                    raise Exception("request failed: %s" % str(e))
+                logging.debug("request error: %s, retrying in %.1f s" % (str(e), delay))
+            attempt = attempt + 1
+            await asyncio.sleep(delay)
+
+    async def requestJSON(self, url : str, params : dict = None):
+        return json.loads(await self.request(url, params))
+
+    async def getMonitoringPoints(self, view: str = Client.default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, offset: int = None, limit: int = None, output: str = None, country: str = None, provider : str = None) -> dict:
+        """Retrieves monitoring points as a geoJSON document from the timeseries API. See Client.getMonitoringPoints"""
+        url, params = self.getMonitoringPointsRequest(view=view,east=east,west=west,north=north,south=south,offset=offset,limit=limit,country=country,provider=provider)
+        result = json.loads(await self.request(url, params))
+        if output is not None:
+            try:
+                f = open(output,"w")
+            except:
+                raise Exception("Couldn't open file %s for writing" % output)
+            f.write(json.dumps(result, indent=2, ensure_ascii=False))
+            f.close()
+        return result
+
+    async def getTimeseries(self, view: str = Client.default_config["view"], monitoringPoint: str = None, observedProperty: str = None, beginPosition: str = None, endPosition: str = None, offset: int = 1, limit: int = 10, output: str = None, has_data = False, provider : str = None) -> dict:
+        """Retrieves timeseries as a geoJSON document from the timeseries API. See Client.getTimeseries"""
+        url, params = self.getTimeseriesRequest(view=view,monitoringPoint=monitoringPoint,observedProperty=observedProperty,beginPosition=beginPosition,endPosition=endPosition,offset=offset,limit=limit,provider=provider)
+        # identical concurrent requests share one response
+        result = await single_flight.doAsync(single_flight.key(url, params), self.requestJSON, url, params)
+        if has_data and "member" in result:
+            result["member"] = self.filterByAvailability(result["member"],self.threshold_begin_date)
+        if output is not None:
+            try:
+                f = open(output,"w")
+            except:
+                raise Exception("Couldn't open file %s for writing" % output)
+            f.write(json.dumps(result, indent=2, ensure_ascii=False))
+            f.close()
+        return result
+
+    async def getTimeseriesMulti(self, view: str = Client.default_config["view"], monitoringPoint: list or str = None, observedProperty: list or str = None, beginPosition: str = None, endPosition: str = None, offset: int = 1, limit: int = 10, output: str = None, has_data=False, provider : str = None, max_workers : int = None) -> dict:
+        """Retrieves timeseries for every combination of monitoringPoint and observedProperty, all requests dispatched at once (bounded by max_concurrency). max_workers is ignored. See Client.getTimeseriesMulti"""
+        queries = self.getTimeseriesQueries(monitoringPoint, observedProperty, provider, beginPosition)
+        if not len(queries):
+            return await self.getTimeseries( view = view, beginPosition = beginPosition, endPosition = endPosition, offset = offset, limit = limit, output = output, has_data=has_data, provider = provider)
+        responses = await asyncio.gather(*[self.getTimeseries(view, endPosition = endPosition, offset = offset, limit = limit, has_data=has_data, **query) for query in queries])
+        result = self.mergeTimeseries(responses)
+        if output is not None:
+            try:
+                f = open(output,"w")
+            except:
+                raise Exception("Couldn't open file %s for writing" % output)
+            f.write(json.dumps(result, indent=2, ensure_ascii=False))
+            f.close()
+        return result
+
+    async def getVariableMapping(self,view=Client.default_config["view"],output=None,output_xml=None,refresh=False) -> pandas.DataFrame:
+        """Retrieves variable mapping from WHOS CUAHSI API (waterML 1.1). See Client.getVariableMapping"""
+        if refresh or output_xml is not None or view not in self.variable_mappings:
+            var_map = None if refresh or output_xml is not None else self.readVariableMapping(view)
+            if var_map is None:
+                url = "%s/gs-service/services/essi/token/%s/view/%s/cuahsi_1_1.asmx" % (self.config["url"], self.config["token"], view)
+                var_map = self.parseVariableMapping(await self.request(url, {"request": "GetVariables"}), output_xml=output_xml)
+                self.writeVariableMapping(view, var_map)
+            self.setVariableMapping(view, var_map)
+        data_frame = self.variable_mappings[view]["data_frame"]
+        if output is not None:
+            f = open(output,"w")
+            f.write(data_frame.to_csv(index=False))
+            f.close()
+        return data_frame
+
+    async def iterPages(self, getPage, offsets, isLastPage, max_workers : int = 1):
+        """Async version of Client.iterPages: awaits up to max_workers pages at a time and yields (offset, page) in offset order until isLastPage(offset, page)"""
+        offsets = iter(offsets)
+        pending = deque()
+        def schedule():
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append((offset, asyncio.ensure_future(getPage(offset))))
+        for _ in range(max(1, max_workers)):
+            schedule()
+        try:
+            while len(pending):
+                offset, task = pending.popleft()
+                page = await task
+                if isLastPage(offset, page):
+                    yield offset, page
+                    return
+                schedule()
+                yield offset, page
+        finally:
+            for offset, task in pending:
+                task.cancel()
+
+    async def getMonitoringPointsWithPagination(self, view: str = Client.default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, json_output: str = None, fews_output: str = None, save_geojson : bool = False, output_dir : str = "",country: str = None, provider : str = None, max_workers : int = None) -> dict:
+        """Retrieves monitoring points using pagination, requesting up to max_workers pages at a time. See Client.getMonitoringPointsWithPagination"""
+        output_dir = Path(output_dir)
+        max_workers = max_workers if max_workers is not None else self.config["max_workers"]
+        stations = pandas.DataFrame(columns= ["STATION_ID", "STATION_NAME", "STATION_SHORTNAME", "TOOLTIP", "LATITUDE", "LONGITUDE", "ALTITUDE", "COUNTRY", "ORGANIZATION", "SUBBASIN"])
+        results = []
+        async def getPage(i):
+            logging.debug("getMonitoringPoints offset: %i" % i)
+            output = output_dir / ("monitoringPointsResponse_%i.json" % i) if save_geojson else None
+            return await self.getMonitoringPoints(view=view,offset=i,limit=self.config["monitoring_points_per_page"],west = west, south = south, east = east, north = north, output=output, country = country, provider = provider)
+        def isLastPage(offset, monitoringPoints):
+            return "results" not in monitoringPoints or len(monitoringPoints["results"]) < self.config["monitoring_points_per_page"]
+        async for i, monitoringPoints in self.iterPages(getPage,range(1,self.config["monitoring_points_max"],self.config["monitoring_points_per_page"]),isLastPage,max_workers=max_workers):
+            if "results" not in monitoringPoints:
+                logging.debug("no monitoring points found")
+                break
+            results.extend(monitoringPoints["results"])
+            if fews_output:
+                stations_i = self.monitoringPointsToFEWS(monitoringPoints)
+                stations= pandas.concat([stations,stations_i])
+        result = {
+            # "type": "featureCollection",
+            "results": results
+        }
+        if json_output:
+            f = open(json_output,"w")
+            f.write(json.dumps(result, indent=2, ensure_ascii=False))
+            f.close()
+        if fews_output:
+            f = open(fews_output,"w")
+            f.write(stations.to_csv())
+            f.close()
+            return stations
+        else:
+            return result
+
+    async def getTimeseriesWithPagination(self, view: str = Client.default_config["view"], monitoringPoint: list or str = None, observedProperty: list or str = None, beginPosition: str = None, endPosition: str = None, json_output: str = None, fews_output: str = None, save_geojson : bool = False, output_dir : str = "", grouped : bool = False, has_data : bool = True, provider : str = None, max_workers : int = 1) -> dict:
+        """Retrieves timeseries using pagination, requesting up to max_workers pages at a time (each page is itself a concurrent getTimeseriesMulti). See Client.getTimeseriesWithPagination"""
+        output_dir = Path(output_dir)
+        member = []
+        timeseries_fews = []
+        if grouped:
+            await self.getVariableMapping(view)
+            var_map = self.getVariableIndex(view)
+        async def getPage(i):
+            logging.debug("getTimeseriesMulti, offset: %i" % i)
+            output = output_dir / ("timeseriesResponse_%i.json" % i) if save_geojson else None
+            return await self.getTimeseriesMulti(view=view,offset=i,monitoringPoint=monitoringPoint,observedProperty=observedProperty,beginPosition=beginPosition,endPosition=endPosition,limit=self.config["timeseries_per_page"],output=output,has_data=False, provider = provider)
+        def isLastPage(offset, timeseries):
+            return "member" not in timeseries or len(timeseries["member"]) < self.config["timeseries_per_page"]
+        async for i, timeseries in self.iterPages(getPage,range(1,self.config["timeseries_max"],self.config["timeseries_per_page"]),isLastPage,max_workers=max_workers):
+            if "member" not in timeseries:
+                logging.debug("No timeseries found")
+                break
+            if has_data:
+                timeseries["member"] = self.filterByAvailability(timeseries["member"],self.threshold_begin_date)
+            logging.debug("Offset: %i, length: %i, got %i timeseries after filtering" % (i,self.config["timeseries_per_page"],len(timeseries["member"])))
+            timeseries_fews.append(self.timeseriesToFEWS(timeseries))
+            member.extend(timeseries["member"])
+        timeseries_fews = pandas.concat(timeseries_fews) if len(timeseries_fews) else None
+        result = {
+            # "type": "featureCollection",
+            "member": member
+        }
+        if json_output:
+            f = open(json_output,"w")
+            f.write(json.dumps(result, indent=2, ensure_ascii=False))
+            f.close()
+        if fews_output:
+            if grouped:
+                timeseries_fews_grouped = self.groupTimeseriesByVar(timeseries_fews,var_map,output_dir=output_dir)
+                f = open(fews_output,"w")
+                f.write(timeseries_fews_grouped.to_csv())
+                f.close()
+                return timeseries_fews_grouped
+            else:
+                f = open(fews_output,"w")
+                f.write(timeseries_fews.to_csv())
+                f.close()
+                return timeseries_fews
+        else:
+            return result
@@ -1,24 +1,56 @@
+from __future__ import annotations
 import requests
 import json
-import pandas
-import isodate
 from datetime import timedelta, datetime
-from lxml import etree
 from warnings import warn
 from typing import Union
 from pathlib import Path
-from geopandas import read_file as gpd_read_file
-from shapely.geometry import Point
+from lazy_import import lazyImport
+from subbasins import SubBasinIndex, SubBasinCache
 import pytz
 import re
 import sys
 import logging
-logging.basicConfig(filename="log/whos_client.log",level=logging.DEBUG,format="%(asctime)s %(levelname)s %(message)s")
-handler = logging.FileHandler("log/whos_client.log","w+")
+import threading
+import contextvars
+import time
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from http_session import getSession
+from response_cache import ResponseCache
+from sync_state import SyncState
+from checkpoint import CheckpointStore
+from page_sizer import PageSizer, measureResponses, recordResponseSize
+from single_flight import single_flight
+from metrics import Metrics, stage, timed, getEndpointName, getRetries, writeMetrics
+from profiler import Profiler
+from compact import compactFrame
+from columnar import writeColumnar, writeColumnarRecords, isColumnarMissing, getPyarrow, getColumnarPaths, columnar_formats
+# heavy libraries load on first use
+pandas = lazyImport("pandas")
+isodate = lazyImport("isodate")
+geopandas = lazyImport("geopandas")
+etree = lazyImport("lxml.etree")
+
+@lru_cache(maxsize=None)
+def isoDurationToHours(aggregationDuration : str) -> float:
+    # ACcording to: ISO 8601 (https://tc39.es/proposal-temporal/docs/duration.html)
+    duration = isodate.parse_duration(aggregationDuration)
+    if isinstance(duration,isodate.Duration):
+        return duration.totimedelta(datetime(1970,1,1)).total_seconds() / 3600
+    else:
+        return duration.total_seconds() / 3600
 
 class Client:
     """Functions for metadata retrieval from WHOS using timeseries API
     plus functions to convert from native format (geoJSON) to FEWS csv format
+
+    Attributes
+    ----------
+    metrics : Metrics
+        Request counts, bytes, retries and latency by endpoint and per-stage timings of the client (see metrics.Metrics)
     
     Methods
     -------
@@ -26,8 +58,10 @@ class Client:
         Retrieves monitoring points as a geoJSON document from WHOS timeseries API
     getTimeseries(view: str = "whos-plata", monitoringPoint: str = None, observedProperty: str = None, beginPosition: str = None, endPosition: str = None, offset: int = 1, limit: int = 10, output: str = None))
         Retrieves timeseries as a geoJSON document from WHOS timeseries API
-    getVariableMapping(view='whos-plata', output=None, output_xml=None)
-        Retrieves variable mapping from WHOS CUAHSI API
+    getVariableMapping(view='whos-plata', output=None, output_xml=None, refresh=False)
+        Retrieves variable mapping from WHOS CUAHSI API (once per view)
+    getVariableIndex(view='whos-plata')
+        Returns variable mapping as a dict indexed by variableCode
     monitoringPointsToFEWS(monitoringPoints, output=None)
         Converts monitoringPoints geoJSON to FEWS table 
     timeseriesToFEWS(timeseries, output=None)
@@ -36,6 +70,8 @@ class Client:
         Groups timeseries by observedVariable, optionally using FEWS convention
     makeFewsTables(output_dir='', save_geojson=False)
         Retrieves WHOS metadata and writes out FEWS tables
+    profile(output=None, mode='deterministic')
+        Context manager profiling the enclosed calls
     """
     
     default_config = {
@@ -47,7 +83,37 @@ class Client:
         "timeseries_per_page": 1000,
         "view": "whos-plata",
         "basins_geojson_file": "cuencas/cuencas.geojson",
-        "begin_days": 180 
+        "begin_days": 180,
+        "max_workers": 1,
+        "timeout": 120,
+        "pool_maxsize": 10,
+        "retries": 5,
+        "backoff_factor": 0.5,
+        "backoff_jitter": 0.5,
+        "cache_dir": None,
+        "cache_ttl": {
+            "monitoring-points": 86400,
+            "timeseries": 3600,
+            "cuahsi_1_1.asmx": 604800
+        },
+        "cache_max_bytes": 1073741824,
+        "var_map_dir": None,
+        "var_map_ttl": 604800,
+        "pipeline_queue_size": 4,
+        "checkpoint": False,
+        "resume": False,
+        "adaptive_page_size": False,
+        "page_size_min": 100,
+        "page_size_max": 5000,
+        "page_target_latency": 10,
+        "page_max_bytes": 52428800,
+        "tiled_harvest": False,
+        "tile_max_depth": 6,
+        "rate_limits": None,
+        "subbasin_cache": True,
+        "compact_frames": False,
+        "columnar_formats": [],
+        "sync_full_days": 7
     }
     
     fews_var_map = {
@@ -180,18 +246,116 @@ class Client:
         Parameters
         ----------
         config : dict
-            Configuration parameters: url, token, monitoring_points_max, monitoring_points_per_page, timeseries_max, timeseries_per_page 
+            Configuration parameters: url, token, monitoring_points_max, monitoring_points_per_page, timeseries_max, timeseries_per_page, max_workers, timeout, pool_maxsize, retries, backoff_factor, backoff_jitter, cache_dir (enables the response cache), cache_ttl (seconds by endpoint), cache_max_bytes, var_map_dir (persist variable mapping, defaults to cache_dir), var_map_ttl, pipeline_queue_size, checkpoint (persist completed pages in output_dir/checkpoints), resume (reuse pages completed by a previous interrupted run), adaptive_page_size (adjust the page size to page_target_latency seconds), page_size_min, page_size_max, page_max_bytes, tiled_harvest (harvest monitoring points by bounding box tiles, see iterMonitoringPointsTiles), tile_max_depth, rate_limits (rate, burst, max_in_flight by host, shared by all clients of the process. See rate_limiter.getGovernor), subbasin_cache (makeFewsTables keeps a subbasin lookup table in output_dir, see openSubBasinCache)
         """
         
         self.config = self.default_config
         if config is not None:
             for key in config:
                 self.config[key] = config[key]
-        self.basins = gpd_read_file(self.config["basins_geojson_file"])
+        self._basins = None
+        self.basins_index = None
+        self.subbasin_cache = None
+        self.cache = ResponseCache(self.config["cache_dir"], ttl=self.config["cache_ttl"], max_bytes=self.config["cache_max_bytes"]) if self.config["cache_dir"] is not None else None
         self.threshold_begin_date = datetime.now() - timedelta(days=self.config["begin_days"])
         self.threshold_begin_date = pytz.utc.localize(self.threshold_begin_date)
-        self.fews_observed_properties = set(self.config["fews_observed_properties"]) if "fews_observed_properties" in self.config else self.fews_observed_properties 
+        self.fews_observed_properties = set(self.config["fews_observed_properties"]) if "fews_observed_properties" in self.config else set(self.fews_observed_properties)
+        self.variable_mappings = {}
+        self.variable_mappings_lock = threading.Lock()
+        self.metrics = Metrics("whos")
+        if len(self.config["columnar_formats"]):
+            # fail before harvesting if pyarrow is missing or a format is invalid
+            getPyarrow()
+            getColumnarPaths("", self.config["columnar_formats"])
+
+    @property
+    def basins(self):
+        """Basins layer (basins_geojson_file), read on first use"""
+        if self._basins is None:
+            self._basins = geopandas.read_file(self.config["basins_geojson_file"])
+        return self._basins
+
+    def profile(self, output : str = None, mode : str = "deterministic", interval : float = 0.01, top : int = 20) -> Profiler:
+        """Context manager profiling the enclosed calls (see profiler.Profiler)
+
+        Usage
+        -----
+            with client.profile("log/run"):
+                client.makeFewsTables(output_dir="results")
+
+        Parameters
+        ----------
+        output : str
+            Output path prefix: writes <output>.pstats (deterministic mode) and <output>.collapsed (flamegraph collapsed stacks). None to only log the top-N summary
+        mode : str
+            deterministic (cProfile) or sampling
+        interval : float
+            Sampling interval in seconds
+        top : int
+            Number of hot functions logged
+
+        Returns
+        -------
+        Profiler
+        """
+        return Profiler(output, mode=mode, interval=interval, top=top)
     
+    def request(self, url : str, params : dict = None) -> requests.Response:
+        """Sends a GET request through the shared session of the url host (connection pool, compression, timeout and retries with backoff)
+
+        If the response cache is enabled (cache_dir), fresh cached responses are returned without a request and stale ones are revalidated with ETag/Last-Modified when available
+        
+        Parameters
+        ----------
+        url : str
+            Request url
+        params : dict
+            Query parameters
+        
+        Returns
+        -------
+        requests.Response
+        """
+        headers = {}
+        if self.cache is not None:
+            # the token is part of the url path: key on what follows it
+            endpoint = url.split("/view/",1)[-1]
+            key = self.cache.key(endpoint, params)
+            entry = self.cache.get(key)
+            if entry is not None and self.cache.isFresh(entry):
+                response = self.cache.response(key, entry)
+                if response is not None:
+                    logging.debug("cache hit: %s" % endpoint)
+                    self.metrics.observeCacheHit(getEndpointName(url))
+                    recordResponseSize(len(response.content))
+                    return response
+                # evicted meanwhile: a miss
+                entry = None
+            headers = self.cache.validators(entry)
+        start = time.perf_counter()
+        try:
+            response = getSession(url, self.config).get(url, params=params, headers=headers, timeout=self.config["timeout"])
+        except requests.exceptions.RequestException as e:
+            self.metrics.observeRequest(getEndpointName(url), "error", time.perf_counter() - start)
+            raise Exception("request failed: %s" % str(e))
+        self.metrics.observeRequest(getEndpointName(url), response.status_code, time.perf_counter() - start, len(response.content), getRetries(response))
+        if self.cache is not None and response.status_code == 304 and entry is not None:
+            cached = self.cache.response(key, entry)
+            if cached is None:
+                # evicted while revalidating: request it again, without validators
+                logging.debug("cache: %s evicted while revalidating" % endpoint)
+                return self.request(url, params)
+            logging.debug("cache revalidated: %s" % endpoint)
+            self.cache.refresh(key, entry)
+            recordResponseSize(len(cached.content))
+            return cached
+        if(response.status_code >= 400):
+            raise Exception("request failed, status code: %s" % response.status_code)
+        if self.cache is not None:
+            self.cache.put(key, endpoint.rsplit("/",1)[-1], response)
+        recordResponseSize(len(response.content))
+        return response
+
     def getMonitoringPoints(self, view: str = default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, offset: int = None, limit: int = None, output: str = None, country: str = None, provider : str = None) -> dict:
         """Retrieves monitoring points as a geoJSON document from the timeseries API
         
@@ -224,23 +388,8 @@ class Client:
             A dict containing geoJSON data
         """
         
-        params = locals()
-        del params["view"]
-        del params["output"]
-        del params["self"]
-        for key in ["east","west","north","south","limit","offset","country","provider"]:
-            if params[key] == None:
-                del params[key]
-        params["outputProperties"] = "country,monitoringPointOriginalIdentifier"
-        url = "%s/gs-service/services/essi/token/%s/view/%s/timeseries-api/monitoring-points" % (self.config["url"], self.config["token"], view)
-        logging.debug("url: %s" % url)
-        logging.debug(str({"params": params}))
-        try:
-            response = requests.get(url, params)
-        except:
-            raise Exception("request failed")
-        if(response.status_code >= 400):
-            raise Exception("request failed, status code: %s" % response.status_code)
+        url, params = self.getMonitoringPointsRequest(view=view,east=east,west=west,north=north,south=south,offset=offset,limit=limit,country=country,provider=provider)
+        response = self.request(url, params)
         if output is not None:
             try: 
                 f = open(output,"w")
@@ -278,26 +427,11 @@ class Client:
             A dict containing geoJSON data
         """
         
-        params = locals()
-        del params["view"]
-        del params["output"]
-        del params["self"]
-        del params["has_data"]
-        for key in ["monitoringPoint","observedProperty","beginPosition","endPosition","limit","offset","provider"]:
-            if params[key] == None:
-                del params[key]
-        url = "%s/gs-service/services/essi/token/%s/view/%s/timeseries-api/timeseries" % (self.config["url"], self.config["token"], view)
-        # print("url: %s" % url)
-        logging.debug("%s - %s?%s" % (str(datetime.now()), url, "&".join([ "%s=%s" % (key, params[key]) for key in params])))
-        try:
-            response = requests.get(url, params)
-        except:
-            raise Exception("request failed")
-        if(response.status_code >= 400):
-            raise Exception("request failed, status code: %s" % response.status_code)
+        url, params = self.getTimeseriesRequest(view=view,monitoringPoint=monitoringPoint,observedProperty=observedProperty,beginPosition=beginPosition,endPosition=endPosition,offset=offset,limit=limit,provider=provider)
+        # identical concurrent requests share one response. Its size counts for every caller (adaptive page size, see measureResponses)
+        result, size = single_flight.do(single_flight.key(url, params), measureResponses, lambda: self.request(url, params).json())
+        recordResponseSize(size)
         # filter out features with no data
-        # xprint("%s - Elapsed: %s" % (str(datetime.now()),str(response.elapsed)))
-        result = response.json()
         if has_data and "member" in result:
             result["member"] = self.filterByAvailability(result["member"],self.threshold_begin_date) 
         if output is not None:
@@ -309,6 +443,34 @@ class Client:
             f.close()
         return result
     
+    def getMonitoringPointsRequest(self, view: str = default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, offset: int = None, limit: int = None, country: str = None, provider : str = None) -> tuple:
+        """Returns the url and query parameters of a getMonitoringPoints request"""
+        params = locals()
+        del params["view"]
+        del params["self"]
+        for key in ["east","west","north","south","limit","offset","country","provider"]:
+            if params[key] == None:
+                del params[key]
+        params["outputProperties"] = "country,monitoringPointOriginalIdentifier"
+        url = "%s/gs-service/services/essi/token/%s/view/%s/timeseries-api/monitoring-points" % (self.config["url"], self.config["token"], view)
+        logging.debug("url: %s" % url)
+        logging.debug(str({"params": params}))
+        return url, params
+
+    def getTimeseriesRequest(self, view: str = default_config["view"], monitoringPoint: str = None, observedProperty: str = None, beginPosition: str = None, endPosition: str = None, offset: int = 1, limit: int = 10, provider : str = None) -> tuple:
+        """Returns the url and query parameters of a getTimeseries request"""
+        params = locals()
+        del params["view"]
+        del params["self"]
+        for key in ["monitoringPoint","observedProperty","beginPosition","endPosition","limit","offset","provider"]:
+            if params[key] == None:
+                del params[key]
+        url = "%s/gs-service/services/essi/token/%s/view/%s/timeseries-api/timeseries" % (self.config["url"], self.config["token"], view)
+        # print("url: %s" % url)
+        logging.debug("%s - %s?%s" % (str(datetime.now()), url, "&".join([ "%s=%s" % (key, params[key]) for key in params])))
+        return url, params
+
+    @timed("convert_stations")
     def monitoringPointsToFEWS(self,monitoringPoints : Union[str, dict],output=None): 
         """Converts monitoringPoints JSON to FEWS table
         
@@ -330,6 +492,7 @@ class Client:
             with open(monitoringPoints,"r") as f: 
                 monitoringPoints = json.load(f)
         rows = []
+        coordinates = []
         for item in monitoringPoints["results"]:
             monitoring_point_parameters = {}
             for i in item["parameter"]:
@@ -345,12 +508,17 @@ class Client:
                 "TYPE": None,
                 "COUNTRY": monitoring_point_parameters["country"] if "country" in monitoring_point_parameters.keys() else None,
                 "ORGANIZATION": self.getOrganizationCode(item["relatedParty"][0]["organisationName"]) if len(item["relatedParty"]) else "WHOS",
-                "SUBBASIN": self.getSubBasin(item["shape"]["coordinates"]),
+                "SUBBASIN": None,
                 "ORIGINAL_STATION_ID" : re.sub("^.*:","",monitoring_point_parameters["identifier"]) if "identifier" in monitoring_point_parameters.keys() else None
             }
             row["PARENT_ID"] = "%s_%s_%s" % (row["COUNTRY"].upper()[0:2] if row["COUNTRY"] is not None else "", row["ORGANIZATION"], str(row["ORIGINAL_STATION_ID"]))
             rows.append(row)
+            coordinates.append(item["shape"]["coordinates"])
         data_frame = pandas.DataFrame(rows)
+        if len(rows):
+            data_frame["SUBBASIN"] = self.getSubBasins(coordinates)
+        if self.config["compact_frames"]:
+            data_frame = compactFrame(data_frame)
         if output is not None:
             try: 
                 f = open(output,"w")
@@ -361,15 +529,61 @@ class Client:
         return data_frame
     
     def getSubBasin(self,coordinates):
-        # def get_region(lon,lat,getNotation=False):
-        st0 = Point(coordinates[0],coordinates[1])
-        subbasin = None
-        for i in range(0,len(self.basins.geometry)):
-            if st0.within(self.basins.geometry[i]):
-                # print("is within subbasin %s" % self.basins.nombre_2[i])
-                subbasin = self.basins.nombre_3[i]
-        return subbasin
+        return self.getSubBasins([coordinates])[0]
+
+    @timed("subbasin")
+    def getSubBasins(self,coordinates : list) -> list:
+        """Assigns subbasin (basins nombre_3) to a list of [longitude, latitude] coordinates, looking them up first in the subbasin table if open (see openSubBasinCache), else using a spatial index built once per basins layer
+        
+        Parameters
+        ----------
+        coordinates : list
+            List of [longitude, latitude(, altitude)]
+        
+        Returns
+        -------
+        list
+            Subbasin name of each point (None if not within any basin). For overlapping basins the last match wins
+        """
+        if self.subbasin_cache is not None:
+            return self.subbasin_cache.getSubBasins(coordinates, self.computeSubBasins)
+        return self.computeSubBasins(coordinates)
+
+    def computeSubBasins(self,coordinates : list) -> list:
+        """Assigns subbasins with the geometry tests, see getSubBasins"""
+        if self.basins_index is None:
+            self.basins_index = SubBasinIndex(self.basins)
+        return self.basins_index.getSubBasins(coordinates)
+
+    def openSubBasinCache(self,output_dir : str) -> SubBasinCache:
+        """Makes getSubBasins look up coordinates in the subbasin table of output_dir (subbasin_cache.json) before the geometry tests, if subbasin_cache is set. The table is discarded when basins_geojson_file changes. Call subbasin_cache.save() to persist new entries
+
+        Returns
+        -------
+        SubBasinCache
+            None if subbasin_cache is not set
+        """
+        if self.config["subbasin_cache"]:
+            self.subbasin_cache = SubBasinCache(Path(output_dir) / "subbasin_cache.json", self.config["basins_geojson_file"])
+        return self.subbasin_cache
+
+    def writeColumnar(self,data_frame : pandas.DataFrame, path : str) -> list:
+        """Writes data_frame in each of columnar_formats (parquet, arrow) next to its CSV, adding the format suffix to path (i.e. results/locations -> results/locations.parquet). Requires pyarrow
+
+        Returns
+        -------
+        list
+            Written files (none if columnar_formats is empty)
+        """
+        with stage(self.metrics, "write"):
+            return writeColumnar(data_frame, path, self.config["columnar_formats"])
+
+    def writeColumnarRecords(self,records : list, path : str) -> list:
+        """Writes raw API records (monitoring points results or timeseries members) in each of columnar_formats as nested columns, adding the format suffix to the path of their JSON output (i.e. results/timeseries.json -> results/timeseries.json.parquet), see writeColumnar"""
+        with stage(self.metrics, "write"):
+            return writeColumnarRecords(records, path, self.config["columnar_formats"])
     
+    @timed("convert_timeseries")
     def timeseriesToFEWS(self,timeseries : Union[str,dict], output=None, stations=None):
         """Converts timeseries geoJSON to FEWS table
         
@@ -391,43 +605,29 @@ class Client:
         DataFrame
             A data frame of the time series in FEWS format
         """
-        if stations is not None:
-            if stations.index.name != 'STATION_ID':
-                stations = stations.set_index("STATION_ID")
-
          # timeseries: str => path to timeseries geojson file or dict => same already parsed into dict 
         if isinstance(timeseries,str):
             with open(timeseries,"r") as f: 
                 timeseries = json.load(f)
-        rows = []
-        for item in timeseries["member"]:
-            timestep_hour = self.isoDurationToHours(item["result"]["defaultPointMetadata"]["aggregationDuration"]) if "aggregationDuration" in item["result"]["defaultPointMetadata"] else self.isoDurationToHours(item["result"]["metadata"]["intendedObservationSpacing"]) if "metadata" in item["result"] and "intendedObservationSpacing" in item["result"]["metadata"] else None
-            row = {
-                "STATION_ID": item["featureOfInterest"]["href"],
-                "EXTERNAL_LOCATION_ID": item["featureOfInterest"]["href"],
-                "EXTERNAL_PARAMETER_ID": item["observedProperty"]["href"],
-                "TIMESTEP_HOUR": timestep_hour,
-                "UNIT": item["result"]["defaultPointMetadata"]["uom"] if "uom" in item["result"]["defaultPointMetadata"] else None,
-                "IMPORT_SOURCE": "WHOS",
-                "IMPORT": True
+        members = timeseries["member"]
+        if len(members):
+            station_ids = [item["featureOfInterest"]["href"] for item in members]
+            data_frame = pandas.DataFrame({
+                "STATION_ID": station_ids,
+                "EXTERNAL_LOCATION_ID": station_ids,
+                "EXTERNAL_PARAMETER_ID": [item["observedProperty"]["href"] for item in members],
+                "TIMESTEP_HOUR": [self.getTimestepHours(item["result"]) for item in members],
+                "UNIT": [item["result"]["defaultPointMetadata"]["uom"] if "uom" in item["result"]["defaultPointMetadata"] else None for item in members],
+                "IMPORT_SOURCE": ["WHOS"] * len(members),
+                "IMPORT": [True] * len(members)
                 # THRESHOLD_1   THRESHOLD_2	THRESHOLD_3	THRESHOLD_4 -> not present in WHOS
-            }
+            })
             if stations is not None:
-                if row["STATION_ID"] not in stations.index:
-                    logging.warning("STATION_ID %s not found in stations" % row["STATION_ID"])
-                    continue
-                row["STATION_NAME"] =  stations["STATION_NAME"][row["STATION_ID"]]
-                row["LATITUDE"] = stations["LATITUDE"][row["STATION_ID"]]
-                row["LONGITUDE"] = stations["LONGITUDE"][row["STATION_ID"]]
-                row["ALTITUDE"] = stations["ALTITUDE"][row["STATION_ID"]]
-                row["TYPE"] = stations["TYPE"][row["STATION_ID"]]
-                row["COUNTRY"] = stations["COUNTRY"][row["STATION_ID"]]
-                row["ORGANIZATION"] = stations["ORGANIZATION"][row["STATION_ID"]]
-                row["SUBBASIN"] = stations["SUBBASIN"][row["STATION_ID"]]
-                row["ORIGINAL_STATION_ID"] = stations["ORIGINAL_STATION_ID"][row["STATION_ID"]]
-                row["PARENT_ID"] = "%s_%s_%s"  % (row["COUNTRY"].upper()[0:2] if row["COUNTRY"] is not None else "", row["ORGANIZATION"], row["ORIGINAL_STATION_ID"])
-            rows.append(row)
-        data_frame = pandas.DataFrame(rows)
+                data_frame = self.addStationMetadata(data_frame, stations)
+        else:
+            data_frame = pandas.DataFrame([])
+        if self.config["compact_frames"]:
+            data_frame = compactFrame(data_frame)
         if output is not None:
             try: 
                 f = open(output,"w")
@@ -436,17 +636,34 @@ class Client:
             f.write(data_frame.to_csv(index=False))
             f.close()
         return data_frame
+
+    def getTimestepHours(self,result : dict) -> float:
+        if "aggregationDuration" in result["defaultPointMetadata"]:
+            return self.isoDurationToHours(result["defaultPointMetadata"]["aggregationDuration"])
+        if "metadata" in result and "intendedObservationSpacing" in result["metadata"]:
+            return self.isoDurationToHours(result["metadata"]["intendedObservationSpacing"])
+        return None
+
+    def addStationMetadata(self,timeseries_fews : pandas.DataFrame, stations : pandas.DataFrame) -> pandas.DataFrame:
+        """Joins station metadata (result of monitoringPointsToFEWS) to timeseries FEWS table (result of timeseriesToFEWS without stations) on STATION_ID. Timeseries of stations not found are dropped"""
+        if stations.index.name != 'STATION_ID':
+            stations = stations.set_index("STATION_ID")
+        found = timeseries_fews["STATION_ID"].isin(stations.index)
+        for station_id in timeseries_fews["STATION_ID"][~found]:
+            logging.warning("STATION_ID %s not found in stations" % station_id)
+        station_columns = ["STATION_NAME", "LATITUDE", "LONGITUDE", "ALTITUDE", "TYPE", "COUNTRY", "ORGANIZATION", "SUBBASIN", "ORIGINAL_STATION_ID"]
+        stations = stations.loc[~stations.index.duplicated(), station_columns]
+        data_frame = timeseries_fews[found].reset_index(drop=True).join(stations, on="STATION_ID")
+        data_frame["PARENT_ID"] = ["%s_%s_%s" % (country.upper()[0:2] if isinstance(country,str) else "", organization, original_station_id) for country, organization, original_station_id in zip(data_frame["COUNTRY"], data_frame["ORGANIZATION"], data_frame["ORIGINAL_STATION_ID"])]
+        return data_frame
     
     def isoDurationToHours(self,aggregationDuration):
-        # ACcording to: ISO 8601 (https://tc39.es/proposal-temporal/docs/duration.html)
-        duration = isodate.parse_duration(aggregationDuration)
-        if isinstance(duration,isodate.Duration):
-            return duration.totimedelta(datetime(1970,1,1)).total_seconds() / 3600
-        else:
-            return duration.total_seconds() / 3600
+        return isoDurationToHours(aggregationDuration)
     
-    def getVariableMapping(self,view=default_config["view"],output=None,output_xml=None):
+    def getVariableMapping(self,view=default_config["view"],output=None,output_xml=None,refresh=False):
         """Retrieves variable mapping from WHOS CUAHSI API (waterML 1.1)
+
+        The mapping is fetched once per view and kept in the client variable mapping registry. If var_map_dir (or cache_dir) is configured it is also persisted to disk and reused for var_map_ttl seconds
         
         Parameters
         ----------
@@ -455,30 +672,53 @@ class Client:
         output : string
             Write CSV output into this file
         output_xml : string
-            Write XML output into this file
+            Write XML output into this file. Forces a new request
+        refresh : bool
+            Ignore the registry and persisted mapping and request it again
         
         Returns
         -------
         DataFrame
             A data frame of the mapped observed variables
         """
+        with self.variable_mappings_lock:
+            if refresh or output_xml is not None or view not in self.variable_mappings:
+                var_map = None if refresh or output_xml is not None else self.readVariableMapping(view)
+                if var_map is None:
+                    var_map = self.fetchVariableMapping(view, output_xml=output_xml)
+                    self.writeVariableMapping(view, var_map)
+                self.setVariableMapping(view, var_map)
+            data_frame = self.variable_mappings[view]["data_frame"]
+        if output is not None:
+            f = open(output,"w")
+            f.write(data_frame.to_csv(index=False))
+            f.close()
+        return data_frame
+
+    def getVariableIndex(self,view=default_config["view"]) -> dict:
+        """Returns the variable mapping of view as a dict of {variableName, unitName} indexed by variableCode"""
+        if view not in self.variable_mappings:
+            self.getVariableMapping(view)
+        return self.variable_mappings[view]["index"]
+
+    def fetchVariableMapping(self,view=default_config["view"],output_xml=None) -> list:
+        """Downloads and parses the variable list from WHOS CUAHSI API GetVariables. Returns list of dict"""
         url = "%s/gs-service/services/essi/token/%s/view/%s/cuahsi_1_1.asmx" % (self.config["url"], self.config["token"], view)
         params = {
             "request": "GetVariables"
         }
-        try:
-            response = requests.get(url, params)
-        except:
-            raise Exception("request failed")
-        if(response.status_code >= 400):
-            raise Exception("request failed, status code: %s" % response.status_code)
-        xml_text = response.text.replace("&lt;","<").replace("&gt;",">")
+        response = self.request(url, params)
+        return self.parseVariableMapping(response.text, output_xml=output_xml)
+
+    def parseVariableMapping(self,text : str,output_xml=None) -> list:
+        """Parses a GetVariables SOAP response. Returns list of dict"""
+        xml_text = text.replace("&lt;","<").replace("&gt;",">")
         exml = etree.fromstring(xml_text.encode())
         namespaces = exml.nsmap
         namespaces["his"] = "http://www.cuahsi.org/his/1.1/ws/"
         namespaces["wml"] = "http://www.cuahsi.org/waterML/1.1/"
         variables = exml.xpath("./soap:Body/his:GetVariablesResponse/his:GetVariablesResult/wml:variablesResponse/wml:variables/wml:variable",namespaces=namespaces)
-        var_map = self.default_var_map
+        var_map = list(self.default_var_map)
         for v in variables:
             variableCode = v.find("./wml:variableCode",namespaces=namespaces).text
             variableName = v.find("./wml:variableName",namespaces=namespaces).text
@@ -488,32 +728,71 @@ class Client:
                 "variableName": variableName,
                 "unitName": unitName
             })
-            if variableName in self.fews_var_map:
-                self.fews_observed_properties.add(variableCode)
-        data_frame = pandas.DataFrame(var_map)
         if output_xml is not None:
             f = open(output_xml,"w")
             f.write(xml_text)
             f.close()
-        if output is not None:
-            f = open(output,"w")
-            f.write(data_frame.to_csv(index=False))
-            f.close()
-        return data_frame
-    
-    def groupTimeseriesByVar(self,input_ts,var_map,output_dir=None,fews=False, set_child_id=True): 
+        return var_map
+
+    def setVariableMapping(self,view,var_map : list):
+        index = {}
+        for v in var_map:
+            index[v["variableCode"]] = {
+                "variableName": v["variableName"],
+                "unitName": v["unitName"]
+            }
+            if v["variableName"] in self.fews_var_map:
+                self.fews_observed_properties.add(v["variableCode"])
+        self.variable_mappings[view] = {
+            "data_frame": pandas.DataFrame(var_map),
+            "index": index
+        }
+
+    def getVariableMappingFile(self,view) -> Path:
+        var_map_dir = self.config["var_map_dir"] if self.config["var_map_dir"] is not None else self.config["cache_dir"]
+        if var_map_dir is None:
+            return None
+        return Path(var_map_dir) / ("var_map_%s.json" % view)
+
+    def readVariableMapping(self,view) -> list:
+        var_map_file = self.getVariableMappingFile(view)
+        if var_map_file is None or not var_map_file.exists():
+            return None
+        try:
+            with open(var_map_file,"r") as f:
+                stored = json.load(f)
+        except ValueError:
+            logging.warning("Invalid variable mapping file %s" % var_map_file)
+            return None
+        if datetime.now().timestamp() - stored["stored"] > self.config["var_map_ttl"]:
+            logging.debug("variable mapping file %s expired" % var_map_file)
+            return None
+        return stored["variables"]
+
+    def writeVariableMapping(self,view,var_map : list):
+        var_map_file = self.getVariableMappingFile(view)
+        if var_map_file is None:
+            return
+        var_map_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(var_map_file,"w") as f:
+            json.dump({"stored": datetime.now().timestamp(), "variables": var_map}, f, ensure_ascii=False)
+
+    @timed("group")
+    def groupTimeseriesByVar(self,input_ts,var_map,output_dir=None,fews=False, set_child_id=True, max_workers : int = 1): 
         """Groups timeseries by observedVariable, optionally using FEWS convention
         
         Parameters
         ----------
         input_ts : DataFrame
             Return value of timeseriesToFEWS()
-        var_map : DataFrame
-            Return value of getVariableMapping()
+        var_map : DataFrame or dict
+            Return value of getVariableMapping() or getVariableIndex()
         output_dir : str
-            Write output to this directory
+            Write output to this directory (one csv file per variable)
         fews : bool
             Use FEWS variables naming convention
+        max_workers : int
+            Number of files to write concurrently. Default 1
         
         Returns
         -------
@@ -521,45 +800,57 @@ class Client:
             A data frame of time series grouped by variable name
         """
         timeseries = input_ts.copy()
-        var_dict = {}
-        for i in var_map.index:
-            var_dict[var_map["variableCode"][i]] = {
-                "variableName": var_map["variableName"][i],
-                "unitName": var_map["unitName"][i]
-            }
-        variable_name_column = []
-        unit_column = []
-        for variableCode in timeseries["EXTERNAL_PARAMETER_ID"]:
-            if variableCode not in var_dict:
-                logging.warning("Missing variable code " + variableCode + " from variable map")
-                variable_name_column.append("Unknown")
-                unit_column.append("Unknown")
-            else:
-                variable_name_column.append(var_dict[variableCode]["variableName"])
-                unit_column.append(var_dict[variableCode]["unitName"])
-        timeseries["variableName"] = variable_name_column
-        timeseries["UNIT"] = timeseries["UNIT"].combine_first(pandas.Series(unit_column))
+        if isinstance(var_map,dict):
+            var_dict = var_map
+        else:
+            var_dict = {}
+            for variableCode, variableName, unitName in zip(var_map["variableCode"], var_map["variableName"], var_map["unitName"]):
+                var_dict[variableCode] = {
+                    "variableName": variableName,
+                    "unitName": unitName
+                }
+        variable_codes = timeseries["EXTERNAL_PARAMETER_ID"]
+        known = variable_codes.isin(list(var_dict.keys()))
+        for variableCode in variable_codes[~known].unique():
+            logging.warning("Missing variable code " + variableCode + " from variable map")
+        timeseries["variableName"] = variable_codes.map({code: v["variableName"] for code, v in var_dict.items()}).where(known, "Unknown")
+        timeseries["UNIT"] = timeseries["UNIT"].combine_first(variable_codes.map({code: v["unitName"] for code, v in var_dict.items()}).where(known, "Unknown"))
         if fews:
-            timeseries["variableName"] = [self.fews_var_map[variableName] if variableName in self.fews_var_map else None for variableName in timeseries["variableName"]]
-            timeseries = timeseries[timeseries["variableName"].notnull()]
+            timeseries["variableName"] = timeseries["variableName"].map(self.fews_var_map)
+            timeseries = timeseries[timeseries["variableName"].notnull()].copy()
             if set_child_id:
                 timeseries["CHILD_ID"] = timeseries["PARENT_ID"] + "_WHO_" + timeseries["TIMESTEP_HOUR"].astype(int).astype(str) + "_" + timeseries["variableName"]
         if output_dir is not None:
             output_dir = Path(output_dir)
-            variableNames = set(timeseries["variableName"])
-            for variableName in variableNames:
-                group = timeseries[timeseries["variableName"]==variableName]
-                del group["variableName"]
-                if fews and variableName in self.fews_series_columns:
-                    fews_group = pandas.DataFrame(columns=self.fews_series_columns[variableName])
-                    for column in fews_group.columns:
-                        fews_group[column] = group[column] if column in group else None
-                    group = fews_group
-                f = open(output_dir / ("%s.csv" % variableName),"w")
-                f.write(group.to_csv(index=False))
+            def writeGroup(item):
+                variableName, group = item
+                with self.metrics.stage("write"), open(output_dir / ("%s.csv" % variableName),"w",buffering=1024*1024) as f:
+                    group.to_csv(f, index=False)
+                self.writeColumnar(group, output_dir / variableName)
+            if max_workers > 1:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    list(executor.map(writeGroup, self.iterVariableTables(timeseries, fews=fews)))
+            else:
+                for item in self.iterVariableTables(timeseries, fews=fews):
+                    writeGroup(item)
         return timeseries
 
-    def makeFewsTables(self,output_dir="",save_geojson=False,has_data=True,observedProperty=None,country=None,has_timestep=True,east=None,west=None,north=None,south=None, provider : str = None):
+    def iterVariableTables(self,timeseries_grouped,fews=False):
+        """Splits the result of groupTimeseriesByVar into one table per variable (in FEWS columns if fews)
+
+        Yields
+        ------
+        tuple
+            (variableName, DataFrame)
+        """
+        for variableName, group in timeseries_grouped.groupby("variableName", sort=False):
+            group = group.drop(columns="variableName")
+            if fews and variableName in self.fews_series_columns:
+                group = group.reindex(columns=self.fews_series_columns[variableName])
+            yield variableName, group
+
+    @timed("makeFewsTables")
+    def makeFewsTables(self,output_dir="",save_geojson=False,has_data=True,observedProperty=None,country=None,has_timestep=True,east=None,west=None,north=None,south=None, provider : str = None, pipeline : bool = False, incremental : bool = False, beginPosition : str = None):
         """Retrieves WHOS metadata and writes out FEWS tables
         
         Parameters
@@ -572,6 +863,12 @@ class Client:
         country: str - country code (ISO3)
         has_timestep: bool
             filter out series without timestep. Default True
+        pipeline: bool
+            harvest stations and timeseries concurrently, converting each page to FEWS rows while the next one downloads (see harvestFewsTables). Output tables are the same. Default False
+        incremental: bool
+            delta sync against the previous run in output_dir (see SyncState): the timeseries of each variable are requested from its watermark in the previous run (the series that didn't reach it are taken from the previous run), falling back to a full harvest from the availability threshold date (now - begin_days) when the previous run had other parameters or its last full harvest is older than sync_full_days. Only tables whose content changed are rewritten, tables of variables left without series are removed and changes are recorded in changelog.json. Default False
+        beginPosition: str
+            Temporal interval begin position for timeseries request. Disables the watermarks of incremental mode
         
         Returns
         -------
@@ -579,32 +876,63 @@ class Client:
             dict containing retrieved stations and timeseries in FEWS format
         """
         output_dir = Path(output_dir)
+        # subbasins of known station coordinates are taken from the previous runs
+        self.openSubBasinCache(output_dir)
         # get WHOS-Plata variable mapping table
-        var_map = self.getVariableMapping()
+        with self.metrics.stage("variable_mapping"):
+            var_map = self.getVariableIndex()
         # if observedProperty and provider are both None, sets list of default observed properties to iterate over (to avoid huge load) 
-        observedProperty = observedProperty if observedProperty is not None else None if provider is not None else list(self.fews_observed_properties)
-        monitoringPoints = self.getMonitoringPointsWithPagination(
-            json_output = output_dir / "monitoringPoints.json" if save_geojson else None,
-            country = country,
-            east=east,
-            west=west,
-            north=north,
-            south=south, 
-            provider = provider)
-        stations_fews = self.monitoringPointsToFEWS(monitoringPoints)
-        # get all WHOS-Plata timeseries metadata (using pagination)
-        timeseries = self.getTimeseriesWithPagination(
-            observedProperty=observedProperty, 
-            json_output = Path(output_dir, "timeseries.json") if save_geojson else None, 
-            has_data = has_data,
-            provider = provider)
-        logging.debug("timeseries length: %i" % len(timeseries["member"]))
-        # station_organization = self.getOrganization(timeseries,stations_fews)
-        timeseries_fews = self.timeseriesToFEWS(
-            timeseries, 
-            stations = stations_fews, 
-            output = Path(output_dir, "timeseries.csv") if output_dir is not None and save_geojson else None
-        )
+        observedProperty = observedProperty if observedProperty is not None else None if provider is not None else sorted(self.fews_observed_properties)
+        previous_members = None
+        if incremental:
+            sync_state = SyncState(output_dir)
+            if beginPosition is None:
+                beginPosition = self.threshold_begin_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+                if observedProperty is not None:
+                    # watermarks of the previous run are valid for the same harvest only
+                    query = {"view": self.config["view"], "observedProperty": [observedProperty] if type(observedProperty) == str else list(observedProperty), "country": country, "bbox": [west,south,east,north], "provider": provider, "has_data": has_data, "begin_days": self.config["begin_days"]}
+                    begin_positions = sync_state.getBeginPositions(query, query["observedProperty"], beginPosition, self.config["sync_full_days"])
+                    if begin_positions is not None:
+                        beginPosition = begin_positions
+                        previous_members = sync_state.previous_members
+        members = []
+        if pipeline:
+            with self.metrics.stage("harvest"):
+                stations_fews, timeseries_fews = self.harvestFewsTables(output_dir=output_dir,save_geojson=save_geojson,has_data=has_data,observedProperty=observedProperty,country=country,east=east,west=west,north=north,south=south,provider=provider,beginPosition=beginPosition,members=members,previous_members=previous_members,deduplicate=incremental)
+        else:
+            with self.metrics.stage("fetch_stations"):
+                monitoringPoints = self.getMonitoringPointsWithPagination(
+                    output_dir = output_dir,
+                    json_output = output_dir / "monitoringPoints.json" if save_geojson else None,
+                    country = country,
+                    east=east,
+                    west=west,
+                    north=north,
+                    south=south, 
+                    provider = provider)
+            stations_fews = self.monitoringPointsToFEWS(monitoringPoints)
+            # get all WHOS-Plata timeseries metadata (using pagination)
+            with self.metrics.stage("fetch_timeseries"):
+                timeseries = self.getTimeseriesWithPagination(
+                    output_dir = output_dir,
+                    observedProperty=observedProperty, 
+                    beginPosition=beginPosition,
+                    json_output = Path(output_dir, "timeseries.json") if save_geojson else None, 
+                    has_data = has_data,
+                    provider = provider)
+            if previous_members is not None:
+                timeseries["member"] = timeseries["member"] + self.getUnchangedMembers(previous_members, timeseries["member"], has_data)
+            if incremental:
+                # duplicates are merged within a page only: which ones are left would depend on the page boundaries, i.e. on the series requested
+                timeseries = self.mergeTimeseries([timeseries])
+            logging.debug("timeseries length: %i" % len(timeseries["member"]))
+            members = timeseries["member"]
+            # station_organization = self.getOrganization(timeseries,stations_fews)
+            timeseries_fews = self.timeseriesToFEWS(
+                timeseries, 
+                stations = stations_fews, 
+                output = Path(output_dir, "timeseries.csv") if output_dir is not None and save_geojson else None
+            )
         logging.debug("timeseries_fews length: %i" % len(timeseries_fews))
         timeseries_fews = self.deleteSeriesWithoutTimestep(timeseries_fews) if has_timestep else timeseries_fews  
         logging.debug("timeseries_fews with timestep length: %i" % len(timeseries_fews))
@@ -612,19 +940,140 @@ class Client:
             logging.error("No timeseries found")
             sys.exit("No timeseries found")
         # filter out stations with no timeseries
+        if self.subbasin_cache is not None:
+            self.subbasin_cache.save()
         stations_fews = self.deleteStationsWithNoTimeseries(stations_fews,timeseries_fews)
         stations_fews = self.setOriginalStationId(stations_fews)
         # get organization name from timeseries metadata
-        # save stations to csv
-        f = open(output_dir / "locations.csv","w")
-        f.write(stations_fews.to_csv(index=False))
-        f.close()
         timeseries_fews = self.setOriginalStationId(timeseries_fews)
         # timeseries_fews["PARENT_ID"] = [str(row["COUNTRY"].upper()[0:2] if row["COUNTRY"] is not None else "") + "_" + row["ORGANIZATION"] + "_" + row["STATION_ID"] for i, row in timeseries_fews.iterrows()]
+        if incremental:
+            # write out only what changed since the previous run
+            if sync_state.writeTable("locations.csv", stations_fews, key="STATION_ID") or isColumnarMissing(output_dir / "locations", self.config["columnar_formats"]):
+                self.writeColumnar(stations_fews, output_dir / "locations")
+            timeseries_fews_grouped = self.groupTimeseriesByVar(timeseries_fews,var_map,fews= True)
+            for variableName, table in self.iterVariableTables(timeseries_fews_grouped, fews=True):
+                if sync_state.writeTable("%s.csv" % variableName, table, key="CHILD_ID") or isColumnarMissing(output_dir / variableName, self.config["columnar_formats"]):
+                    self.writeColumnar(table, output_dir / variableName)
+            for filename in sync_state.removeTables():
+                for path in getColumnarPaths(output_dir / Path(filename).stem, list(columnar_formats.keys())).values():
+                    if path.exists():
+                        path.unlink()
+            sync_state.setWatermarks(self.getWatermarks(members))
+            sync_state.setMembers(members)
+            sync_state.save()
+            return {"stations": stations_fews, "timeseries": timeseries_fews_grouped, "changelog": sync_state.changelog}
+        # save stations to csv
+        with self.metrics.stage("write"):
+            f = open(output_dir / "locations.csv","w")
+            f.write(stations_fews.to_csv(index=False))
+            f.close()
+        self.writeColumnar(stations_fews, output_dir / "locations")
         #group timeseries by variable using FEWS variable names and output each group to a separate .csv file
         timeseries_fews_grouped = self.groupTimeseriesByVar(timeseries_fews,var_map,output_dir=output_dir,fews= True) # False)
         return {"stations": stations_fews, "timeseries": timeseries_fews_grouped}
+
+    def getWatermarks(self,members : list) -> dict:
+        """Returns phenomenonTime.end of each timeseries member indexed by 'featureOfInterest|observedProperty'"""
+        return {"%s|%s" % (item["featureOfInterest"]["href"], item["observedProperty"]["href"]): item["phenomenonTime"]["end"] for item in members if "phenomenonTime" in item}
+
+    def getUnchangedMembers(self, previous_members : list, members : list, has_data : bool = True) -> list:
+        """Members of a previous run that were not retrieved again (same key, see getMemberKey), i.e. series whose end didn't reach the watermark of an incremental request. If has_data, those no longer available are left out"""
+        retrieved = set(self.getMemberKey(item) for item in members)
+        unchanged = [item for item in previous_members if self.getMemberKey(item) not in retrieved]
+        return self.filterByAvailability(unchanged, self.threshold_begin_date) if has_data else unchanged
     
+    def harvestFewsTables(self,output_dir="",save_geojson=False,has_data=True,observedProperty=None,country=None,east=None,west=None,north=None,south=None, provider : str = None, beginPosition : str or dict = None, members : list = None, previous_members : list = None, deduplicate : bool = False) -> tuple:
+        """Pipelined retrieval of stations and timeseries in FEWS format, used by makeFewsTables(pipeline=True)
+
+        Stations and timeseries are harvested concurrently. In each stream pages are downloaded in a background stage and handed through a bounded queue (pipeline_queue_size) to the conversion stage, so that page N+1 downloads while page N is converted to FEWS rows. Station metadata is joined to the timeseries once both streams finish
+
+        Parameters
+        ----------
+        members : list
+            If not None, filled with the timeseries members of the output
+        previous_members : list
+            Members of a previous incremental run. Those not retrieved again are added to the output (see getUnchangedMembers)
+        deduplicate : bool
+            Merge duplicate members across pages (see mergeTimeseries), so that the output doesn't depend on the page boundaries. Duplicates within a page are always merged
+
+        Returns
+        -------
+        tuple
+            (stations_fews, timeseries_fews): the same tables monitoringPointsToFEWS and timeseriesToFEWS(stations=...) produce from the full harvest
+        """
+        output_dir = Path(output_dir)
+        stations_checkpoint = self.getCheckpointStore(output_dir, harvest="monitoringPoints", view=self.config["view"], bbox=[west,south,east,north], country=country, provider=provider, per_page=self.getPageSizeKey("monitoring_points"), tiled=self.config["tiled_harvest"])
+        timeseries_checkpoint = self.getCheckpointStore(output_dir, harvest="timeseries", view=self.config["view"], monitoringPoint=None, observedProperty=observedProperty, beginPosition=beginPosition, endPosition=None, provider=provider, per_page=self.getPageSizeKey("timeseries"))
+        def harvestStations():
+            results = []
+            frames = []
+            pages = self.iterMonitoringPointsPages(west=west,south=south,east=east,north=north,country=country,provider=provider,checkpoint=stations_checkpoint)
+            for i, monitoringPoints in self.iterPrefetched(pages):
+                if "results" not in monitoringPoints:
+                    logging.debug("no monitoring points found")
+                    break
+                if save_geojson:
+                    results.extend(monitoringPoints["results"])
+                frames.append(self.monitoringPointsToFEWS(monitoringPoints))
+            if save_geojson:
+                f = open(output_dir / "monitoringPoints.json","w")
+                f.write(json.dumps({"results": results}, indent=2, ensure_ascii=False))
+                f.close()
+                self.writeColumnarRecords(results, output_dir / "monitoringPoints.json")
+            # pages of categoricals with different categories concatenate as object
+            stations_fews = pandas.concat(frames, ignore_index=True) if len(frames) else self.monitoringPointsToFEWS({"results": []})
+            return compactFrame(stations_fews) if self.config["compact_frames"] else stations_fews
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            stations_future = executor.submit(harvestStations)
+            member = members if members is not None else []
+            frames = []
+            member_count = 0
+            pages = self.iterTimeseriesPages(observedProperty=observedProperty,beginPosition=beginPosition,provider=provider,checkpoint=timeseries_checkpoint)
+            for i, timeseries in self.iterPrefetched(pages):
+                if "member" not in timeseries:
+                    logging.debug("No timeseries found")
+                    break
+                if has_data:
+                    timeseries["member"] = self.filterByAvailability(timeseries["member"],self.threshold_begin_date)
+                member_count += len(timeseries["member"])
+                if save_geojson or members is not None or previous_members is not None or deduplicate:
+                    member.extend(timeseries["member"])
+                if len(timeseries["member"]):
+                    frames.append(self.timeseriesToFEWS(timeseries))
+            if previous_members is not None:
+                unchanged = self.getUnchangedMembers(previous_members, member, has_data)
+                member_count += len(unchanged)
+                member.extend(unchanged)
+                if len(unchanged):
+                    frames.append(self.timeseriesToFEWS({"member": unchanged}))
+            if deduplicate:
+                merged = self.mergeTimeseries([{"member": member}])["member"]
+                if len(merged) < len(member):
+                    logging.debug("%i duplicate members in different pages" % (len(member) - len(merged)))
+                    member[:] = merged
+                    member_count = len(member)
+                    frames = [self.timeseriesToFEWS({"member": member})]
+            stations_fews = stations_future.result()
+        for checkpoint in [stations_checkpoint, timeseries_checkpoint]:
+            if checkpoint is not None:
+                checkpoint.clear()
+        logging.debug("timeseries length: %i" % member_count)
+        if save_geojson:
+            f = open(output_dir / "timeseries.json","w")
+            f.write(json.dumps({"member": member}, indent=2, ensure_ascii=False))
+            f.close()
+            self.writeColumnarRecords(member, output_dir / "timeseries.json")
+        timeseries_fews = self.addStationMetadata(pandas.concat(frames, ignore_index=True), stations_fews) if len(frames) else pandas.DataFrame([])
+        if self.config["compact_frames"]:
+            timeseries_fews = compactFrame(timeseries_fews)
+        if save_geojson:
+            f = open(output_dir / "timeseries.csv","w")
+            f.write(timeseries_fews.to_csv(index=False))
+            f.close()
+            self.writeColumnar(timeseries_fews, output_dir / "timeseries")
+        return stations_fews, timeseries_fews
+
     def setOriginalStationId(self,stations_or_timeseries_fews):
         stations_or_timeseries_fews_original_id = stations_or_timeseries_fews.assign(STATION_ID=stations_or_timeseries_fews["ORIGINAL_STATION_ID"])
         del stations_or_timeseries_fews_original_id["ORIGINAL_STATION_ID"]
@@ -635,14 +1084,234 @@ class Client:
             return timeseries_fews
         return timeseries_fews[~pandas.isna(timeseries_fews["TIMESTEP_HOUR"])]
 
-    def getMonitoringPointsWithPagination(self, view: str = default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, json_output: str = None, fews_output: str = None, save_geojson : bool = False, output_dir : str = "",country: str = None, provider : str = None) -> dict:
+    def iterPages(self, getPage, offsets, isLastPage, max_workers : int = 1):
+        """Fetches pages concurrently and yields them in offset order
+
+        Parameters
+        ----------
+        getPage : callable
+            Function that takes an offset and returns the page
+        offsets : iterable
+            Page offsets, in ascending order
+        isLastPage : callable
+            Function that takes an offset and its page and returns True if the page ends the result set
+        max_workers : int
+            Maximum number of concurrent requests. Default 1 (sequential)
+
+        Yields
+        ------
+        tuple
+            (offset, page), stopping after the first page for which isLastPage is True
+        """
+        offsets = iter(offsets)
+        end_offset = None
+        lock = threading.Lock()
+        def fetch(offset):
+            nonlocal end_offset
+            page = getPage(offset)
+            if isLastPage(offset, page):
+                with lock:
+                    if end_offset is None or offset < end_offset:
+                        end_offset = offset
+            return page
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def schedule():
+                # stop scheduling once a page beyond the end of the result set is known
+                for offset in offsets:
+                    with lock:
+                        if end_offset is not None and offset > end_offset:
+                            return
+                    pending.append((offset, executor.submit(fetch, offset)))
+                    return
+            try:
+                for _ in range(max_workers):
+                    schedule()
+                while len(pending):
+                    offset, future = pending.popleft()
+                    page = future.result()
+                    if isLastPage(offset, page):
+                        yield offset, page
+                        break
+                    # keep the window full while the page is being consumed
+                    schedule()
+                    yield offset, page
+            finally:
+                for offset, future in pending:
+                    future.cancel()
+
+    def iterPrefetched(self, iterable, queue_size : int = None):
+        """Iterates over iterable in a background thread, buffering up to queue_size items in a bounded queue
+
+        Used to overlap the production of items (i.e. page downloads) with their consumption (i.e. conversion). Exceptions raised by the producer are re-raised in the consumer
+
+        Parameters
+        ----------
+        iterable : iterable
+            Items to produce
+        queue_size : int
+            Maximum number of produced items waiting to be consumed. Defaults to config pipeline_queue_size
+
+        Yields
+        ------
+        items of iterable
+        """
+        queue_size = queue_size if queue_size is not None else self.config["pipeline_queue_size"]
+        items = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        end = object()
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        def produce():
+            try:
+                for item in iterable:
+                    if not put((item, None)):
+                        return
+                put((end, None))
+            except Exception as e:
+                put((end, e))
+            finally:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item, error = items.get()
+                if error is not None:
+                    raise error
+                if item is end:
+                    break
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    def getCheckpointStore(self, output_dir : str = "", **key) -> CheckpointStore:
+        """Returns the checkpoint store of the harvest identified by key in output_dir, or None if checkpoint is not enabled in config. Previous checkpoints of the same harvest are reused only if resume is set"""
+        if not self.config["checkpoint"] and not self.config["resume"]:
+            return None
+        return CheckpointStore(output_dir, key, resume=self.config["resume"])
+
+    def iterMonitoringPointsPages(self, view: str = default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, save_geojson : bool = False, output_dir : str = "",country: str = None, provider : str = None, max_workers : int = None, checkpoint : CheckpointStore = None):
+        """Iterates over the pages of getMonitoringPoints (monitoring_points_per_page results each) until a short page or monitoring_points_max, requesting up to max_workers pages concurrently
+
+        Parameters
+        ----------
+        checkpoint : CheckpointStore
+            If not None, pages completed in a previous run are read from it and new pages are saved into it
+
+        Yields
+        ------
+        tuple
+            (offset, monitoringPoints)
+        """
+        output_dir = Path(output_dir)
+        max_workers = max_workers if max_workers is not None else self.config["max_workers"]
+        if self.config["tiled_harvest"]:
+            return self.iterMonitoringPointsTiles(view=view,west=west,south=south,east=east,north=north,save_geojson=save_geojson,output_dir=output_dir,country=country,provider=provider,max_workers=max_workers,checkpoint=checkpoint)
+        def getPage(i, limit):
+            logging.debug("getMonitoringPoints offset: %i, limit: %i" % (i, limit))
+            output = output_dir / ("monitoringPointsResponse_%i.json" % i) if save_geojson else None
+            return self.getMonitoringPoints(view=view,offset=i,limit=limit,west = west, south = south, east = east, north = north, output=output, country = country, provider = provider)
+        return self.iterSizedPages("monitoring_points", getPage, "results", max_workers=max_workers, checkpoint=checkpoint)
+
+    def iterMonitoringPointsTiles(self, view: str = default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, save_geojson : bool = False, output_dir : str = "",country: str = None, provider : str = None, max_workers : int = None, checkpoint : CheckpointStore = None):
+        """Tiled harvest of monitoring points, used by iterMonitoringPointsPages when tiled_harvest is set
+
+        The bounding box (defaults to the extent of the basins layer) is requested as a single page of monitoring_points_per_page results. A tile that comes back full is split into four quadrants, recursively up to tile_max_depth levels (deeper tiles are paginated instead). Tiles are requested concurrently (up to max_workers) and stations on tile borders are de-duplicated by id
+
+        Parameters
+        ----------
+        checkpoint : CheckpointStore
+            If not None, tiles completed (or split) in a previous run are read from it and new ones are saved into it, under the offset of their quadtree path (see getTileOffset)
+
+        Yields
+        ------
+        tuple
+            (tile number, monitoringPoints) for each non-empty tile, in quadtree order
+        """
+        output_dir = Path(output_dir)
+        max_workers = max_workers if max_workers is not None else self.config["max_workers"]
+        if west is None or south is None or east is None or north is None:
+            west, south, east, north = [float(x) for x in self.basins.total_bounds]
+        limit = self.config["monitoring_points_per_page"]
+        def getCheckpointedTile(path, bbox):
+            if checkpoint is not None and checkpoint.has(self.getTileOffset(path)):
+                tile, tile_limit = checkpoint.load(self.getTileOffset(path))
+                if tile_limit == limit:
+                    logging.debug("tile %s read from checkpoint" % path)
+                    return None if tile["split"] else tile["results"]
+            results = getTile(path, bbox)
+            if checkpoint is not None:
+                checkpoint.save(self.getTileOffset(path), {"split": results is None, "results": results}, limit)
+            return results
+        def getTile(path, bbox):
+            output = output_dir / ("monitoringPointsResponse_tile%s.json" % path) if save_geojson else None
+            monitoringPoints = self.getMonitoringPoints(view=view,offset=1,limit=limit,west=bbox[0],south=bbox[1],east=bbox[2],north=bbox[3],output=output,country=country,provider=provider)
+            if "results" not in monitoringPoints:
+                return []
+            if len(monitoringPoints["results"]) < limit:
+                return monitoringPoints["results"]
+            if len(path) < self.config["tile_max_depth"]:
+                # full tile: split
+                return None
+            logging.warning("tile %s %s is full at tile_max_depth=%i. Using pagination" % (path, str(bbox), self.config["tile_max_depth"]))
+            def getPage(i, page_limit):
+                return self.getMonitoringPoints(view=view,offset=i,limit=page_limit,west=bbox[0],south=bbox[1],east=bbox[2],north=bbox[3],country=country,provider=provider)
+            results = []
+            for i, page in self.iterSizedPages("monitoring_points", getPage, "results"):
+                if "results" in page:
+                    results.extend(page["results"])
+            return results
+        tiles = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(getCheckpointedTile, "", (west, south, east, north)): ("", (west, south, east, north))}
+            while len(pending):
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, bbox = pending.pop(future)
+                    results = future.result()
+                    if results is not None:
+                        tiles[path] = results
+                        continue
+                    for quadrant, quadrant_bbox in enumerate(self.splitBbox(bbox)):
+                        pending[executor.submit(getCheckpointedTile, path + str(quadrant), quadrant_bbox)] = (path + str(quadrant), quadrant_bbox)
+        logging.info("monitoring points: %i tiles, max depth %i" % (len(tiles), max(len(path) for path in tiles)))
+        found = set()
+        for i, path in enumerate(sorted(tiles)):
+            results = []
+            for item in tiles[path]:
+                if item["id"] in found:
+                    continue
+                found.add(item["id"])
+                results.append(item)
+            if len(results):
+                yield i, {"results": results}
+
+    def getTileOffset(self, path : str) -> int:
+        """Checkpoint offset of a tile: its quadtree path (string of quadrant digits) read in base 4 after a leading 1, unique for every path"""
+        return int("1" + path, 4)
+
+    def splitBbox(self, bbox : tuple) -> list:
+        """Splits bbox (west, south, east, north) into its four quadrants: southwest, southeast, northwest, northeast"""
+        west, south, east, north = bbox
+        x = (west + east) / 2
+        y = (south + north) / 2
+        return [(west, south, x, y), (x, south, east, y), (west, y, x, north), (x, y, east, north)]
+
+    def getMonitoringPointsWithPagination(self, view: str = default_config["view"],east: float = None, west: float = None, north: float = None, south: float = None, json_output: str = None, fews_output: str = None, save_geojson : bool = False, output_dir : str = "",country: str = None, provider : str = None, max_workers : int = None) -> dict:
         output_dir = Path(output_dir)
         stations = pandas.DataFrame(columns= ["STATION_ID", "STATION_NAME", "STATION_SHORTNAME", "TOOLTIP", "LATITUDE", "LONGITUDE", "ALTITUDE", "COUNTRY", "ORGANIZATION", "SUBBASIN"])
         results = []
-        for i in range(1,self.config["monitoring_points_max"],self.config["monitoring_points_per_page"]):
-            logging.debug("getMonitoringPoints offset: %i" % i)
-            output = output_dir / ("monitoringPointsResponse_%i.json" % i) if save_geojson else None
-            monitoringPoints = self.getMonitoringPoints(offset=i,limit=self.config["monitoring_points_per_page"],west = west, south = south, east = east, north = north, output=output, country = country, provider = provider)
+        checkpoint = self.getCheckpointStore(output_dir, harvest="monitoringPoints", view=view, bbox=[west,south,east,north], country=country, provider=provider, per_page=self.getPageSizeKey("monitoring_points"), tiled=self.config["tiled_harvest"])
+        for i, monitoringPoints in self.iterMonitoringPointsPages(view=view,west=west,south=south,east=east,north=north,save_geojson=save_geojson,output_dir=output_dir,country=country,provider=provider,max_workers=max_workers,checkpoint=checkpoint):
             # convert to FEWS stations CSV, output as gauges.csv
             if "results" not in monitoringPoints:
                 logging.debug("no monitoring points found")
@@ -651,8 +1320,8 @@ class Client:
             if fews_output:
                 stations_i = self.monitoringPointsToFEWS(monitoringPoints)
                 stations= pandas.concat([stations,stations_i])
-            if len(monitoringPoints["results"]) < self.config["monitoring_points_per_page"]:
-                break
+        if checkpoint is not None:
+            checkpoint.clear()
         result = {
             # "type": "featureCollection",
             "results": results
@@ -661,15 +1330,64 @@ class Client:
             f = open(json_output,"w")
             f.write(json.dumps(result, indent=2, ensure_ascii=False))
             f.close()
+            self.writeColumnarRecords(results, json_output)
         if fews_output:
             f = open(fews_output,"w")
             f.write(stations.to_csv())
             f.close()
+            self.writeColumnar(stations, Path(fews_output).with_suffix(""))
             return stations
         else:
             return result
 
-    def getTimeseriesMulti(self, view: str = default_config["view"], monitoringPoint: list or str = None, observedProperty: list or str = None, beginPosition: str = None, endPosition: str = None, offset: int = 1, limit: int = 10, output: str = None, has_data=False, provider : str = None):
+    def getTimeseriesMulti(self, view: str = default_config["view"], monitoringPoint: list or str = None, observedProperty: list or str = None, beginPosition: str = None, endPosition: str = None, offset: int = 1, limit: int = 10, output: str = None, has_data=False, provider : str = None, max_workers : int = None):
+        """Retrieves timeseries for every combination of monitoringPoint and observedProperty
+
+        Requests are dispatched concurrently (up to max_workers) and merged in monitoringPoint, observedProperty order. Members are de-duplicated on (featureOfInterest, observedProperty, time step), keeping the latest (see mergeTimeseries)
+
+        Parameters
+        ----------
+        monitoringPoint : list or str
+            Identifier(s) of the monitoring point
+        observedProperty : list or str
+            Identifier(s) of the observed property
+        beginPosition : str or dict
+            Temporal interval begin position, or begin position of each observedProperty (dict indexed by observedProperty)
+        max_workers : int
+            Maximum number of concurrent requests. Defaults to config max_workers
+        
+        Returns
+        -------
+        dict
+            A dict containing the merged timeseries members
+        """
+        queries = self.getTimeseriesQueries(monitoringPoint, observedProperty, provider, beginPosition)
+        if not len(queries):
+            return self.getTimeseries( view = view, beginPosition = beginPosition, endPosition = endPosition, offset = offset, limit = limit, output = output, has_data=has_data, provider = provider)
+        max_workers = max_workers if max_workers is not None else self.config["max_workers"]
+        def getTimeseries(query):
+            logging.debug("getTimeseries: %s" % str(query))
+            return self.getTimeseries(view, endPosition = endPosition, offset = offset, limit = limit, has_data=has_data, **query)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # in a copy of the context of the caller, so that response sizes count for its page (see page_sizer)
+            futures = [executor.submit(contextvars.copy_context().run, getTimeseries, query) for query in queries]
+            responses = [future.result() for future in futures]
+        result = self.mergeTimeseries(responses)
+        if output is not None:
+            try: 
+                f = open(output,"w")
+            except:
+                raise Exception("Couldn't open file %s for writing" % output)
+            f.write(json.dumps(result, indent=2, ensure_ascii=False))
+            f.close()
+        return result
+
+    def getTimeseriesQueries(self, monitoringPoint: list or str = None, observedProperty: list or str = None, provider : str = None, beginPosition : str or dict = None) -> list:
+        """Returns the getTimeseries parameters of every combination of monitoringPoint and observedProperty (empty list if both are empty). beginPosition may be given by observedProperty (dict)"""
+        def getBeginPosition(op):
+            if type(beginPosition) == dict:
+                return beginPosition[op] if op in beginPosition else None
+            return beginPosition
         if monitoringPoint is not None:
             if type(monitoringPoint) == str:
                 monitoringPoint = [monitoringPoint]
@@ -680,61 +1398,218 @@ class Client:
                 observedProperty = [observedProperty]
         else:
             observedProperty = []
+        queries = []
         if len(monitoringPoint) == 0:
-            if len(observedProperty) == 0:
-                return self.getTimeseries( view = view, beginPosition = beginPosition, endPosition = endPosition, offset = offset, limit = limit, output = output, has_data=has_data, provider = provider)
-            else:
-                member = []
-                for op in observedProperty:
-                    logging.debug("observedProperty: %s" % op)
-                    timeseries = self.getTimeseries(view, observedProperty = op, beginPosition = beginPosition, endPosition = endPosition, offset = offset, limit = limit, output = output, has_data=has_data, provider = provider)
-                    if "member" in timeseries:
-                        member.extend(timeseries["member"])
-                return {
-                    # "type": "featureCollection",
-                    "member": member
-                }
+            for op in observedProperty:
+                queries.append({"observedProperty": op, "provider": provider, "beginPosition": getBeginPosition(op)})
         else:
-            member = []
             for mp in monitoringPoint:
-                logging.debug("monitoringPoint: %s" % mp)
                 if len(observedProperty) == 0:
-                    timeseries = self.getTimeseries( view = view, monitoringPoint = mp, beginPosition = beginPosition, endPosition = endPosition, offset = offset, limit = limit, output = output, has_data=has_data)
-                    if "member" in timeseries:
-                        member.extend(timeseries["member"])
+                    queries.append({"monitoringPoint": mp, "beginPosition": getBeginPosition(None)})
                 else:
                     for op in observedProperty:
-                        logging.debug("observedProperty: %s" % op)
-                        timeseries = self.getTimeseries(view, monitoringPoint = mp, observedProperty = op, beginPosition = beginPosition, endPosition = endPosition, offset = offset, limit = limit, output = output, has_data=has_data)
-                        if "member" in timeseries:
-                            member.extend(timeseries["member"])
-            return {
-                # "type": "featureCollection",
-                "member": member
-            }
+                        queries.append({"monitoringPoint": mp, "observedProperty": op, "beginPosition": getBeginPosition(op)})
+        return queries
 
-    def getTimeseriesWithPagination(self, view: str = default_config["view"], monitoringPoint: list or str = None, observedProperty: list or str = None, beginPosition: str = None, endPosition: str = None, json_output: str = None, fews_output: str = None, save_geojson : bool = False, output_dir : str = "", grouped : bool = False, has_data : bool = True, provider : str = None) -> dict:
-        output_dir = Path(output_dir)
+    def mergeTimeseries(self, responses : list) -> dict:
+        """Merges getTimeseries responses, de-duplicating members on (featureOfInterest, observedProperty, time step). Of duplicate members the one with the latest phenomenonTime.end is kept, so that a stale copy doesn't hide an active series from the availability filter"""
         member = []
-        var_map = self.getVariableMapping()
-        timeseries_fews = None # pandas.DataFrame(columns= ["STATION_ID", "EXTERNAL_LOCATION_ID", "EXTERNAL_PARAMETER_ID", "TIMESTEP_HOUR", "UNIT", "IMPORT_SOURCE"])
-        for i in range(1,self.config["timeseries_max"],self.config["timeseries_per_page"]):
-            logging.debug("getTimeseriesMulti, offset: %i" % i)
-            output = output_dir / ("timeseriesResponse_%i.json" % i) if save_geojson else None
-            timeseries = self.getTimeseriesMulti(offset=i,monitoringPoint=monitoringPoint,observedProperty=observedProperty,beginPosition=beginPosition,endPosition=endPosition,limit=self.config["timeseries_per_page"],output=output,has_data=False, provider = provider)
+        found = {}
+        for timeseries in responses:
             if "member" not in timeseries:
-                logging.debug("No timeseries found")
-                break
-            timeseries_length = len(timeseries["member"])
-            logging.debug("Found %i members" % timeseries_length)
-            if has_data:
-                timeseries["member"] = self.filterByAvailability(timeseries["member"],self.threshold_begin_date)
-            logging.debug("Offset: %i, length: %i, got %i timeseries after filtering" % (i,self.config["timeseries_per_page"],len(timeseries["member"])))
-            timeseries_fews = pandas.concat([timeseries_fews,self.timeseriesToFEWS(timeseries)]) if timeseries_fews is not None else self.timeseriesToFEWS(timeseries)
-            member.extend(timeseries["member"])
-            if timeseries_length < self.config["timeseries_per_page"]:
-                logging.debug("last page, breaking")
-                break
+                continue
+            for item in timeseries["member"]:
+                key = self.getMemberKey(item)
+                if key in found:
+                    i = found[key]
+                    if self.getMemberEnd(item) > self.getMemberEnd(member[i]):
+                        member[i] = item
+                    continue
+                found[key] = len(member)
+                member.append(item)
+        return {
+            # "type": "featureCollection",
+            "member": member
+        }
+
+    def getMemberKey(self, item : dict) -> tuple:
+        """Identity of a timeseries member: (featureOfInterest, observedProperty, time step). Members of different time step become different FEWS series (CHILD_ID)"""
+        result = item["result"] if "result" in item else {}
+        metadata = result["defaultPointMetadata"] if "defaultPointMetadata" in result else {}
+        timestep = metadata["aggregationDuration"] if "aggregationDuration" in metadata else result["metadata"]["intendedObservationSpacing"] if "metadata" in result and "intendedObservationSpacing" in result["metadata"] else None
+        return (item["featureOfInterest"]["href"], item["observedProperty"]["href"], timestep)
+
+    def getMemberEnd(self, item : dict) -> datetime:
+        """phenomenonTime.end of a timeseries member (UTC), datetime.min if missing"""
+        if "phenomenonTime" not in item or item["phenomenonTime"].get("end") is None:
+            return pytz.utc.localize(datetime.min)
+        end = datetime.fromisoformat(item["phenomenonTime"]["end"].replace("Z", "+00:00"))
+        return end if end.tzinfo is not None else pytz.utc.localize(end)
+
+    def iterTimeseriesPages(self, view: str = default_config["view"], monitoringPoint: list or str = None, observedProperty: list or str = None, beginPosition: str = None, endPosition: str = None, save_geojson : bool = False, output_dir : str = "", provider : str = None, checkpoint : CheckpointStore = None):
+        """Iterates over the pages of getTimeseriesMulti (timeseries_per_page members each) until a short page or timeseries_max
+
+        Parameters
+        ----------
+        checkpoint : CheckpointStore
+            If not None, pages completed in a previous run are read from it and new pages are saved into it
+
+        Yields
+        ------
+        tuple
+            (offset, timeseries)
+        """
+        output_dir = Path(output_dir)
+        def getPage(i, limit):
+            logging.debug("getTimeseriesMulti, offset: %i, limit: %i" % (i, limit))
+            output = output_dir / ("timeseriesResponse_%i.json" % i) if save_geojson else None
+            return self.getTimeseriesMulti(view=view,offset=i,monitoringPoint=monitoringPoint,observedProperty=observedProperty,beginPosition=beginPosition,endPosition=endPosition,limit=limit,output=output,has_data=False, provider = provider)
+        return self.iterSizedPages("timeseries", getPage, "member", checkpoint=checkpoint)
+
+    def getPageSizeKey(self, name : str):
+        """Page size identifying a checkpointed harvest: <name>_per_page, or 'adaptive' if adaptive_page_size is set"""
+        return "adaptive" if self.config["adaptive_page_size"] else self.config["%s_per_page" % name]
+
+    def iterSizedPages(self, name : str, getPage, items_key : str, max_workers : int = 1, checkpoint : CheckpointStore = None):
+        """Iterates over the pages of a paginated request until a short page or <name>_max
+
+        Pages have <name>_per_page items unless adaptive_page_size is set, in which case the page size is adjusted after each page to approach page_target_latency within [page_size_min, page_size_max] and page_max_bytes (see PageSizer). A failed page is then retried as two half pages. Offsets follow the page size of each request, so that pages neither overlap nor leave gaps. A warning is logged if <name>_max is reached before the last page
+
+        Parameters
+        ----------
+        name : str
+            Config prefix of the request: 'monitoring_points' or 'timeseries'
+        getPage : callable
+            Function that takes an offset and a limit and returns the page
+        items_key : str
+            Key of the list of items in a page ('results' or 'member')
+        max_workers : int
+            Maximum number of concurrent requests. Default 1 (sequential)
+        checkpoint : CheckpointStore
+            If not None, pages completed in a previous run are read from it and new pages are saved into it
+
+        Yields
+        ------
+        tuple
+            (offset, page)
+        """
+        per_page = self.config["%s_per_page" % name]
+        max_offset = self.config["%s_max" % name]
+        sizer = PageSizer(name, per_page, self.config["page_size_min"], self.config["page_size_max"], self.config["page_target_latency"], self.config["page_max_bytes"]) if self.config["adaptive_page_size"] else None
+        limits = {}
+        stored = {}
+        def offsets():
+            offset = 1
+            while offset < max_offset:
+                limits[offset] = sizer.limit if sizer is not None else per_page
+                if checkpoint is not None and checkpoint.has(offset):
+                    # resume along the offsets of the stored pages
+                    page, limit = checkpoint.load(offset)
+                    if limit is not None:
+                        limits[offset] = limit
+                        stored[offset] = page
+                yield offset
+                offset = offset + limits[offset]
+        def fetch(offset, limit):
+            start = time.monotonic()
+            try:
+                page, size = measureResponses(getPage, offset, limit)
+            except Exception as e:
+                if sizer is None or limit // 2 < sizer.min_limit:
+                    raise
+                logging.warning("%s page at offset %i (limit %i) failed: %s. Retrying as two pages" % (name, offset, limit, str(e)))
+                half = limit // 2
+                sizer.shrink(limit)
+                page = fetch(offset, half)
+                if items_key not in page or len(page[items_key]) < half:
+                    return page
+                rest = fetch(offset + half, limit - half)
+                page[items_key] = page[items_key] + (rest[items_key] if items_key in rest else [])
+                return page
+            if sizer is not None:
+                sizer.update(limit, len(page[items_key]) if items_key in page else 0, time.monotonic() - start, size)
+            return page
+        def getCheckpointedPage(offset):
+            limit = limits[offset]
+            if offset in stored:
+                logging.debug("%s offset %i read from checkpoint" % (name, offset))
+                return stored.pop(offset)
+            page = fetch(offset, limit)
+            if checkpoint is not None:
+                checkpoint.save(offset, page, limit)
+            return page
+        def isLastPage(offset, page):
+            return items_key not in page or len(page[items_key]) < limits[offset]
+        complete = False
+        for offset, page in self.iterPages(getCheckpointedPage, offsets(), isLastPage, max_workers=max_workers):
+            complete = isLastPage(offset, page)
+            if complete:
+                # compared with the limit requested at this offset, which varies with adaptive sizing
+                logging.debug("%s: last page at offset %i (%i items, limit %i)" % (name, offset, len(page[items_key]) if items_key in page else 0, limits[offset]))
+            yield offset, page
+        if sizer is not None:
+            logging.info("%s page sizes: %s" % (name, ", ".join(str(limit) for limit in sizer.sizes)))
+        if not complete:
+            logging.warning("%s: stopped at %s_max=%i before the last page. Results may be truncated" % (name, name, max_offset))
+
+    def getTimeseriesWithPagination(self, view: str = default_config["view"], monitoringPoint: list or str = None, observedProperty: list or str = None, beginPosition: str = None, endPosition: str = None, json_output: str = None, fews_output: str = None, save_geojson : bool = False, output_dir : str = "", grouped : bool = False, has_data : bool = True, provider : str = None, stream : bool = False) -> dict:
+        """Retrieves timeseries using pagination, optionally writing raw (json_output) and FEWS (fews_output) outputs
+
+        Parameters
+        ----------
+        stream : bool
+            Constant-memory mode: each page is converted and appended to the outputs on disk (json_output as JSON lines, one member per line) and then dropped. Returns only the counts of written members and rows. Not available with grouped
+        
+        Returns
+        -------
+        dict or DataFrame
+            dict of members, or DataFrame of FEWS rows if fews_output is set, or dict of counts if stream
+        """
+        if stream:
+            if grouped:
+                raise Exception("grouped output is not available in stream mode")
+            if not json_output and not fews_output:
+                raise Exception("Missing arguments: at least one of json_output fews_output must be defined in stream mode")
+        output_dir = Path(output_dir)
+        member = []
+        var_map = self.getVariableIndex(view) if grouped else None
+        timeseries_fews = []
+        counts = {"member": 0, "fews": 0}
+        checkpoint = self.getCheckpointStore(output_dir, harvest="timeseries", view=view, monitoringPoint=monitoringPoint, observedProperty=observedProperty, beginPosition=beginPosition, endPosition=endPosition, provider=provider, per_page=self.getPageSizeKey("timeseries"))
+        json_file = open(json_output,"w") if stream and json_output else None
+        fews_file = open(fews_output,"w") if stream and fews_output else None
+        try:
+            for i, timeseries in self.iterTimeseriesPages(view=view,monitoringPoint=monitoringPoint,observedProperty=observedProperty,beginPosition=beginPosition,endPosition=endPosition,save_geojson=save_geojson,output_dir=output_dir,provider=provider,checkpoint=checkpoint):
+                if "member" not in timeseries:
+                    logging.debug("No timeseries found")
+                    break
+                timeseries_length = len(timeseries["member"])
+                logging.debug("Found %i members" % timeseries_length)
+                if has_data:
+                    timeseries["member"] = self.filterByAvailability(timeseries["member"],self.threshold_begin_date)
+                logging.debug("Offset: %i, got %i timeseries after filtering" % (i,len(timeseries["member"])))
+                if stream:
+                    if json_file is not None:
+                        for item in timeseries["member"]:
+                            json_file.write(json.dumps(item, ensure_ascii=False) + "\n")
+                    if fews_file is not None and len(timeseries["member"]):
+                        page_fews = self.timeseriesToFEWS(timeseries)
+                        page_fews.to_csv(fews_file, header=counts["fews"] == 0)
+                        counts["fews"] += len(page_fews)
+                    counts["member"] += len(timeseries["member"])
+                else:
+                    timeseries_fews.append(self.timeseriesToFEWS(timeseries))
+                    member.extend(timeseries["member"])
+        finally:
+            if json_file is not None:
+                json_file.close()
+            if fews_file is not None:
+                fews_file.close()
+        if checkpoint is not None:
+            checkpoint.clear()
+        if stream:
+            return counts
+        timeseries_fews = pandas.concat(timeseries_fews) if len(timeseries_fews) else None
         #group timeseries by variable using FEWS variable names and output each group to a separate .csv file
         result = {
             # "type": "featureCollection",
@@ -744,17 +1619,20 @@ class Client:
             f = open(json_output,"w")
             f.write(json.dumps(result, indent=2, ensure_ascii=False))
             f.close()
+            self.writeColumnarRecords(member, json_output)
         if fews_output:
             if grouped:
                 timeseries_fews_grouped = self.groupTimeseriesByVar(timeseries_fews,var_map,output_dir=output_dir) # ,fews=True)
                 f = open(fews_output,"w")
                 f.write(timeseries_fews_grouped.to_csv())
                 f.close()
+                self.writeColumnar(timeseries_fews_grouped, Path(fews_output).with_suffix(""))
                 return timeseries_fews_grouped
             else:
                 f = open(fews_output,"w")
                 f.write(timeseries_fews.to_csv())
                 f.close()
+                self.writeColumnar(timeseries_fews, Path(fews_output).with_suffix(""))
                 return timeseries_fews
         else:
             return result
@@ -798,11 +1676,19 @@ class Client:
         stations_fews = stations_fews.merge(ts_st,how='inner',on="STATION_ID")
         return stations_fews
 
+    @timed("filter")
     def filterByAvailability(self,members,threshold_begin_date):
-        return [x for x in members if "phenomenonTime" in x and datetime.fromisoformat(x["phenomenonTime"]["end"].replace("Z","+00:00")) >=  threshold_begin_date]
+        members = [x for x in members if "phenomenonTime" in x]
+        if not len(members):
+            return members
+        end = pandas.to_datetime([x["phenomenonTime"]["end"] for x in members], utc=True, format="ISO8601")
+        return [x for x, available in zip(members, end >= threshold_begin_date) if available]
 
 
 if __name__ == "__main__":
+    # the log is rewritten on each run
+    Path("log").mkdir(exist_ok=True)
+    logging.basicConfig(filename="log/whos_client.log",filemode="w",level=logging.DEBUG,format="%(asctime)s %(levelname)s %(message)s")
     config = open("config.json")
     config = json.load(config)
     client = Client(config)
@@ -828,12 +1714,45 @@ if __name__ == "__main__":
     argparser.add_argument('-O','--output_dir',help = 'output directory for fews csv', type=str)
     argparser.add_argument('-c','--country',help = 'country code (ISO3)', type=str)
     argparser.add_argument('-P','--provider',help = 'provider code (i.e.: argentina-ina)', type=str)
+    argparser.add_argument('--cache-dir',help = "cache API responses in this directory", type=str)
+    argparser.add_argument('--no-cache',help = "disable the response cache", action="store_true")
+    argparser.add_argument('-s','--stream',help = "timeseries: write each page to the outputs and drop it (constant memory). json output is written as JSON lines", action="store_true")
+    argparser.add_argument('-I','--incremental',help = "all: delta sync against the previous run in output_dir. Requests only the timeseries that reached the watermark of their variable, rewrites only changed tables and writes changelog.json", action="store_true")
+    argparser.add_argument('--checkpoint',help = "save completed pages in <output_dir>/checkpoints so that an interrupted harvest can be resumed", action="store_true", default=None)
+    argparser.add_argument('--resume',help = "resume an interrupted harvest from its last completed page (implies --checkpoint)", action="store_true", default=None)
+    argparser.add_argument('-A','--adaptive_page_size',help = "adjust the page size of paginated requests to the observed latency", action="store_true", default=None)
+    argparser.add_argument('--tiled_harvest',help = "harvest monitoring points by quadtree bounding box tiles (bbox or extent of the basins layer) instead of global pagination, not limited by monitoring_points_max", action="store_true", default=None)
+    argparser.add_argument('--no-subbasin-cache',help = "don't keep the subbasin lookup table of station coordinates (<output_dir>/subbasin_cache.json)", action="store_true")
+    argparser.add_argument('--compact_frames',help = "keep the FEWS tables in memory with categorical / fixed-width dtypes (same CSV output)", action="store_true", default=None)
+    argparser.add_argument('--columnar',help = "also write the FEWS tables and raw responses in these columnar formats (requires pyarrow): parquet (zstd), arrow (IPC, memory-mappable)", nargs="+", choices=["parquet","arrow"])
+    argparser.add_argument('--metrics',help = "write the JSON run report (request and per-stage metrics) to this file", type=str)
+    argparser.add_argument('--prometheus',help = "write the run metrics in Prometheus text format to this file", type=str)
+    argparser.add_argument('--profile',help = "profile the run: deterministic (cProfile, default) or sampling. Logs the top hot functions", nargs="?", const="deterministic", choices=["deterministic","sampling"])
+    argparser.add_argument('--profile-out',help = "profile output path prefix (writes .pstats and .collapsed flamegraph stacks). Defaults to log/whos_client_profile", type=str, default="log/whos_client_profile")
+    argparser.add_argument('-w','--max_workers',help = "Maximum number of concurrent page requests. Defaults to %s" % Client.default_config["max_workers"], type=int)
     args = argparser.parse_args()
     config = {}
-    for key in ["url","token","monitoring_points_max","monitoring_points_per_page","timeseries_max","timeseries_per_page","view"]:
+    for key in ["url","token","monitoring_points_max","monitoring_points_per_page","timeseries_max","timeseries_per_page","view","max_workers","checkpoint","resume","adaptive_page_size","tiled_harvest","compact_frames"]:
         if key in vars(args) and vars(args)[key] is not None:
             config[key] = vars(args)[key]
+    if args.cache_dir is not None:
+        config["cache_dir"] = args.cache_dir
+    if args.no_cache:
+        config["cache_dir"] = None
+    if args.no_subbasin_cache:
+        config["subbasin_cache"] = False
+    if args.columnar is not None:
+        config["columnar_formats"] = args.columnar
     client = Client(config)
+    if args.metrics is not None or args.prometheus is not None:
+        import atexit
+        # written at exit, also when the run fails
+        atexit.register(writeMetrics, client.metrics, args.metrics, args.prometheus)
+    if args.profile is not None:
+        import atexit
+        profiler = client.profile(args.profile_out, mode=args.profile)
+        profiler.start()
+        atexit.register(profiler.stop)
     if args.action.lower() == "monitoringpoints":
         # GET MONITORING POINTS
         mp_args = {}
@@ -881,6 +1800,8 @@ if __name__ == "__main__":
             ts_args["fews_output"] = args.fews
         if args.provider:
             ts_args["provider"] = args.provider
+        if args.stream:
+            ts_args["stream"] = True
         if "json_output" not in ts_args and "fews_output" not in ts_args:
             raise Exception("Missing arguments: at least one of json fews must be defined")
         client.getTimeseriesWithPagination(**ts_args)
@@ -901,6 +1822,11 @@ if __name__ == "__main__":
             all_args["north"] = args.bbox[3]
         if args.provider:
             all_args["provider"] = args.provider
+        if args.beginPosition:
+            all_args["beginPosition"] = args.beginPosition
+        if args.incremental:
+            all_args["incremental"] = True
+        all_args["pipeline"] = True
         # make FEWS tables for WHOS-Plata (all stations and variables). Save into specified folder
         client.makeFewsTables(**all_args)
     else: